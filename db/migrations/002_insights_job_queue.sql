@@ -0,0 +1,12 @@
+--
+-- Insights job queue
+--
+-- The `insights` table is used as a work queue by scripts/src/insights_worker.py:
+-- rows with status 'pending' are claimed oldest-first with
+-- SELECT ... FOR UPDATE SKIP LOCKED. This partial index keeps that claim
+-- query cheap regardless of how many completed insights exist.
+--
+
+CREATE INDEX IF NOT EXISTS idx_insights_pending_created_at
+    ON public.insights USING btree (created_at)
+    WHERE status = 'pending';
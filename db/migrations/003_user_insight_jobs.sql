@@ -0,0 +1,30 @@
+--
+-- Patient summary jobs
+--
+-- POST /internal/generate-user-insights queues a row here and returns its id;
+-- scripts/src/insights_worker.py claims pending rows with
+-- SELECT ... FOR UPDATE SKIP LOCKED and writes the result to
+-- users.patient_insights. Status values match the insights queue:
+-- pending -> processing -> completed | failed.
+--
+
+CREATE TABLE IF NOT EXISTS public.user_insight_jobs (
+    id uuid DEFAULT gen_random_uuid() NOT NULL,
+    user_id uuid NOT NULL,
+    status text DEFAULT 'pending'::text NOT NULL,
+    error_message text,
+    created_at timestamp with time zone DEFAULT now() NOT NULL,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT user_insight_jobs_pkey PRIMARY KEY (id),
+    CONSTRAINT user_insight_jobs_user_id_fkey FOREIGN KEY (user_id)
+        REFERENCES public.users(id) ON DELETE CASCADE
+);
+
+-- At most one queued/running summary per user; repeated requests reuse it
+CREATE UNIQUE INDEX IF NOT EXISTS uq_user_insight_jobs_active_user
+    ON public.user_insight_jobs USING btree (user_id)
+    WHERE status IN ('pending', 'processing');
+
+CREATE INDEX IF NOT EXISTS idx_user_insight_jobs_pending_created_at
+    ON public.user_insight_jobs USING btree (created_at)
+    WHERE status = 'pending';
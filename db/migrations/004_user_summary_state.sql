@@ -0,0 +1,24 @@
+--
+-- Incremental patient summaries
+--
+-- user_summary_state holds a compact rolling record per user plus the set of
+-- documents it already covers (the watermark). New reports are folded into
+-- the record instead of re-summarizing the whole history on every request.
+-- prompt_hash / model_name invalidate the record when either changes.
+--
+
+CREATE TABLE IF NOT EXISTS public.user_summary_state (
+    user_id uuid NOT NULL,
+    summary_markdown text NOT NULL,
+    covered_document_ids uuid[] DEFAULT '{}'::uuid[] NOT NULL,
+    prompt_hash text NOT NULL,
+    model_name text NOT NULL,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT user_summary_state_pkey PRIMARY KEY (user_id),
+    CONSTRAINT user_summary_state_user_id_fkey FOREIGN KEY (user_id)
+        REFERENCES public.users(id) ON DELETE CASCADE
+);
+
+-- Force a full map-reduce rebuild instead of an incremental update
+ALTER TABLE public.user_insight_jobs
+    ADD COLUMN IF NOT EXISTS rebuild boolean DEFAULT false NOT NULL;
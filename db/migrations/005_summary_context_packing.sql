@@ -0,0 +1,16 @@
+--
+-- Token-budgeted patient summaries
+--
+-- documents.digest_markdown caches a short per-report digest used when a
+-- report doesn't fit the summary prompt's token budget verbatim;
+-- digest_prompt_hash invalidates it when the digest prompt changes.
+-- user_insight_jobs.input_tokens records the estimated prompt tokens a
+-- summary job sent to the model.
+--
+
+ALTER TABLE public.documents
+    ADD COLUMN IF NOT EXISTS digest_markdown text,
+    ADD COLUMN IF NOT EXISTS digest_prompt_hash text;
+
+ALTER TABLE public.user_insight_jobs
+    ADD COLUMN IF NOT EXISTS input_tokens integer;
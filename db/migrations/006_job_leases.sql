@@ -0,0 +1,29 @@
+--
+-- Job leases
+--
+-- A worker that claims a job (insights or user_insight_jobs) records itself
+-- in locked_by and holds the job until lease_expires_at, renewing the lease
+-- with a heartbeat while it runs. If the worker dies the lease runs out and
+-- another worker reclaims the job; after max attempts it is marked failed
+-- instead. Completing or failing a job is only accepted from the current
+-- lease holder.
+--
+
+ALTER TABLE public.insights
+    ADD COLUMN IF NOT EXISTS locked_by text,
+    ADD COLUMN IF NOT EXISTS lease_expires_at timestamp with time zone,
+    ADD COLUMN IF NOT EXISTS attempts integer DEFAULT 0 NOT NULL;
+
+ALTER TABLE public.user_insight_jobs
+    ADD COLUMN IF NOT EXISTS locked_by text,
+    ADD COLUMN IF NOT EXISTS lease_expires_at timestamp with time zone,
+    ADD COLUMN IF NOT EXISTS attempts integer DEFAULT 0 NOT NULL;
+
+-- Finds expired leases without scanning completed jobs
+CREATE INDEX IF NOT EXISTS idx_insights_processing_lease
+    ON public.insights USING btree (lease_expires_at)
+    WHERE status = 'processing';
+
+CREATE INDEX IF NOT EXISTS idx_user_insight_jobs_processing_lease
+    ON public.user_insight_jobs USING btree (lease_expires_at)
+    WHERE status = 'processing';
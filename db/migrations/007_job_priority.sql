@@ -0,0 +1,31 @@
+--
+-- Job priorities
+--
+-- Every job carries a priority class (lower runs first):
+--     0 interactive  a user is waiting on this document's insights
+--     1 normal       patient summaries
+--     2 bulk         re-runs and backfills
+-- Workers claim by priority, then prefer users with fewer jobs already
+-- running, then the oldest job. Bulk jobs may only take part of a
+-- worker's slots (BULK_MAX_SHARE).
+--
+
+ALTER TABLE public.insights
+    ADD COLUMN IF NOT EXISTS priority smallint DEFAULT 0 NOT NULL;
+
+ALTER TABLE public.user_insight_jobs
+    ADD COLUMN IF NOT EXISTS priority smallint DEFAULT 1 NOT NULL;
+
+-- Claim order of pending jobs
+CREATE INDEX IF NOT EXISTS idx_insights_pending_priority
+    ON public.insights USING btree (priority, created_at)
+    WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS idx_user_insight_jobs_pending_priority
+    ON public.user_insight_jobs USING btree (priority, created_at)
+    WHERE status = 'pending';
+
+-- Running jobs per user, for fair ordering between users
+CREATE INDEX IF NOT EXISTS idx_insights_processing_user
+    ON public.insights USING btree (user_id)
+    WHERE status = 'processing';
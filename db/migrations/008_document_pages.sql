@@ -0,0 +1,21 @@
+--
+-- Per-page extraction results
+--
+-- extract_markdown_from_file() writes each page's Markdown here as soon as
+-- the page is done (see scripts/src/document_pages.py), so a job that
+-- fails on page 9 of 10 only re-extracts the missing pages on retry.
+-- extraction_key covers file content, page, render settings, model and
+-- prompt; a stored page whose key no longer matches is extracted again.
+--
+
+CREATE TABLE IF NOT EXISTS public.document_pages (
+    document_id uuid NOT NULL,
+    page_number integer NOT NULL,
+    markdown text NOT NULL,
+    source text NOT NULL,
+    extraction_key text NOT NULL,
+    created_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT document_pages_pkey PRIMARY KEY (document_id, page_number),
+    CONSTRAINT document_pages_document_id_fkey FOREIGN KEY (document_id)
+        REFERENCES public.documents(id) ON DELETE CASCADE
+);
@@ -0,0 +1,37 @@
+--
+-- Structured lab results
+--
+-- One row per test result, extracted from documents.extracted_markdown with
+-- a JSON-schema constrained model call (scripts/src/lab_results.py).
+-- test_key groups the same analyte across reports; value_num, ref_low and
+-- ref_high are parsed from the printed value and reference range where
+-- they are numeric. A document's rows are replaced when it is re-extracted.
+--
+
+CREATE TABLE IF NOT EXISTS public.lab_results (
+    id uuid DEFAULT gen_random_uuid() NOT NULL,
+    document_id uuid NOT NULL,
+    user_id uuid NOT NULL,
+    test_name text NOT NULL,
+    test_key text NOT NULL,
+    value_text text NOT NULL,
+    value_num double precision,
+    unit text,
+    reference_range text,
+    ref_low double precision,
+    ref_high double precision,
+    observed_on date,
+    created_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT lab_results_pkey PRIMARY KEY (id),
+    CONSTRAINT lab_results_document_id_fkey FOREIGN KEY (document_id)
+        REFERENCES public.documents(id) ON DELETE CASCADE,
+    CONSTRAINT lab_results_user_id_fkey FOREIGN KEY (user_id)
+        REFERENCES public.users(id) ON DELETE CASCADE
+);
+
+-- Trend queries: one analyte of one user over time
+CREATE INDEX IF NOT EXISTS idx_lab_results_user_test_date
+    ON public.lab_results USING btree (user_id, test_key, observed_on);
+
+CREATE INDEX IF NOT EXISTS idx_lab_results_document
+    ON public.lab_results USING btree (document_id);
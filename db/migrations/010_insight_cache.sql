@@ -0,0 +1,21 @@
+--
+-- Insight result cache
+--
+-- generate_insights_html() stores the text model's output here under a
+-- hash of (input Markdown, prompt text, model, options), so duplicate
+-- uploads, regenerate clicks and unchanged patient summaries skip the
+-- model (see scripts/src/insight_cache.py). last_used_at is bumped on
+-- every hit; entries unused for INSIGHT_CACHE_MAX_AGE_DAYS are pruned.
+--
+
+CREATE TABLE IF NOT EXISTS public.insight_cache (
+    cache_key text NOT NULL,
+    output text NOT NULL,
+    model_name text NOT NULL,
+    created_at timestamp with time zone DEFAULT now() NOT NULL,
+    last_used_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT insight_cache_pkey PRIMARY KEY (cache_key)
+);
+
+CREATE INDEX IF NOT EXISTS insight_cache_last_used_idx
+    ON public.insight_cache (last_used_at);
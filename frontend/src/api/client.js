@@ -171,6 +171,42 @@ export async function triggerInsightGeneration(documentId) {
   return true;
 }
 
+// 3) Follow generation live (Server-Sent Events).
+// handlers: { onStatus(status), onProgress(message), onToken(text, stage),
+//             onCompleted(html), onFailed(error) }
+// Returns a function that closes the stream.
+export function subscribeToInsightStream(documentId, handlers = {}) {
+  const source = new EventSource(
+    `${INSIGHTS_API_BASE_URL}/internal/insights/${documentId}/stream`
+  );
+  const parse = (e) => {
+    try {
+      return JSON.parse(e.data);
+    } catch {
+      return {};
+    }
+  };
+
+  source.addEventListener("status", (e) => handlers.onStatus?.(parse(e).status));
+  source.addEventListener("progress", (e) =>
+    handlers.onProgress?.(parse(e).message)
+  );
+  source.addEventListener("token", (e) => {
+    const data = parse(e);
+    handlers.onToken?.(data.text, data.stage);
+  });
+  source.addEventListener("completed", (e) => {
+    source.close();
+    handlers.onCompleted?.(parse(e).html);
+  });
+  source.addEventListener("failed", (e) => {
+    source.close();
+    handlers.onFailed?.(parse(e).error);
+  });
+
+  return () => source.close();
+}
+
 export function fetchUserInsights() {
   return apiRequest("/user/insights", {
     method: "GET",
@@ -3,6 +3,7 @@ import React, { useEffect, useState, useRef } from "react";
 import { useParams, Link } from "react-router-dom";
 import {
   getInsight,
+  subscribeToInsightStream,
   triggerInsightGeneration,
 } from "../api/client.js";
 
@@ -12,6 +13,9 @@ function InsightPage() {
   const [insight, setInsight] = useState("");
   const [status, setStatus] = useState("checking");
   const [error, setError] = useState("");
+  const [progress, setProgress] = useState("");
+  // Insight HTML streamed so far, shown until the final document arrives
+  const [partial, setPartial] = useState("");
 
   // Ref to track if we've already triggered generation for this ID
   const generationTriggeredRef = useRef(null);
@@ -72,6 +76,37 @@ function InsightPage() {
     loadInsight();
   }, [id]);
 
+  // While generating, follow the job live instead of asking for a refresh
+  useEffect(() => {
+    if (!id || status !== "generating") return undefined;
+
+    setProgress("");
+    setPartial("");
+    const close = subscribeToInsightStream(id, {
+      onStatus: (jobStatus) => {
+        setProgress(`Status: ${jobStatus}`);
+        // A retried job streams its insights from the start again
+        if (jobStatus === "insights_generating") setPartial("");
+      },
+      onProgress: (message) => message && setProgress(message.trim()),
+      onToken: (text, stage) => {
+        if (stage === "insights_generating" && text) {
+          setPartial((prev) => prev + text);
+        }
+      },
+      onCompleted: (html) => {
+        setInsight(html || "");
+        setPartial("");
+        setStatus("ready");
+      },
+      onFailed: (message) => {
+        setError(message || "Insight generation failed.");
+        setStatus("failed");
+      },
+    });
+    return close;
+  }, [id, status]);
+
   const isGenerating = status === "generating";
 
   return (
@@ -105,8 +140,23 @@ function InsightPage() {
 
       {!loading && !error && !insight && isGenerating && (
         <div className="mb-4 text-sm bg-yellow-50 border border-yellow-100 rounded-md px-3 py-2 text-yellow-800">
-          Insights are being generated for this document. Please check again in
-          some time.
+          Insights are being generated for this document. This page updates
+          when they are ready.
+          {progress && (
+            <div className="mt-1 text-xs text-yellow-700">{progress}</div>
+          )}
+        </div>
+      )}
+
+      {!loading && !error && !insight && isGenerating && partial && (
+        <div className="mb-4">
+          <h2 className="text-sm font-semibold text-slate-700 mb-2">
+            Insight (generating…)
+          </h2>
+          <div
+            className="text-sm whitespace-pre-wrap bg-slate-50 border border-slate-200 rounded-md px-3 py-2"
+            dangerouslySetInnerHTML={{ __html: partial }}
+          />
         </div>
       )}
 
@@ -0,0 +1 @@
+python src/insights_worker.py --workers 2
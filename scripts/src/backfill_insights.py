@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+
+"""
+Backfill: regenerate extraction and/or insights for many existing documents.
+
+Use it after a prompt or model change. Documents are selected by status,
+upload date or user, processed by a pool of threads (each runs the same
+VLM extraction / SLM insight code as the worker) and written back in
+batches: one UPDATE for documents and one upsert for insights per batch.
+
+Progress is checkpointed to a JSON file after every committed batch, so
+an interrupted run (Ctrl+C, crash) continues where it stopped when started
+again with the same --checkpoint. Documents whose insights job is pending
+or processing in the queue are left to the workers.
+
+Usage:
+    # Regenerate insights for everything completed before today
+    python src/backfill_insights.py --insight-status completed --until 2026-10-17
+
+    # Re-run VLM extraction too, for one user's failed documents
+    python src/backfill_insights.py --status failed --user-id <uuid> --re-extract
+
+    # See what would be processed
+    python src/backfill_insights.py --insight-status completed --dry-run
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+# Add parent directory to path to allow importing config
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from config import (
+    BACKFILL_CHECKPOINT_DIR,
+    DB_POOL_MAX,
+    INSIGHTS_WORKER_COUNT,
+    LAB_FACTS_ENABLED,
+    LAB_RESULTS_ENABLED,
+)
+from cpu_pool import shutdown_cpu_pool
+from db import close_db_pool, db_connection, init_db_pool
+from document_pages import DocumentPageStore
+from llm_client import set_default_priority
+from prompts import get_registry
+from streaming import LogSink, set_default_sink
+
+logger = logging.getLogger("backfill_insights")
+
+# Flush results at least this often, even if the batch isn't full
+FLUSH_INTERVAL_SECONDS = 30
+
+
+# -------------------------------------------------------------------
+# Selection
+# -------------------------------------------------------------------
+def select_documents(args) -> list[str]:
+    """Ids of the documents matching the filters, oldest upload first."""
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT d.id::text
+            FROM documents d
+            LEFT JOIN insights i ON i.document_id = d.id
+            WHERE (%(statuses)s::text[] IS NULL OR d.processing_status::text = ANY(%(statuses)s))
+              AND (%(insight_statuses)s::text[] IS NULL
+                   OR COALESCE(i.status, 'none') = ANY(%(insight_statuses)s))
+              AND (%(since)s::timestamptz IS NULL OR d.uploaded_at >= %(since)s)
+              AND (%(until)s::timestamptz IS NULL OR d.uploaded_at < %(until)s)
+              AND (%(user_id)s::uuid IS NULL OR d.user_id = %(user_id)s::uuid)
+              AND COALESCE(i.status, '') NOT IN ('pending', 'processing')
+            ORDER BY d.uploaded_at, d.id
+            LIMIT %(limit)s
+            """,
+            {
+                "statuses": args.status,
+                "insight_statuses": args.insight_status,
+                "since": args.since,
+                "until": args.until,
+                "user_id": args.user_id,
+                "limit": args.limit,
+            },
+        )
+        return [row[0] for row in cur.fetchall()]
+
+
+# -------------------------------------------------------------------
+# Checkpoint
+# -------------------------------------------------------------------
+class Checkpoint:
+    """
+    JSON file with the ids already written back ("done") and the ones that
+    failed ("failed": {id: error}). Saved atomically (temp file + replace).
+    """
+
+    def __init__(self, path: str, filters: dict):
+        self.path = path
+        self.filters = filters
+        self.done = set()
+        self.failed = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.done = set(data.get("done", []))
+            self.failed = dict(data.get("failed", {}))
+            if data.get("filters") != filters:
+                print(
+                    f"[WARN] Checkpoint {path} was written with different filters: "
+                    f"{data.get('filters')}"
+                )
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        data = {
+            "filters": self.filters,
+            "updated_at": datetime.now().isoformat(timespec="seconds"),
+            "done": sorted(self.done),
+            "failed": self.failed,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+# -------------------------------------------------------------------
+# Processing
+# -------------------------------------------------------------------
+def process_document(document_id: str, re_extract: bool, extract_only: bool) -> dict:
+    """
+    Extract (if needed or forced) and generate insights for one document.
+    Returns {"document_id", "markdown", "html"}; markdown is only set when
+    it was (re-)extracted, html is None with extract_only.
+    """
+    from extract_report_slm import extract_markdown_from_file
+    from generate_insights_txt import generate_insights_html
+    from insights_worker import load_lab_facts, refresh_lab_results, resolve_storage_path
+
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT storage_path, extracted_markdown FROM documents WHERE id = %s",
+            (document_id,),
+        )
+        row = cur.fetchone()
+    if not row:
+        raise LookupError(f"Document not found: {document_id}")
+
+    storage_path, markdown = row
+    new_markdown = None
+    if re_extract or not markdown:
+        # Pages stored by an interrupted run are reused (document_pages.py)
+        markdown = extract_markdown_from_file(
+            resolve_storage_path(storage_path), page_store=DocumentPageStore(document_id)
+        )
+        new_markdown = markdown
+
+    if LAB_RESULTS_ENABLED:
+        refresh_lab_results(document_id, markdown, new_markdown is not None)
+
+    html = None
+    if not extract_only:
+        facts = load_lab_facts(document_id) if LAB_FACTS_ENABLED else ""
+        html = generate_insights_html(markdown, facts=facts)
+    return {"document_id": document_id, "markdown": new_markdown, "html": html}
+
+
+def write_batch(results: list[dict]) -> None:
+    """Write a batch of results back in one transaction."""
+    doc_rows = [
+        (r["document_id"], r["markdown"], r["html"] is not None)
+        for r in results
+    ]
+    insight_rows = [(r["document_id"], r["html"]) for r in results if r["html"] is not None]
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            execute_values(
+                cur,
+                """
+                UPDATE documents AS d
+                SET extracted_markdown = COALESCE(v.markdown, d.extracted_markdown),
+                    processing_status = CASE WHEN v.done THEN 'done' ELSE d.processing_status END,
+                    last_error = CASE WHEN v.done THEN NULL ELSE d.last_error END,
+                    updated_at = NOW()
+                FROM (VALUES %s) AS v(id, markdown, done)
+                WHERE d.id = v.id::uuid
+                """,
+                doc_rows,
+                template="(%s, %s::text, %s::boolean)",
+            )
+            if insight_rows:
+                # Upsert, but never overwrite a job a worker has picked up meanwhile
+                execute_values(
+                    cur,
+                    """
+                    INSERT INTO insights
+                        (document_id, user_id, html_insights, status, generated_at, created_at, updated_at)
+                    SELECT d.id, d.user_id, v.html, 'completed', NOW(), NOW(), NOW()
+                    FROM (VALUES %s) AS v(id, html)
+                    JOIN documents d ON d.id = v.id::uuid
+                    ON CONFLICT (document_id) DO UPDATE
+                    SET html_insights = EXCLUDED.html_insights, status = 'completed',
+                        error_message = NULL, generated_at = NOW(), updated_at = NOW()
+                    WHERE insights.status NOT IN ('pending', 'processing')
+                    """,
+                    insight_rows,
+                )
+        conn.commit()
+
+
+def run_backfill(todo: list[str], args, checkpoint: Checkpoint) -> None:
+    stop_event = threading.Event()
+
+    def _shutdown(signum, frame):
+        print("\n[INFO] Stopping: finishing in-flight documents and saving the checkpoint...")
+        stop_event.set()
+        # A second Ctrl+C aborts immediately
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    signal.signal(signal.SIGINT, _shutdown)
+    signal.signal(signal.SIGTERM, _shutdown)
+
+    buffer = []
+    processed = failed = 0
+    started = last_flush = time.monotonic()
+
+    def flush():
+        nonlocal last_flush
+        if buffer:
+            write_batch(buffer)
+            checkpoint.done.update(r["document_id"] for r in buffer)
+            for r in buffer:
+                checkpoint.failed.pop(r["document_id"], None)
+            buffer.clear()
+        checkpoint.save()
+        last_flush = time.monotonic()
+        elapsed = last_flush - started
+        rate = processed / elapsed if elapsed else 0.0
+        print(
+            f"[{processed + failed}/{len(todo)}] {processed} written, {failed} failed "
+            f"({rate:.2f} docs/s)"
+        )
+
+    remaining = iter(todo)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="backfill") as pool:
+        while True:
+            # Keep the pool busy, but don't queue more than we can finish on stop
+            while not stop_event.is_set() and len(in_flight) < args.workers * 2:
+                document_id = next(remaining, None)
+                if document_id is None:
+                    break
+                future = pool.submit(
+                    process_document, document_id, args.re_extract, args.extract_only
+                )
+                in_flight[future] = document_id
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, timeout=1.0, return_when=FIRST_COMPLETED)
+            for future in done:
+                document_id = in_flight.pop(future)
+                try:
+                    buffer.append(future.result())
+                    processed += 1
+                except Exception as e:
+                    failed += 1
+                    checkpoint.failed[document_id] = str(e)
+                    logger.error(f"document_id={document_id}: {e}")
+
+            if len(buffer) >= args.batch_size or (
+                time.monotonic() - last_flush >= FLUSH_INTERVAL_SECONDS
+            ):
+                flush()
+
+    flush()
+    if stop_event.is_set():
+        print(f"[INFO] Interrupted. Run the same command again to resume ({checkpoint.path}).")
+
+
+def parse_date(value: str) -> str:
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an ISO date/time: {value}")
+    return value
+
+
+def main():
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="[%(levelname)s] %(asctime)s %(name)s - %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Regenerate extraction / insights for many documents."
+    )
+    parser.add_argument(
+        "--status",
+        action="append",
+        help="documents.processing_status to include (repeatable, e.g. done, failed)",
+    )
+    parser.add_argument(
+        "--insight-status",
+        action="append",
+        choices=["completed", "failed", "none"],
+        help="insights.status to include; 'none' = no insights row yet (repeatable)",
+    )
+    parser.add_argument("--since", type=parse_date, help="uploaded_at >= this date/time")
+    parser.add_argument("--until", type=parse_date, help="uploaded_at < this date/time")
+    parser.add_argument("--user-id", help="Only this user's documents")
+    parser.add_argument("--limit", type=int, help="Process at most this many documents")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=INSIGHTS_WORKER_COUNT,
+        help="Documents processed in parallel (default: INSIGHTS_WORKER_COUNT)",
+    )
+    parser.add_argument("--batch-size", type=int, default=20, help="Results per DB write")
+    parser.add_argument(
+        "--re-extract",
+        action="store_true",
+        help="Run VLM extraction again even if extracted_markdown is set",
+    )
+    parser.add_argument(
+        "--extract-only", action="store_true", help="Only (re-)extract Markdown, no insights"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=os.path.join(BACKFILL_CHECKPOINT_DIR, "backfill_checkpoint.json"),
+        help="Checkpoint file (default: BACKFILL_CHECKPOINT_DIR/backfill_checkpoint.json)",
+    )
+    parser.add_argument(
+        "--fresh", action="store_true", help="Ignore an existing checkpoint and start over"
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Also retry documents that failed in an earlier run of this checkpoint",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only show which documents would be processed"
+    )
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be >= 1")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be >= 1")
+
+    filters = {
+        "status": args.status,
+        "insight_status": args.insight_status,
+        "since": args.since,
+        "until": args.until,
+        "user_id": args.user_id,
+        "re_extract": args.re_extract,
+        "extract_only": args.extract_only,
+    }
+    if args.fresh and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    checkpoint = Checkpoint(args.checkpoint, filters)
+
+    # No per-token console output from parallel documents
+    set_default_sink(LogSink())
+    # Model calls yield to interactive jobs sharing this process's endpoints
+    set_default_priority("bulk")
+    # The whole run uses the prompts as they are now, even if they are edited
+    registry = get_registry()
+    registry.load_all()
+    registry.reload_seconds = 0
+    init_db_pool(maxconn=max(DB_POOL_MAX, args.workers + 1))
+    try:
+        selected = select_documents(args)
+        skip = set(checkpoint.done)
+        if not args.retry_failed:
+            skip.update(checkpoint.failed)
+        todo = [doc_id for doc_id in selected if doc_id not in skip]
+
+        print(
+            f"📄 {len(selected)} document(s) match, {len(selected) - len(todo)} already "
+            f"handled in {args.checkpoint}, {len(todo)} to process"
+        )
+        if args.dry_run:
+            for doc_id in todo[:20]:
+                print(f"  {doc_id}")
+            if len(todo) > 20:
+                print(f"  ... and {len(todo) - 20} more")
+            return
+        if not todo:
+            return
+
+        run_backfill(todo, args, checkpoint)
+    finally:
+        shutdown_cpu_pool()
+        close_db_pool()
+
+    print(f"\n🎯 DONE — {len(checkpoint.done)} written, {len(checkpoint.failed)} failed")
+    if checkpoint.failed:
+        print("Failed documents are listed in the checkpoint; retry with --retry-failed.")
+
+
+if __name__ == "__main__":
+    main()
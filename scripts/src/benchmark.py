@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the extraction and insight pipeline, without a GPU.
+
+Runs against fake_ollama.py (started in-process) or any Ollama-compatible
+server given with --ollama-url, on synthetic multi-page PDFs:
+
+    extract          extract_markdown_from_file() on a scanned PDF and an image
+    pdf_to_markdown  text-layer converter on a born-digital PDF
+    insights         generate_insights_html() on extracted Markdown
+    pipeline         run_insights_pipeline() end to end      (needs Postgres)
+    service          FastAPI endpoints under concurrent load (needs Postgres)
+
+For every case it reports p50 / p95 / mean latency, throughput (pages/sec
+or requests/sec) and the peak Python heap of one extra traced run
+(tracemalloc, so timed runs are not slowed down). The Postgres scenarios
+are skipped when DATABASE_URL is unreachable; they create a throwaway
+benchmark user and delete it (with its documents) afterwards.
+
+Usage:
+    python src/benchmark.py
+    python src/benchmark.py --scenario extract --pages 8 --iterations 5 --token-delay 0.01
+    python src/benchmark.py --scenario service --requests 500 --concurrency 32 --json out.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+SCENARIOS = ["extract", "pdf_to_markdown", "insights", "pipeline", "service"]
+
+# Rows of the synthetic lab report: (test, result, unit, reference range)
+LAB_ROWS = [
+    ("Hemoglobin", "13.5", "g/dL", "12.0 - 16.0"),
+    ("WBC Count", "7.2", "10^3/uL", "4.0 - 11.0"),
+    ("Platelet Count", "250", "10^3/uL", "150 - 400"),
+    ("Fasting Glucose", "112", "mg/dL", "70 - 100"),
+    ("HbA1c", "6.1", "%", "4.0 - 5.6"),
+    ("Total Cholesterol", "210", "mg/dL", "< 200"),
+    ("LDL Cholesterol", "135", "mg/dL", "< 100"),
+    ("HDL Cholesterol", "48", "mg/dL", "> 40"),
+    ("Triglycerides", "160", "mg/dL", "< 150"),
+    ("Creatinine", "0.9", "mg/dL", "0.6 - 1.2"),
+    ("TSH", "2.1", "uIU/mL", "0.4 - 4.0"),
+    ("Vitamin D", "18", "ng/mL", "30 - 100"),
+]
+
+
+# -------------------------------------------------------------------
+# Measurement helpers
+# -------------------------------------------------------------------
+def percentile(values, pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(name: str, latencies, units_per_call: int, unit: str, peak_bytes=None) -> dict:
+    total = sum(latencies)
+    return {
+        "name": name,
+        "runs": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "throughput": units_per_call * len(latencies) / total if total else 0.0,
+        "unit": unit,
+        "peak_mb": peak_bytes / 1e6 if peak_bytes is not None else None,
+    }
+
+
+def measure(name: str, fn, iterations: int, units_per_call: int = 1, unit: str = "calls/s",
+            warmup: int = 1) -> dict:
+    """
+    Time fn() `iterations` times after `warmup` untimed calls, then run it
+    once more under tracemalloc for the peak heap. fn may take the run
+    index (0..) as its only argument.
+    """
+    calls = 0
+
+    def call():
+        nonlocal calls
+        fn(calls)
+        calls += 1
+
+    for _ in range(warmup):
+        call()
+
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return summarize(name, latencies, units_per_call, unit, peak)
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident set size of this process, if the platform reports it."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1024
+
+
+# -------------------------------------------------------------------
+# Synthetic inputs
+# -------------------------------------------------------------------
+def draw_lab_page(page, page_number: int) -> None:
+    """Write a lab report page with a results table onto a PyMuPDF page."""
+    page.insert_text((72, 72), "CITY DIAGNOSTICS LABORATORY", fontsize=16)
+    page.insert_text((72, 96), f"Patient: Benchmark Patient    Page {page_number}", fontsize=10)
+    page.insert_text((72, 130), "COMPLETE HEALTH PANEL", fontsize=12)
+    y = 160
+    for test, result, unit, ref in LAB_ROWS:
+        page.insert_text((72, y), test, fontsize=10)
+        page.insert_text((260, y), result, fontsize=10)
+        page.insert_text((340, y), unit, fontsize=10)
+        page.insert_text((430, y), ref, fontsize=10)
+        y += 18
+    page.insert_text(
+        (72, y + 30),
+        "Remarks: Fasting glucose and HbA1c above range; advise follow-up.",
+        fontsize=10,
+    )
+
+
+def make_synthetic_pdf(path: str, pages: int, scanned: bool) -> str:
+    """
+    Write a multi-page lab report PDF. With scanned=True every page is
+    a raster image without a text layer, so extraction goes to the VLM.
+    """
+    import fitz  # PyMuPDF
+
+    doc = fitz.open()
+    for i in range(1, pages + 1):
+        if scanned:
+            source = fitz.open()
+            draw_lab_page(source.new_page(), i)
+            pix = source[0].get_pixmap(dpi=150, colorspace=fitz.csGRAY)
+            page = doc.new_page()
+            page.insert_image(page.rect, pixmap=pix)
+            source.close()
+        else:
+            draw_lab_page(doc.new_page(), i)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def make_synthetic_image(path: str) -> str:
+    """Write a single 'photographed' report page as PNG."""
+    import fitz  # PyMuPDF
+
+    doc = fitz.open()
+    draw_lab_page(doc.new_page(), 1)
+    doc[0].get_pixmap(dpi=200).save(path)
+    doc.close()
+    return path
+
+
+def synthetic_markdown(pages: int) -> str:
+    header = "| Test | Result | Unit | Reference Range |\n|---|---|---|---|\n"
+    rows = "".join(f"| {t} | {r} | {u} | {ref} |\n" for t, r, u, ref in LAB_ROWS)
+    return "\n\n".join(f"## Page {i}\n\n{header}{rows}" for i in range(1, pages + 1))
+
+
+# -------------------------------------------------------------------
+# Scenarios
+# -------------------------------------------------------------------
+def bench_extract(args, workdir: str) -> list[dict]:
+    from extract_report_slm import extract_markdown_from_file
+
+    pdf = make_synthetic_pdf(os.path.join(workdir, "scanned.pdf"), args.pages, scanned=True)
+    image = make_synthetic_image(os.path.join(workdir, "photo.png"))
+    return [
+        measure(
+            f"extract_markdown_from_file (scanned PDF, {args.pages} pages)",
+            lambda _i: extract_markdown_from_file(pdf),
+            args.iterations,
+            args.pages,
+            "pages/s",
+        ),
+        measure(
+            "extract_markdown_from_file (PNG image)",
+            lambda _i: extract_markdown_from_file(image),
+            args.iterations,
+            1,
+            "pages/s",
+        ),
+    ]
+
+
+def bench_pdf_to_markdown(args, workdir: str) -> list[dict]:
+    from txt.extract_report_txt import pdf_to_markdown
+
+    pdf = make_synthetic_pdf(os.path.join(workdir, "digital.pdf"), args.pages, scanned=False)
+    return [
+        measure(
+            f"pdf_to_markdown (born-digital PDF, {args.pages} pages)",
+            lambda _i: pdf_to_markdown(pdf),
+            args.iterations,
+            args.pages,
+            "pages/s",
+        )
+    ]
+
+
+def bench_insights(args, workdir: str) -> list[dict]:
+    from generate_insights_txt import generate_insights_html
+
+    markdown = synthetic_markdown(args.pages)
+    return [
+        measure(
+            f"generate_insights_html ({len(markdown)} chars of Markdown, "
+            f"cache {'on' if args.cache else 'off'})",
+            lambda _i: generate_insights_html(markdown),
+            args.iterations,
+        )
+    ]
+
+
+def create_benchmark_documents(path: str, count: int) -> tuple[str, list[str]]:
+    """Insert a throwaway user with `count` documents pointing at `path`."""
+    from db import db_connection
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO users (phone_number, full_name) VALUES (%s, %s) RETURNING id",
+                (f"bench-{uuid.uuid4().hex[:12]}", "Benchmark User"),
+            )
+            user_id = str(cur.fetchone()[0])
+            doc_ids = []
+            for i in range(count):
+                cur.execute(
+                    """
+                    INSERT INTO documents (user_id, original_name, content_type, storage_path)
+                    VALUES (%s, %s, 'application/pdf', %s)
+                    RETURNING id
+                    """,
+                    (user_id, f"benchmark-{i}.pdf", os.path.abspath(path)),
+                )
+                doc_ids.append(str(cur.fetchone()[0]))
+        conn.commit()
+    return user_id, doc_ids
+
+
+def delete_benchmark_user(user_id: str) -> None:
+    """Remove the benchmark user; documents and insights cascade."""
+    from db import db_connection
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        conn.commit()
+
+
+def bench_pipeline(args, workdir: str) -> list[dict]:
+    from db import db_connection
+    from insights_worker import run_insights_pipeline
+    from job_queue import enqueue_insights_job
+
+    pdf = make_synthetic_pdf(os.path.join(workdir, "pipeline.pdf"), args.pages, scanned=True)
+    # One fresh document per run (warmup + timed + traced) so every run extracts
+    user_id, doc_ids = create_benchmark_documents(pdf, args.iterations + 2)
+    try:
+        def run(i: int) -> None:
+            with db_connection() as conn:
+                enqueue_insights_job(conn, doc_ids[i])
+            run_insights_pipeline(doc_ids[i])
+
+        return [
+            measure(
+                f"run_insights_pipeline (scanned PDF, {args.pages} pages)",
+                run,
+                args.iterations,
+                args.pages,
+                "pages/s",
+            )
+        ]
+    finally:
+        delete_benchmark_user(user_id)
+
+
+def bench_service(args, workdir: str) -> list[dict]:
+    import httpx
+    import uvicorn
+
+    from insights_service import app
+
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=args.service_port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, name="benchmark-uvicorn", daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("insights_service failed to start")
+        time.sleep(0.05)
+
+    base_url = f"http://127.0.0.1:{args.service_port}"
+    pdf = make_synthetic_pdf(os.path.join(workdir, "service.pdf"), 1, scanned=True)
+    user_id, doc_ids = create_benchmark_documents(pdf, min(args.requests, 50))
+    limits = httpx.Limits(max_connections=args.concurrency)
+    try:
+        with httpx.Client(base_url=base_url, limits=limits, timeout=60) as client:
+
+            def load(name: str, request) -> dict:
+                def timed(i: int) -> float:
+                    started = time.perf_counter()
+                    response = request(i)
+                    response.raise_for_status()
+                    return time.perf_counter() - started
+
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                    latencies = list(pool.map(timed, range(args.requests)))
+                wall = time.perf_counter() - started
+                result = summarize(name, latencies, 1, "req/s")
+                # Throughput under load is requests over wall-clock time
+                result["throughput"] = len(latencies) / wall
+                return result
+
+            return [
+                load(
+                    f"GET /health (concurrency {args.concurrency})",
+                    lambda _i: client.get("/health"),
+                ),
+                load(
+                    f"POST /internal/generate-insights (concurrency {args.concurrency})",
+                    lambda i: client.post(
+                        "/internal/generate-insights",
+                        json={"document_id": doc_ids[i % len(doc_ids)]},
+                    ),
+                ),
+            ]
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+        delete_benchmark_user(user_id)
+
+
+BENCHMARKS = {
+    "extract": bench_extract,
+    "pdf_to_markdown": bench_pdf_to_markdown,
+    "insights": bench_insights,
+    "pipeline": bench_pipeline,
+    "service": bench_service,
+}
+NEEDS_DB = {"pipeline", "service"}
+
+
+def database_reachable() -> str | None:
+    """Returns None if Postgres answers, else the reason it doesn't."""
+    import psycopg2
+
+    from config import DATABASE_URL
+
+    try:
+        psycopg2.connect(DATABASE_URL, connect_timeout=3).close()
+        return None
+    except Exception as e:
+        return str(e).strip().splitlines()[0]
+
+
+def print_results(results: list[dict]) -> None:
+    print(
+        f"\n{'benchmark':<62} {'runs':>5} {'p50 ms':>9} {'p95 ms':>9} "
+        f"{'mean ms':>9} {'throughput':>16} {'peak MB':>8}"
+    )
+    print("-" * 124)
+    for r in results:
+        peak = f"{r['peak_mb']:.1f}" if r["peak_mb"] is not None else "-"
+        throughput = f"{r['throughput']:.2f} {r['unit']}"
+        print(
+            f"{r['name']:<62} {r['runs']:>5} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} "
+            f"{r['mean_ms']:>9.1f} {throughput:>16} {peak:>8}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the extraction / insight pipeline.")
+    parser.add_argument(
+        "--scenario", action="append", choices=SCENARIOS,
+        help="Scenario to run (repeatable, default: all)",
+    )
+    parser.add_argument("--pages", type=int, default=4, help="Pages per synthetic PDF")
+    parser.add_argument("--iterations", type=int, default=5, help="Timed runs per benchmark")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint (service)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients (service)")
+    parser.add_argument("--service-port", type=int, default=9100)
+    parser.add_argument(
+        "--ollama-url", help="Use this Ollama server instead of starting the fake one"
+    )
+    parser.add_argument("--token-delay", type=float, default=0.002, help="Fake server: s/token")
+    parser.add_argument(
+        "--first-token-delay", type=float, default=0.05, help="Fake server: s before first token"
+    )
+    parser.add_argument("--tokens", type=int, default=200, help="Fake server: tokens/response")
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Keep the extraction and insight result caches enabled",
+    )
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    # Must be set before config / ollama are imported. With the caches on,
+    # every run after the first is a cache hit and measures no model work.
+    if not args.cache:
+        os.environ["EXTRACTION_CACHE_ENABLED"] = "0"
+        os.environ["INSIGHT_CACHE_ENABLED"] = "0"
+    print(f"Extraction / insight caches: {'enabled' if args.cache else 'disabled'}")
+
+    # config reads the endpoints once, when it is first imported, so nothing
+    # may import it before OLLAMA_ENDPOINTS is set below
+    server = None
+    url = args.ollama_url
+    if url is None:
+        from fake_ollama import FakeOllamaSettings, start_fake_ollama
+
+        server, url = start_fake_ollama(
+            settings=FakeOllamaSettings(
+                token_delay=args.token_delay,
+                first_token_delay=args.first_token_delay,
+                tokens=args.tokens,
+            )
+        )
+        print(f"Fake Ollama at {url} (token delay {args.token_delay}s, {args.tokens} tokens)")
+    # Both models on this one server, whatever the environment says
+    os.environ["OLLAMA_ENDPOINTS"] = url
+    os.environ["VLM_OLLAMA_ENDPOINTS"] = url
+    os.environ["SLM_OLLAMA_ENDPOINTS"] = url
+    assert "config" not in sys.modules, "config was imported before the endpoints were set"
+
+    import logging
+
+    from streaming import LogSink, set_default_sink
+
+    logging.basicConfig(level=logging.WARNING)
+    set_default_sink(LogSink())
+
+    scenarios = args.scenario or SCENARIOS
+    db_problem = None
+    if NEEDS_DB & set(scenarios):
+        db_problem = database_reachable()
+        if db_problem is None:
+            from db import init_db_pool
+
+            init_db_pool(maxconn=max(args.concurrency, 4))
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="med-sum-bench-") as workdir:
+        for name in scenarios:
+            if name in NEEDS_DB and db_problem is not None:
+                print(f"[skip] {name}: database not reachable ({db_problem})")
+                continue
+            print(f"[run] {name} ...")
+            results.extend(BENCHMARKS[name](args, workdir))
+
+    if db_problem is None and NEEDS_DB & set(scenarios):
+        from db import close_db_pool
+
+        close_db_pool()
+    if server is not None:
+        server.shutdown()
+
+    print_results(results)
+    rss = peak_rss_mb()
+    if rss is not None:
+        print(f"\nProcess peak RSS: {rss:.0f} MB")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "peak_rss_mb": rss, "args": vars(args)}, f, indent=2)
+        print(f"Results written to {os.path.abspath(args.json)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Token-budgeted context packing for SLM prompts.
+
+- estimate_tokens(): fast local estimate for qwen-style BPE tokenizers
+  (no tokenizer download). Words cost ~1 token per 6 letters, every digit
+  is its own token, symbols cost one token each, runs of whitespace
+  (table padding, blank lines) collapse to one.
+- pack_reports(): fit a set of reports into a token budget. The newest
+  and most relevant reports go in verbatim; the rest are replaced by
+  per-document digests (produced by the caller's `compress` function)
+  and, if even those don't fit, dropped.
+"""
+
+import re
+
+# Letter runs in any script, single digits, single symbols, whitespace runs
+_WORD_RE = re.compile(r"[^\W\d_]+")
+_DIGIT_RE = re.compile(r"\d")
+_SYMBOL_RE = re.compile(r"[^\w\s]|_")
+_SPACE_RUN_RE = re.compile(r"\s{2,}|\n")
+
+# Words / markers that make a report more relevant for a summary
+_ABNORMAL_RE = re.compile(
+    r"\b(?:high|low|abnormal|critical|elevated|raised|reduced|decreased|"
+    r"deficien\w*|positive|urgent|suspicious|follow[- ]?up)\b",
+    re.IGNORECASE,
+)
+_FLAG_CELL_RE = re.compile(r"\|\s*[HL]\*?\s*\|")
+
+# How many positions up the priority order one abnormal marker is worth
+RELEVANCE_WEIGHT = 0.5
+# Cap so a single very long abnormal report can't outrank all newer ones
+MAX_RELEVANCE_BOOST = 3.0
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens a qwen-style tokenizer produces for text."""
+    if not text:
+        return 0
+    word_tokens = sum(1 + (len(w) - 1) // 6 for w in _WORD_RE.findall(text))
+    return (
+        word_tokens
+        + len(_DIGIT_RE.findall(text))
+        + len(_SYMBOL_RE.findall(text))
+        + len(_SPACE_RUN_RE.findall(text))
+    )
+
+
+def relevance_score(markdown: str) -> int:
+    """Number of abnormal / follow-up markers in a report."""
+    return len(_ABNORMAL_RE.findall(markdown)) + len(_FLAG_CELL_RE.findall(markdown))
+
+
+def pack_reports(docs, budget_tokens: int, compress=None):
+    """
+    Choose how each report enters a prompt of at most `budget_tokens`.
+
+    docs: [(document_id, markdown, uploaded_at), ...] oldest first.
+    compress: optional callable(doc) -> digest markdown for one report.
+
+    Reports are considered newest first, with abnormal reports moved up
+    the order (bounded by MAX_RELEVANCE_BOOST). Each one goes in verbatim
+    if it fits, otherwise as its digest if that fits, otherwise it is
+    dropped.
+
+    Returns (packed, stats):
+      packed -> [(document_id, markdown_or_digest, uploaded_at), ...]
+                in the original (chronological) order
+      stats  -> {"tokens", "full", "compressed", "dropped"}
+    """
+    n = len(docs)
+    priority = sorted(
+        range(n),
+        key=lambda i: (n - 1 - i)
+        - min(RELEVANCE_WEIGHT * relevance_score(docs[i][1]), MAX_RELEVANCE_BOOST),
+    )
+
+    remaining = budget_tokens
+    chosen = {}
+    stats = {"tokens": 0, "full": 0, "compressed": 0, "dropped": 0}
+
+    for i in priority:
+        doc_id, markdown, uploaded_at = docs[i]
+        cost = estimate_tokens(markdown)
+        if cost <= remaining:
+            chosen[i] = markdown
+            stats["full"] += 1
+        else:
+            digest = compress(docs[i]) if compress is not None else None
+            cost = estimate_tokens(digest) if digest else 0
+            if digest and cost <= remaining:
+                chosen[i] = digest
+                stats["compressed"] += 1
+            else:
+                stats["dropped"] += 1
+                continue
+        remaining -= cost
+        stats["tokens"] += cost
+
+    packed = [(docs[i][0], chosen[i], docs[i][2]) for i in sorted(chosen)]
+    return packed, stats
@@ -0,0 +1,146 @@
+"""
+Process pool for CPU-bound stages.
+
+Rasterizing PDF pages, encoding page images and sanitizing model HTML with
+BeautifulSoup are pure CPU work. On a thread they hold the GIL, so in the
+worker they stall every other job's streaming, lease heartbeats and DB
+work. They run in a ProcessPoolExecutor of CPU_POOL_SIZE processes
+instead:
+
+    run_cpu(fn, *args)      # blocks the calling thread, not the process
+    submit_cpu(fn, *args)   # -> concurrent.futures.Future
+
+fn must be a module-level function (it is pickled by name). With
+CPU_POOL_SIZE=0 everything runs inline on the calling thread.
+
+Page images are large, so they don't travel through the pool's pipe as
+pickled bytes: a task writes them into a shared memory block and returns
+a SharedBytes handle; the parent takes the bytes out with take_shared(),
+which also frees the block.
+
+Processes are started with "spawn" (no fork of a threaded parent). If one
+dies (e.g. a crash inside MuPDF) the pool is replaced and the running
+task fails, which fails only that job.
+"""
+
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+from config import CPU_POOL_SIZE
+
+logger = logging.getLogger("cpu_pool")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class SharedBytes:
+    """Picklable handle to bytes left in a shared memory block by a task."""
+
+    __slots__ = ("name", "size")
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+
+def put_shared(data: bytes) -> SharedBytes:
+    """Copy data into a new shared memory block (called in the pool process)."""
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    try:
+        shm.buf[: len(data)] = data
+    finally:
+        shm.close()
+    return SharedBytes(shm.name, len(data))
+
+
+def take_shared(ref) -> bytes:
+    """The bytes behind a SharedBytes handle; frees the block. Bytes pass through."""
+    if not isinstance(ref, SharedBytes):
+        return ref
+    shm = shared_memory.SharedMemory(name=ref.name)
+    try:
+        return bytes(shm.buf[: ref.size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def discard_shared_result(future: Future) -> None:
+    """Free the shared memory of a task result nobody is going to take."""
+
+    def _discard(f):
+        if f.cancelled() or f.exception() is not None:
+            return
+        result = f.result()
+        for ref in result if isinstance(result, tuple) else (result,):
+            if isinstance(ref, SharedBytes):
+                try:
+                    take_shared(ref)
+                except FileNotFoundError:
+                    pass
+
+    future.add_done_callback(_discard)
+
+
+def get_cpu_pool() -> ProcessPoolExecutor | None:
+    """Process-wide pool, created on first use; None if CPU_POOL_SIZE is 0."""
+    global _pool
+    if CPU_POOL_SIZE <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=CPU_POOL_SIZE, mp_context=multiprocessing.get_context("spawn")
+            )
+            logger.info(f"Started CPU pool with {CPU_POOL_SIZE} process(es)")
+        return _pool
+
+
+def _replace_broken_pool(broken: ProcessPoolExecutor) -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            logger.error("A CPU pool process died; starting a new pool")
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def submit_cpu(fn, *args) -> Future:
+    """Run fn(*args) in the pool (inline if there is none)."""
+    pool = get_cpu_pool()
+    if pool is None:
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    try:
+        future = pool.submit(fn, *args)
+    except BrokenProcessPool:
+        _replace_broken_pool(pool)
+        future = get_cpu_pool().submit(fn, *args)
+
+    def _check(f):
+        if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool):
+            _replace_broken_pool(pool)
+
+    future.add_done_callback(_check)
+    return future
+
+
+def run_cpu(fn, *args):
+    return submit_cpu(fn, *args).result()
+
+
+def shutdown_cpu_pool() -> None:
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
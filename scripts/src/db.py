@@ -0,0 +1,96 @@
+"""
+Shared Postgres access for the insights service and its workers.
+
+All service/worker DB access goes through one process-wide
+ThreadedConnectionPool:
+
+    init_db_pool()              # at app / worker startup
+    with db_connection() as conn:
+        ...                     # borrowed connection, returned on exit
+    close_db_pool()             # at shutdown
+
+Connections are only borrowed for the duration of a DB step; never hold
+one across a VLM/SLM call.
+"""
+
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions, pool
+
+from config import DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT_SECONDS
+
+_pool = None
+# ThreadedConnectionPool raises instead of waiting when exhausted,
+# so borrowers queue on this semaphore first.
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+
+def get_db_connection():
+    """
+    Opens a dedicated (non-pooled) connection, e.g. for LISTEN.
+    The caller must close it.
+    """
+    return psycopg2.connect(DATABASE_URL)
+
+
+def init_db_pool(
+    minconn: int = DB_POOL_MIN, maxconn: int = DB_POOL_MAX, dsn: str = DATABASE_URL
+) -> None:
+    """Create the process-wide pool. No-op if it already exists."""
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            return
+        _pool = pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        _pool_slots = threading.BoundedSemaphore(maxconn)
+
+
+def close_db_pool() -> None:
+    """Close every pooled connection."""
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+        _pool = None
+        _pool_slots = None
+
+
+@contextmanager
+def db_connection(timeout: float = DB_POOL_TIMEOUT_SECONDS):
+    """
+    Borrow a connection from the pool (creating the pool on first use).
+
+    Any open transaction is rolled back when the block exits, so commit
+    explicitly. Connections that broke during use are discarded.
+    """
+    if _pool is None:
+        init_db_pool()
+    db_pool, slots = _pool, _pool_slots
+
+    if not slots.acquire(timeout=timeout):
+        raise pool.PoolError(f"Timed out after {timeout}s waiting for a DB connection")
+    try:
+        conn = db_pool.getconn()
+    except Exception:
+        slots.release()
+        raise
+
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        try:
+            if conn.closed:
+                broken = True
+            elif conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        db_pool.putconn(conn, close=broken)
+        slots.release()
@@ -0,0 +1,101 @@
+"""
+Per-page extraction results (document_pages table).
+
+The worker and the backfill hand a DocumentPageStore to
+extract_markdown_from_file(). Every page's Markdown is written as soon as
+that page is done, so when a job fails on page 9 of 10 the retry only
+extracts pages 9 and 10 again; the document's Markdown is assembled from
+the stored pages plus the newly extracted ones.
+
+Each stored page carries the extraction key it was produced under (file
+hash, page, render settings, model and prompt, see
+extract_report_slm.page_cache_key). A page whose key no longer matches
+is extracted again and overwritten.
+
+Writes are best-effort: if one fails, extraction carries on and the page
+is simply extracted again next time.
+"""
+
+import logging
+
+from db import db_connection
+
+logger = logging.getLogger("document_pages")
+
+
+def load_document_pages(conn, document_id: str, page_count: int) -> dict:
+    """
+    Return {page_number: (extraction_key, markdown)} for a document and
+    drop stored pages beyond page_count (the file has fewer pages now).
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "DELETE FROM document_pages WHERE document_id = %s AND page_number > %s",
+            (document_id, page_count),
+        )
+        cur.execute(
+            """
+            SELECT page_number, extraction_key, markdown
+            FROM document_pages
+            WHERE document_id = %s
+            """,
+            (document_id,),
+        )
+        rows = cur.fetchall()
+    conn.commit()
+    return {page: (key, markdown) for page, key, markdown in rows}
+
+
+def save_document_page(
+    conn, document_id: str, page_number: int, key: str, markdown: str, source: str
+) -> None:
+    """Insert or replace one page's extraction result."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO document_pages
+                (document_id, page_number, markdown, source, extraction_key, created_at)
+            VALUES (%s, %s, %s, %s, %s, NOW())
+            ON CONFLICT (document_id, page_number) DO UPDATE
+            SET markdown = EXCLUDED.markdown, source = EXCLUDED.source,
+                extraction_key = EXCLUDED.extraction_key, created_at = NOW()
+            """,
+            (document_id, page_number, markdown, source, key),
+        )
+    conn.commit()
+
+
+class DocumentPageStore:
+    """
+    document_pages access for one document during extraction. Borrows a
+    pooled connection per call, never across a VLM call; safe to use from
+    the page threads of process_pdf_file.
+    """
+
+    def __init__(self, document_id: str):
+        self.document_id = document_id
+        self._pages = {}
+
+    def load(self, page_count: int) -> int:
+        """Read the stored pages; returns how many there are."""
+        with db_connection() as conn:
+            self._pages = load_document_pages(conn, self.document_id, page_count)
+        return len(self._pages)
+
+    def get(self, page_number: int, key: str | None) -> str | None:
+        """Stored Markdown of a page, if it was extracted under `key`."""
+        stored = self._pages.get(page_number)
+        if stored is None or key is None or stored[0] != key:
+            return None
+        return stored[1]
+
+    def save(self, page_number: int, key: str, markdown: str, source: str) -> None:
+        try:
+            with db_connection() as conn:
+                save_document_page(
+                    conn, self.document_id, page_number, key, markdown, source
+                )
+        except Exception as e:
+            logger.warning(
+                f"Could not store page {page_number} of document {self.document_id}: {e}"
+            )
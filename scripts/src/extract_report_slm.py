@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 
+import contextvars
 import os
 import sys
-import ollama
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # Optional: only needed for PDF → image conversion
 import fitz  # PyMuPDF
@@ -16,131 +18,425 @@ from config import (
     OUTPUT_MD_SLM,
     INPUT_PDF,
     OPTHAL_POINT_FILE,
-    VISION_PROMPT_FILE
+    VISION_PROMPT_FILE,
+    VLM_PAGE_CONCURRENCY,
+    TEXT_LAYER_FAST_PATH,
 )  # INPUT_PDF is generic input file
+import llm_client
+from cpu_pool import discard_shared_result, get_cpu_pool, run_cpu, submit_cpu, take_shared
+from metrics import observe_stage, record_llm_call, span
+from prompts import load_prompt_text
+from streaming import collect_chat_stream, get_default_sink
+from extraction_cache import (
+    file_sha256,
+    get_extraction_cache,
+    make_cache_key,
+    sha256_hex,
+)
+from image_prep import (
+    describe,
+    prepare_image_file_task,
+    prepare_page_image,
+    render_pdf_page_task,
+    settings_signature,
+)
+from txt.extract_report_txt import (
+    classify_page,
+    extract_page_rows,
+    page_to_markdown,
+)
 
 VISION_MODEL = "qwen2.5vl:7b"
 END_MARKER = "[[END_OF_PAGE]]"
+# extraction_key of text-layer pages in document_pages. They are cheap to
+# redo, so they are stored for completeness but never reused.
+TEXT_LAYER_KEY = "text-layer"
+# Upper bound on PDF render resolution; VLM_MAX_IMAGE_PIXELS usually caps it lower
+RENDER_DPI = 200
+USER_INSTRUCTION = (
+    "Extract ONLY the essential clinical content from this report page as per your instructions: "
+    "lab/test tables and clinician remarks, in Markdown. "
+    "At the very end, output [[END_OF_PAGE]] on its own line, then stop."
+)
 # ----------------------------------
 
 
 def load_prompt(path: str) -> str:
     """
-    Load the system prompt for the VLM.
+    Load the system prompt for the VLM from the prompt registry (cached,
+    pinned per job, see prompts.py).
 
     Raises FileNotFoundError instead of calling sys.exit so that callers
     (like the FastAPI worker) can handle the error gracefully.
     """
-    if not os.path.exists(path):
-        print(f"[ERROR] Prompt file not found: {path}", file=sys.stderr)
-        raise FileNotFoundError(f"Prompt file not found: {path}")
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read()
+    return load_prompt_text(path)
 
 
-def run_vlm_on_image_bytes(image_bytes: bytes, system_prompt: str, label: str) -> str:
+def run_vlm_on_image_bytes(
+    image_bytes: bytes,
+    system_prompt: str,
+    label: str,
+    echo: bool = True,
+    sink=None,
+) -> str:
     """
     Call qwen2.5vl:7b on a single image (JPG/PNG or PDF-rendered page) as bytes.
-    Streams output to console and stops when END_MARKER is seen.
+    Streams tokens to the sink (if echo) and stops the stream as soon as
+    END_MARKER is seen.
     Returns the content WITHOUT the END_MARKER.
     """
-    print(f"\n=== 👁️ Processing {label} with vision model ===\n")
+    sink = sink or get_default_sink()
+    sink.event(f"\n=== 👁️ Processing {label} with vision model ===\n")
 
-    print(f"SYSTEM PROMPT: {system_prompt}")
+    if echo:
+        sink.document("SYSTEM PROMPT:", system_prompt)
 
     messages = [
         {"role": "system", "content": system_prompt},
         {
             "role": "user",
-            "content": (
-                "Extract ONLY the essential clinical content from this report page as per your instructions: "
-                "lab/test tables and clinician remarks, in Markdown. "
-                "At the very end, output [[END_OF_PAGE]] on its own line, then stop."
-            ),
+            "content": USER_INSTRUCTION,
             "images": [image_bytes],
         },
     ]
 
-    full = ""
-    for chunk in ollama.chat(
-        model=VISION_MODEL,
-        messages=messages,
-        stream=True,
-    ):
-        token = chunk.get("message", {}).get("content", "")
-        if not token:
-            continue
-        full += token
-        print(token, end="", flush=True)
+    on_token = sink.token if echo else None
+    stats = {}
+    page_md = collect_chat_stream(
+        llm_client.chat("vlm", VISION_MODEL, messages),
+        end_marker=END_MARKER,
+        on_token=on_token,
+        stats=stats,
+    )
+    record_llm_call("vlm", VISION_MODEL, stats, label=label)
+
+    sink.event(f"\n\n=== ✅ Finished {label} ===\n")
 
-        if END_MARKER in full:
-            break
+    return page_md.strip()
 
-    print(f"\n\n=== ✅ Finished {label} ===\n")
 
-    if END_MARKER in full:
-        full = full.split(END_MARKER)[0]
+def page_cache_key(content_hash: str, variant: str, system_prompt: str) -> str:
+    """
+    Cache key for one page: what was on the page, how it was rendered,
+    and which model + prompt turned it into Markdown.
+    """
+    return make_cache_key(
+        content_hash,
+        variant,
+        VISION_MODEL,
+        sha256_hex(system_prompt),
+        sha256_hex(USER_INSTRUCTION),
+    )
 
-    return full.strip()
 
+def run_vlm_cached(
+    image_bytes: bytes,
+    system_prompt: str,
+    label: str,
+    echo: bool = True,
+    cache_key: str | None = None,
+    sink=None,
+    page_store=None,
+    page_number: int = 1,
+) -> str:
+    """
+    run_vlm_on_image_bytes, storing the result in the extraction cache and,
+    with a page_store (document_pages.py), as the document's page.
+    """
+    page_md = run_vlm_on_image_bytes(image_bytes, system_prompt, label, echo, sink)
+    cache = get_extraction_cache()
+    if cache is not None and cache_key is not None:
+        cache.put(cache_key, page_md)
+    if page_store is not None and cache_key is not None:
+        page_store.save(page_number, cache_key, page_md, "vlm")
+    return page_md
 
-def process_image_file(input_path: str, system_prompt: str) -> str:
-    """Read a normal image file and send it to the VLM."""
+
+def process_image_file(
+    input_path: str, system_prompt: str, sink=None, page_store=None
+) -> str:
+    """
+    Read a normal image file, downscale / crop / re-encode it (image_prep.py)
+    and send it to the VLM. With a page_store the result is kept as page 1.
+    """
+    sink = sink or get_default_sink()
+    label = os.path.basename(input_path)
     with open(input_path, "rb") as f:
         image_bytes = f.read()
-    page_md = run_vlm_on_image_bytes(
-        image_bytes, system_prompt, label=os.path.basename(input_path)
+
+    cache = get_extraction_cache()
+    key = page_cache_key(
+        sha256_hex(image_bytes), f"image-{settings_signature()}", system_prompt
+    )
+    if page_store is not None:
+        page_store.load(1)
+        stored = page_store.get(1, key)
+        if stored is not None:
+            sink.event(f"\n--- {label}: already extracted, skipping VLM ---")
+            return stored
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            sink.event(f"\n--- {label}: extraction cache hit, skipping VLM ---")
+            if page_store is not None:
+                page_store.save(1, key, cached, "vlm")
+            return cached
+
+    try:
+        # Decoding / scaling / encoding runs in the CPU pool (cpu_pool.py)
+        with span("image_prep"):
+            ref, info = run_cpu(prepare_image_file_task, input_path)
+            prepared = take_shared(ref)
+        sink.event(
+            f"\n--- {label}: sending {describe(info)} "
+            f"(original {len(image_bytes) / 1024:.0f} KB) ---"
+        )
+        image_bytes = prepared
+    except Exception as e:
+        # Formats MuPDF can't decode go to the model unchanged
+        sink.event(f"\n--- {label}: could not prepare image ({e}), sending original ---")
+
+    page_md = run_vlm_cached(
+        image_bytes, system_prompt, label, cache_key=key, sink=sink, page_store=page_store
     )
     return page_md
 
 
-def process_pdf_file(input_path: str, system_prompt: str) -> str:
+def completed_future(value) -> Future:
+    """Wrap an already-known page result so it sits in order with pending ones."""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def render_page_for_vlm(page) -> tuple[bytes, dict]:
+    """Rasterize a single PyMuPDF page for the VLM (see image_prep.py)."""
+    return prepare_page_image(page, max_scale=RENDER_DPI / 72)
+
+
+def submit_page_render(input_path: str, page, page_number: int) -> Future:
     """
-    Render each PDF page to an image in memory and process via VLM.
-    Concatenate all page markdown outputs.
+    Render a page for the VLM in the CPU pool; the pool process opens the
+    PDF itself and returns the image through shared memory. Without a pool
+    the page is rendered right here.
     """
-    doc = fitz.open(input_path)
-    all_pages_md = []
+    if get_cpu_pool() is None:
+        with span("pdf_render", page=page_number):
+            return submit_cpu(render_page_for_vlm, page)
+    return submit_cpu(render_pdf_page_task, input_path, page_number, RENDER_DPI / 72)
+
+
+def run_vlm_page(
+    render: Future,
+    system_prompt: str,
+    label: str,
+    echo: bool,
+    cache_key: str | None,
+    sink,
+    page_store,
+    page_number: int,
+    sent: list,
+) -> str:
+    """Wait for a page's rendered image, then run it through the VLM."""
+    ref, info = render.result()
+    image_bytes = take_shared(ref)
+    seconds = info.pop("seconds", None)
+    if seconds is not None:
+        observe_stage("pdf_render", seconds, page=page_number)
+    sink.event(f"\n--- {label}: sending {describe(info)} ---")
+    sent.append(info)
+    return run_vlm_cached(
+        image_bytes, system_prompt, label, echo, cache_key, sink, page_store, page_number
+    )
 
-    num_pages = len(doc)
-    print(f"\n=== 📄 PDF detected: {num_pages} page(s) ===")
 
-    for i, page in enumerate(doc, start=1):
-        label = f"{os.path.basename(input_path)} - page {i}/{num_pages}"
-        print(f"\n--- Rendering {label} to image ---")
+def process_pdf_file(
+    input_path: str,
+    system_prompt: str,
+    concurrency: int | None = None,
+    sink=None,
+    page_store=None,
+) -> str:
+    """
+    Convert each PDF page to Markdown and concatenate them in page order.
+
+    Born-digital pages with a usable text layer (see classify_page) are
+    converted directly from PyMuPDF text; only scanned / image-only pages
+    are rendered to an image and sent to the VLM.
 
-        pix = page.get_pixmap(dpi=200)
-        image_bytes = pix.tobytes("png")
+    Pages are rendered in the CPU process pool (cpu_pool.py) while up to
+    `concurrency` VLM requests run in a thread pool, so rendering page N+1
+    overlaps with the model working on page N and several pages render on
+    separate cores. Rendering never runs more than `concurrency` pages
+    ahead, which bounds memory for large PDFs.
 
-        page_md = run_vlm_on_image_bytes(image_bytes, system_prompt, label=label)
-        all_pages_md.append(page_md)
+    With a page_store (document_pages.py) each page is stored as soon as it
+    is done, and pages stored by an earlier, failed run are reused.
 
-    return "\n\n".join(md for md in all_pages_md if md)
+    Every page starts with a "## Page N" header: page_to_markdown writes it
+    for text-layer pages, VLM pages get it when the pages are joined (so
+    cached / stored VLM output stays header-free).
+    """
+    sink = sink or get_default_sink()
+    if concurrency is None:
+        concurrency = VLM_PAGE_CONCURRENCY
+    concurrency = max(1, concurrency)
+
+    cache = get_extraction_cache()
+    needs_key = cache is not None or page_store is not None
+    file_hash = file_sha256(input_path) if needs_key else None
+
+    doc = fitz.open(input_path)
+    num_pages = len(doc)
+    sink.event(f"\n=== 📄 PDF detected: {num_pages} page(s), concurrency={concurrency} ===")
+    if page_store is not None:
+        stored_pages = page_store.load(num_pages)
+        if stored_pages:
+            sink.event(f"\n=== {stored_pages} page(s) stored by an earlier run ===")
+
+    # Token-by-token echo is only readable when one page streams at a time
+    echo = concurrency == 1
+    slots = threading.BoundedSemaphore(concurrency)
+    futures = []
+    renders = {}  # page future -> its render future
+    sent = []  # info of every page image sent to the VLM
+    text_layer_pages = set()  # page numbers whose Markdown has its own header
+
+    with ThreadPoolExecutor(
+        max_workers=concurrency, thread_name_prefix="vlm-page"
+    ) as pool:
+        try:
+            for i, page in enumerate(doc, start=1):
+                slots.acquire()
+                # Stop rendering early if an in-flight page already failed
+                failed = next((f for f in futures if f.done() and f.exception()), None)
+                if failed is not None:
+                    slots.release()
+                    break
+
+                label = f"{os.path.basename(input_path)} - page {i}/{num_pages}"
+
+                if TEXT_LAYER_FAST_PATH:
+                    with span("text_layer", page=i):
+                        rows = extract_page_rows(page)
+                        use_text_layer, reason = classify_page(page, rows)
+                        page_md = page_to_markdown(rows, i) if use_text_layer else None
+                    if use_text_layer:
+                        sink.event(f"\n--- {label}: using {reason}, skipping VLM ---")
+                        if page_store is not None:
+                            page_store.save(i, TEXT_LAYER_KEY, page_md, "text_layer")
+                        text_layer_pages.add(i)
+                        futures.append(completed_future(page_md))
+                        slots.release()
+                        continue
+                    sink.event(f"\n--- {label}: {reason}, falling back to VLM ---")
+
+                key = None
+                if needs_key:
+                    key = page_cache_key(
+                        file_hash,
+                        f"pdf-page-{i}@{RENDER_DPI}dpi-{settings_signature()}",
+                        system_prompt,
+                    )
+                if page_store is not None:
+                    stored = page_store.get(i, key)
+                    if stored is not None:
+                        sink.event(f"\n--- {label}: already extracted, skipping VLM ---")
+                        futures.append(completed_future(stored))
+                        slots.release()
+                        continue
+                if cache is not None:
+                    cached = cache.get(key)
+                    if cached is not None:
+                        sink.event(f"\n--- {label}: extraction cache hit, skipping VLM ---")
+                        if page_store is not None:
+                            page_store.save(i, key, cached, "vlm")
+                        futures.append(completed_future(cached))
+                        slots.release()
+                        continue
+
+                sink.event(f"\n--- Rendering {label} to image ---")
+                render = submit_page_render(input_path, page, i)
+
+                # Run in a copy of this context so the page's spans reach the job trace
+                future = pool.submit(
+                    contextvars.copy_context().run,
+                    run_vlm_page,
+                    render,
+                    system_prompt,
+                    label,
+                    echo,
+                    key,
+                    sink,
+                    page_store,
+                    i,
+                    sent,
+                )
+                future.add_done_callback(lambda _f: slots.release())
+                futures.append(future)
+                renders[future] = render
+        except BaseException:
+            for f in futures:
+                if f.cancel() and f in renders:
+                    # Nobody will collect this page's image anymore
+                    discard_shared_result(renders[f])
+            raise
+        finally:
+            doc.close()
+
+        # .result() re-raises the first page failure, in page order
+        all_pages_md = [f.result() for f in futures]
+
+    if sent:
+        sent_pixels = sum(info["pixels"] for info in sent)
+        sent_bytes = sum(info["bytes"] for info in sent)
+        sink.event(
+            f"\n=== {len(sent)} page image(s) sent: {sent_pixels / 1e6:.2f} MP, "
+            f"{sent_bytes / 1024:.0f} KB total ==="
+        )
+
+    return "\n\n".join(
+        md if i in text_layer_pages else f"## Page {i}\n\n{md}"
+        for i, md in enumerate(all_pages_md, start=1)
+        if md
+    )
 
 
 # -------------------------------------------------------------------
 # Reusable wrapper so other Python code can call this directly
 # -------------------------------------------------------------------
-def extract_markdown_from_file(input_path: str) -> str:
+def extract_markdown_from_file(input_path: str, sink=None, page_store=None) -> str:
     """
     Given a local file path (PDF / JPG / PNG / etc.), run the vision pipeline
     and return the extracted Markdown string.
+
+    PDF pages with a usable text layer bypass the VLM (TEXT_LAYER_FAST_PATH).
+    Progress and tokens go to `sink` (default: streaming.get_default_sink()).
+    page_store (document_pages.DocumentPageStore) persists pages as they
+    complete and lets a retry resume from the pages still missing.
     """
+    sink = sink or get_default_sink()
     if not os.path.exists(input_path):
         raise FileNotFoundError(f"Input file not found: {input_path}")
 
     system_prompt = load_prompt(OPTHAL_POINT_FILE)
     ext = os.path.splitext(input_path)[1].lower()
 
-    print("\n======================================")
-    print(f" Vision-based extraction for: {input_path}")
-    print(" Using model:", VISION_MODEL)
-    print("======================================\n")
+    sink.event(
+        "\n======================================\n"
+        f" Vision-based extraction for: {input_path}\n"
+        f" Using model: {VISION_MODEL}\n"
+        "======================================\n"
+    )
 
     if ext in [".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp"]:
-        full_md = process_image_file(input_path, system_prompt)
+        full_md = process_image_file(
+            input_path, system_prompt, sink=sink, page_store=page_store
+        )
     elif ext == ".pdf":
-        full_md = process_pdf_file(input_path, system_prompt)
+        full_md = process_pdf_file(
+            input_path, system_prompt, sink=sink, page_store=page_store
+        )
     else:
         raise ValueError(f"Unsupported file type for vision model: {ext}")
 
@@ -0,0 +1,167 @@
+"""
+Content-addressed on-disk cache for VLM page extraction.
+
+Keys are SHA-256 digests over the page content (image bytes, or PDF file
+hash + page number) together with the vision model name and the prompt
+text, so a prompt or model change never returns stale Markdown.
+
+Entries live under EXTRACTION_CACHE_DIR as <key[:2]>/<key>.md. A hit bumps
+the file's mtime, and once the directory grows past
+EXTRACTION_CACHE_MAX_BYTES the least recently used entries are deleted.
+The cache is safe to share between threads and worker processes: writes
+go through a temp file + os.replace and eviction tolerates files that
+disappear underneath it.
+
+The cache is best-effort: an entry that can't be read counts as a miss,
+and a failed write (full disk, unwritable directory) is logged and
+ignored, never failing the page that was just extracted.
+"""
+
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+# Add parent directory to path to allow importing config
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from config import (
+    EXTRACTION_CACHE_DIR,
+    EXTRACTION_CACHE_ENABLED,
+    EXTRACTION_CACHE_MAX_BYTES,
+)
+
+logger = logging.getLogger("extraction_cache")
+
+# Evict down to this fraction of the limit so we don't rescan on every put
+EVICT_TARGET_RATIO = 0.9
+
+
+def sha256_hex(data: bytes | str) -> str:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """Hash a file in chunks without reading it into memory at once."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_cache_key(*parts: str) -> str:
+    """Combine key parts (content hash, model, prompt hash, ...) into one key."""
+    return sha256_hex("\x1f".join(parts))
+
+
+class ExtractionCache:
+    """Size-bounded LRU cache of Markdown strings stored as files."""
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None  # computed lazily on first put
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.md")
+
+    def get(self, key: str) -> str | None:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = f.read()
+        except OSError as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning(f"Extraction cache read failed: {e}")
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            # Evicted meanwhile or not ours to touch: still a hit
+            pass
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, markdown: str) -> None:
+        path = self._path(key)
+        data = markdown.encode("utf-8")
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException as e:
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            if not isinstance(e, OSError):
+                raise
+            logger.warning(f"Extraction cache write failed: {e}")
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _scan(self):
+        """Return ([(mtime, size, path), ...], total_size) for all entries."""
+        entries = []
+        total = 0
+        for root, _dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".md"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return entries, total
+
+    def _evict(self) -> None:
+        entries, total = self._scan()
+        target = self.max_bytes * EVICT_TARGET_RATIO
+        for _mtime, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_extraction_cache() -> ExtractionCache | None:
+    """Process-wide cache instance, or None if caching is disabled."""
+    global _cache
+    if not EXTRACTION_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ExtractionCache(EXTRACTION_CACHE_DIR, EXTRACTION_CACHE_MAX_BYTES)
+        return _cache
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+"""
+Fake Ollama server for benchmarks and local runs without a GPU.
+
+Implements just enough of the Ollama HTTP API for this project:
+    POST /api/chat      streaming (NDJSON) or non-streaming chat
+    POST /api/generate  only the empty-prompt form used to preload a model
+    GET  /api/tags      lists the two models from config
+    GET  /api/version
+
+Responses are synthetic but shaped like the real thing:
+    - vision requests (a message with "images") get a Markdown lab table
+      followed by [[END_OF_PAGE]] and some trailing text, so callers that
+      stop at the end marker are exercised
+    - text requests get an HTML fragment, or JSON lab results when a
+      `format` (JSON schema) is requested
+    - the final chunk carries eval_count / eval_duration /
+      prompt_eval_count like Ollama does
+
+Timing is configurable: --first-token-delay simulates prompt processing
+(plus --per-image-delay for each image), --token-delay the decode speed.
+
+Usage:
+    python src/fake_ollama.py --port 11435 --token-delay 0.01
+    set OLLAMA_HOST=http://127.0.0.1:11435   (then run the service / worker)
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Add parent directory to path to allow importing config
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+DEFAULT_PORT = 11435
+
+
+class FakeOllamaSettings:
+    def __init__(
+        self,
+        token_delay: float = 0.005,
+        first_token_delay: float = 0.05,
+        per_image_delay: float = 0.0,
+        tokens: int = 200,
+    ):
+        self.token_delay = token_delay
+        self.first_token_delay = first_token_delay
+        self.per_image_delay = per_image_delay
+        self.tokens = tokens
+        self.requests = 0
+        self.images = 0
+        self._lock = threading.Lock()
+
+    def count(self, images: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.images += images
+
+
+def vision_tokens(n: int) -> list[str]:
+    """A Markdown lab table of roughly n tokens, then the end marker."""
+    tokens = ["## Laboratory Results\n\n", "| Test | Result | Unit | Range |\n", "|---|---|---|---|\n"]
+    row = 0
+    while len(tokens) < n:
+        row += 1
+        tokens += [f"| Test {row} ", f"| {10 + row % 7}.{row % 10} ", "| mg/dL ", "| 5-15 |\n"]
+    # Trailing output after the marker is what a real model may keep producing
+    return tokens + ["\n[[END_OF_PAGE]]\n"] + ["extra "] * 20
+
+
+def text_tokens(n: int) -> list[str]:
+    """An HTML insights fragment of roughly n tokens."""
+    tokens = ["<h2>", "Summary", "</h2>\n", "<ul>\n"]
+    item = 0
+    while len(tokens) < n:
+        item += 1
+        tokens += ["<li>", f"Finding {item}: ", "value within ", "reference range", "</li>\n"]
+    return tokens + ["</ul>\n"]
+
+
+def json_tokens(n: int) -> list[str]:
+    """Lab results JSON (see lab_results.LAB_RESULTS_SCHEMA), ~n tokens."""
+    results = []
+    while len(results) * 12 < n:
+        row = len(results) + 1
+        results.append(
+            {
+                "test_name": f"Test {row}",
+                "value": f"{10 + row % 7}.{row % 10}",
+                "unit": "mg/dL",
+                "reference_range": "5-15",
+                "date": None,
+            }
+        )
+    text = json.dumps({"report_date": "2024-01-15", "results": results})
+    # Stream it in small pieces like a model would
+    return [text[i : i + 8] for i in range(0, len(text), 8)]
+
+
+def make_handler(settings: FakeOllamaSettings):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, payload: dict, status: int = 200) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self):
+            if self.path == "/api/version":
+                self._send_json({"version": "0.0.0-fake"})
+            elif self.path == "/api/tags":
+                # Imported here: benchmark.py starts this server before config
+                # is imported, so config picks up the server's URL
+                from config import MODEL_NAME
+
+                names = [MODEL_NAME, "qwen2.5vl:7b"]
+                self._send_json({"models": [{"name": n, "model": n} for n in names]})
+            else:
+                self._send_json({"error": "not found"}, status=404)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                self._send_json({"error": "invalid JSON"}, status=400)
+                return
+            if self.path == "/api/chat":
+                self._chat(request)
+            elif self.path == "/api/generate":
+                # Model preload (see llm_client.preload_models)
+                self._send_json(
+                    {
+                        "model": request.get("model", ""),
+                        "created_at": datetime.now(timezone.utc).isoformat(),
+                        "response": "",
+                        "done": True,
+                        "done_reason": "load",
+                    }
+                )
+            else:
+                self._send_json({"error": "not found"}, status=404)
+
+        def _chat(self, request: dict) -> None:
+            model = request.get("model", "")
+            messages = request.get("messages") or []
+            images = sum(len(m.get("images") or []) for m in messages)
+            settings.count(images)
+
+            if images:
+                tokens = vision_tokens(settings.tokens)
+            elif request.get("format"):
+                tokens = json_tokens(settings.tokens)
+            else:
+                tokens = text_tokens(settings.tokens)
+            prompt_chars = sum(len(m.get("content") or "") for m in messages)
+            started = time.perf_counter()
+            time.sleep(settings.first_token_delay + images * settings.per_image_delay)
+            prompt_done = time.perf_counter()
+
+            def chunk(content: str, done: bool = False) -> dict:
+                return {
+                    "model": model,
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                    "message": {"role": "assistant", "content": content},
+                    "done": done,
+                }
+
+            def final(sent: int) -> dict:
+                now = time.perf_counter()
+                last = chunk("", done=True)
+                last.update(
+                    {
+                        "done_reason": "stop",
+                        "total_duration": int((now - started) * 1e9),
+                        "load_duration": 0,
+                        "prompt_eval_count": prompt_chars // 4 + images * 1000,
+                        "prompt_eval_duration": int((prompt_done - started) * 1e9),
+                        "eval_count": sent,
+                        "eval_duration": int((now - prompt_done) * 1e9),
+                    }
+                )
+                return last
+
+            if not request.get("stream", True):
+                time.sleep(settings.token_delay * len(tokens))
+                result = final(len(tokens))
+                result["message"]["content"] = "".join(tokens)
+                self._send_json(result)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for token in tokens:
+                    time.sleep(settings.token_delay)
+                    self._write_chunk(chunk(token))
+                self._write_chunk(final(len(tokens)))
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client closed the stream early (e.g. at the end marker)
+                self.close_connection = True
+
+        def _write_chunk(self, payload: dict) -> None:
+            data = json.dumps(payload).encode("utf-8") + b"\n"
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def start_fake_ollama(
+    host: str = "127.0.0.1", port: int = 0, settings: FakeOllamaSettings | None = None
+):
+    """
+    Start the server on a background thread.
+    Returns (server, url); call server.shutdown() to stop it.
+    Port 0 picks a free port.
+    """
+    settings = settings or FakeOllamaSettings()
+    server = ThreadingHTTPServer((host, port), make_handler(settings))
+    server.daemon_threads = True
+    server.settings = settings
+    threading.Thread(target=server.serve_forever, name="fake-ollama", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Ollama server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--token-delay", type=float, default=0.005, help="seconds per token")
+    parser.add_argument(
+        "--first-token-delay", type=float, default=0.05, help="seconds before the first token"
+    )
+    parser.add_argument(
+        "--per-image-delay", type=float, default=0.0, help="extra first-token delay per image"
+    )
+    parser.add_argument("--tokens", type=int, default=200, help="tokens per response")
+    args = parser.parse_args()
+
+    settings = FakeOllamaSettings(
+        args.token_delay, args.first_token_delay, args.per_image_delay, args.tokens
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(settings))
+    server.daemon_threads = True
+    print(f"Fake Ollama listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,18 @@
 
 import os
 import sys
-import ollama
 from bs4 import BeautifulSoup  # used to ensure clean HTML structure
 
 
 # Add parent directory to path to allow importing config
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from config import INPUT_MD_SLM, OUTPUT_HTML_SLM, MODEL_NAME, PROMPT_FILE
+from config import INPUT_MD_SLM, OUTPUT_HTML_SLM, MODEL_NAME, PROMPT_FILE, SLM_NUM_CTX
+import llm_client
+from cpu_pool import run_cpu
+from insight_cache import get_insight_cache, insight_cache_key
+from metrics import record_llm_call, span
+from prompts import load_prompt_text
+from streaming import collect_chat_stream, get_default_sink
 
 
 # Minimal clean medical CSS styling
@@ -50,38 +55,42 @@ ul {
 """
 
 
+# Options of every insights / summary call; part of the result cache key
+INSIGHT_OPTIONS = {"num_ctx": SLM_NUM_CTX}
+
+
 def load_text(path: str) -> str:
+    """
+    Read a text file. Raises FileNotFoundError (never exits) so the
+    worker can fail just the job. Prompts go through prompts.py instead.
+    """
     if not os.path.exists(path):
-        print(f"[ERROR] File not found: {path}", file=sys.stderr)
-        sys.exit(1)
+        raise FileNotFoundError(f"File not found: {path}")
     with open(path, "r", encoding="utf-8") as f:
         return f.read()
 
 
-def generate_insights(prompt: str, markdown_report: str) -> str:
+def generate_insights(prompt: str, markdown_report: str, sink=None) -> str:
+    sink = sink or get_default_sink()
     messages = [
         {"role": "system", "content": prompt},
         {"role": "user", "content": markdown_report},
     ]
 
-    print(f"\n=== 📝 Loading Markdown Report === \n{markdown_report}")
-    print(f"\n=== 📝 Loading Prompt === \n{prompt}")
-    print("\n=== 💡 Generating Clinical Insights (streaming) ===\n")
-    print("\n=== Model Name===\n", MODEL_NAME)
-
-    streamed = ""
-    for chunk in ollama.chat(
-        model=MODEL_NAME,
-        messages=messages,
-        stream=True,
-    ):
-        token = chunk.get("message", {}).get("content", "")
-        if not token:
-            continue
-        streamed += token
-        print(token, end="", flush=True)
-
-    print("\n\n=== 🚀 Generation complete ===\n")
+    sink.document("\n=== 📝 Loading Markdown Report === ", markdown_report)
+    sink.document("\n=== 📝 Loading Prompt === ", prompt)
+    sink.event("\n=== 💡 Generating Clinical Insights (streaming) ===\n")
+    sink.event(f"\n=== Model Name===\n {MODEL_NAME}")
+
+    stats = {}
+    streamed = collect_chat_stream(
+        llm_client.chat("slm", MODEL_NAME, messages, options=INSIGHT_OPTIONS),
+        on_token=sink.token,
+        stats=stats,
+    )
+    record_llm_call("slm", MODEL_NAME, stats)
+
+    sink.event("\n\n=== 🚀 Generation complete ===\n")
     return streamed
 
 
@@ -110,21 +119,42 @@ def sanitize_and_wrap_html(inner_html: str) -> str:
 # -------------------------------------------------------------------
 # NEW: reusable wrapper so other Python code can call this directly
 # -------------------------------------------------------------------
-def generate_insights_html(markdown_data: str, prompt: str | None = None) -> str:
+def generate_insights_html(
+    markdown_data: str, prompt: str | None = None, sink=None, facts: str | None = None
+) -> str:
     """
     Takes extracted Markdown text and returns a full HTML document string
     (with <html>...</html> and CSS).
+    facts: optional precomputed lab facts block (lab_facts.py), sent ahead
+    of the Markdown.
+    The model output is cached (insight_cache.py); the same input, prompt
+    and model return the cached output without calling the model.
     """
     if prompt is None:
-        prompt = load_text(PROMPT_FILE)
-
-    inner_html_raw = generate_insights(prompt, markdown_data)
-    final_html = sanitize_and_wrap_html(inner_html_raw)
+        prompt = load_prompt_text(PROMPT_FILE)
+    if facts:
+        markdown_data = f"{facts}\n\n{markdown_data}"
+
+    cache = get_insight_cache()
+    key = insight_cache_key(MODEL_NAME, prompt, markdown_data, INSIGHT_OPTIONS)
+    with span("insight_cache_lookup"):
+        inner_html_raw = cache.get(key) if cache else None
+    if inner_html_raw is not None:
+        sink = sink or get_default_sink()
+        sink.event("\n=== ⚡ Insights served from cache ===\n")
+        sink.token(inner_html_raw)
+    else:
+        inner_html_raw = generate_insights(prompt, markdown_data, sink=sink)
+        if cache and inner_html_raw.strip():
+            cache.put(key, inner_html_raw, MODEL_NAME)
+    # BeautifulSoup parsing is CPU-bound; it runs in the CPU pool (cpu_pool.py)
+    with span("sanitize"):
+        final_html = run_cpu(sanitize_and_wrap_html, inner_html_raw)
     return final_html
 
 
 def main():
-    prompt = load_text(PROMPT_FILE)
+    prompt = load_prompt_text(PROMPT_FILE)
     markdown_data = load_text(INPUT_MD_SLM)
 
     inner_html_raw = generate_insights(prompt, markdown_data)
@@ -0,0 +1,227 @@
+"""
+Prepare page images for the vision model.
+
+Both rendered PDF pages and uploaded photos/scans go through the same steps:
+
+    1) analyse a small thumbnail: where is the content, is there color?
+    2) crop blank margins (VLM_CROP_MARGINS)
+    3) scale so the image holds at most VLM_MAX_IMAGE_PIXELS, never above
+       the source resolution (RENDER_DPI for PDFs, native size for images)
+    4) convert to grayscale where it loses nothing (VLM_IMAGE_GRAYSCALE)
+    5) encode as JPEG by default (VLM_IMAGE_FORMAT / VLM_IMAGE_QUALITY)
+
+Every function returns (image_bytes, info) where info records what is sent
+to the model: {"width", "height", "pixels", "bytes", "format", "grayscale",
+"cropped"}.
+"""
+
+import math
+import os
+import sys
+import time
+from io import BytesIO
+
+import fitz  # PyMuPDF
+
+try:
+    # Optional: only needed for VLM_IMAGE_FORMAT=webp
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Add parent directory to path to allow importing config
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from config import (
+    VLM_CROP_MARGINS,
+    VLM_IMAGE_FORMAT,
+    VLM_IMAGE_GRAYSCALE,
+    VLM_IMAGE_QUALITY,
+    VLM_MAX_IMAGE_PIXELS,
+)
+
+# Width of the analysis thumbnail
+THUMBNAIL_WIDTH = 256
+# A thumbnail pixel darker than this (in any channel) counts as content
+INK_THRESHOLD = 200
+# A pixel whose channels differ by more than this counts as colored
+COLOR_THRESHOLD = 48
+# Keep color when at least this fraction of thumbnail pixels is colored
+MIN_COLOR_FRACTION = 0.0005
+# Padding kept around the content box, as a fraction of the page size
+CROP_PADDING = 0.02
+
+
+def settings_signature() -> str:
+    """Short description of the settings, for cache keys of prepared pages."""
+    return (
+        f"{VLM_MAX_IMAGE_PIXELS}px-{output_format()}{VLM_IMAGE_QUALITY}"
+        f"-gray:{VLM_IMAGE_GRAYSCALE}-crop:{int(VLM_CROP_MARGINS)}"
+    )
+
+
+def output_format() -> str:
+    if VLM_IMAGE_FORMAT == "webp" and Image is None:
+        return "jpeg"
+    if VLM_IMAGE_FORMAT in ("jpeg", "png", "webp"):
+        return VLM_IMAGE_FORMAT
+    return "jpeg"
+
+
+def analyse_page(page) -> tuple[fitz.Rect | None, bool]:
+    """
+    Render a small RGB thumbnail of the page and return
+    (content_box, has_color). content_box is in page coordinates and is
+    None for a blank page.
+    """
+    rect = page.rect
+    scale = THUMBNAIL_WIDTH / rect.width
+    thumb = page.get_pixmap(
+        matrix=fitz.Matrix(scale, scale), colorspace=fitz.csRGB, alpha=False
+    )
+    w, h = thumb.width, thumb.height
+    samples = thumb.samples
+    r, g, b = samples[0::3], samples[1::3], samples[2::3]
+    darkest = bytes(map(min, r, g, b))
+    brightest = bytes(map(max, r, g, b))
+
+    colored = sum(1 for hi, lo in zip(brightest, darkest) if hi - lo > COLOR_THRESHOLD)
+    has_color = colored >= MIN_COLOR_FRACTION * w * h
+
+    rows = [y for y in range(h) if min(darkest[y * w : (y + 1) * w]) < INK_THRESHOLD]
+    if not rows:
+        return None, has_color
+    cols = [x for x in range(w) if min(darkest[x::w]) < INK_THRESHOLD]
+
+    # Thumbnail pixels -> page coordinates, with some padding
+    pad_x, pad_y = CROP_PADDING * rect.width, CROP_PADDING * rect.height
+    box = fitz.Rect(
+        rect.x0 + cols[0] * rect.width / w - pad_x,
+        rect.y0 + rows[0] * rect.height / h - pad_y,
+        rect.x0 + (cols[-1] + 1) * rect.width / w + pad_x,
+        rect.y0 + (rows[-1] + 1) * rect.height / h + pad_y,
+    )
+    return box & rect, has_color
+
+
+def encode_pixmap(pix, fmt: str) -> bytes:
+    if fmt == "png":
+        return pix.tobytes("png")
+    if fmt == "webp":
+        mode = "L" if pix.n == 1 else "RGB"
+        img = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+        buf = BytesIO()
+        img.save(buf, format="WEBP", quality=VLM_IMAGE_QUALITY)
+        return buf.getvalue()
+    return pix.tobytes("jpeg", jpg_quality=VLM_IMAGE_QUALITY)
+
+
+def prepare_page_image(page, max_scale: float) -> tuple[bytes, dict]:
+    """
+    Render a PyMuPDF page for the vision model.
+    max_scale is the highest zoom allowed (e.g. RENDER_DPI / 72 for PDFs).
+    """
+    rect = page.rect
+    box, has_color = analyse_page(page)
+    clip = rect
+    if VLM_CROP_MARGINS and box is not None and not box.is_empty:
+        clip = box
+
+    if VLM_IMAGE_GRAYSCALE == "always":
+        grayscale = True
+    elif VLM_IMAGE_GRAYSCALE == "never":
+        grayscale = False
+    else:
+        grayscale = not has_color
+
+    scale = min(max_scale, math.sqrt(VLM_MAX_IMAGE_PIXELS / (clip.width * clip.height)))
+    pix = page.get_pixmap(
+        matrix=fitz.Matrix(scale, scale),
+        clip=clip,
+        colorspace=fitz.csGRAY if grayscale else fitz.csRGB,
+        alpha=False,
+    )
+    fmt = output_format()
+    data = encode_pixmap(pix, fmt)
+    return data, {
+        "width": pix.width,
+        "height": pix.height,
+        "pixels": pix.width * pix.height,
+        "bytes": len(data),
+        "format": fmt,
+        "grayscale": grayscale,
+        "cropped": clip != rect,
+    }
+
+
+def prepare_image_bytes(image_bytes: bytes) -> tuple[bytes, dict]:
+    """
+    Prepare an uploaded image (JPG/PNG/...) for the vision model.
+    Images are never scaled above their native resolution.
+    """
+    native = fitz.Pixmap(image_bytes)
+    doc = fitz.open(stream=image_bytes)
+    try:
+        page = doc[0]
+        # Image pages are sized by the image's DPI; zoom back to native pixels
+        return prepare_page_image(page, max_scale=native.width / page.rect.width)
+    finally:
+        doc.close()
+
+
+def describe(info: dict) -> str:
+    """One-line summary of what is sent to the model, for progress messages."""
+    extras = []
+    if info["grayscale"]:
+        extras.append("grayscale")
+    if info["cropped"]:
+        extras.append("cropped")
+    suffix = f", {', '.join(extras)}" if extras else ""
+    return (
+        f"{info['width']}x{info['height']} px ({info['pixels'] / 1e6:.2f} MP), "
+        f"{info['bytes'] / 1024:.0f} KB {info['format'].upper()}{suffix}"
+    )
+
+
+# -------------------------------------------------------------------
+# Process pool tasks (see cpu_pool.py)
+# -------------------------------------------------------------------
+# The last PDF opened by this pool process, as (path, mtime, doc). Pages
+# of one document arrive one after another, so it is parsed only once.
+_open_pdf = None
+
+
+def _open_cached(path: str):
+    global _open_pdf
+    mtime = os.path.getmtime(path)
+    if _open_pdf is not None and _open_pdf[:2] == (path, mtime):
+        return _open_pdf[2]
+    if _open_pdf is not None:
+        _open_pdf[2].close()
+    _open_pdf = (path, mtime, fitz.open(path))
+    return _open_pdf[2]
+
+
+def render_pdf_page_task(path: str, page_number: int, max_scale: float):
+    """
+    prepare_page_image() for page `page_number` (1-based) of a PDF, run in
+    a pool process. Returns (SharedBytes, info); info["seconds"] is the
+    time spent rendering and encoding.
+    """
+    from cpu_pool import put_shared
+
+    started = time.perf_counter()
+    page = _open_cached(path)[page_number - 1]
+    data, info = prepare_page_image(page, max_scale)
+    info["seconds"] = time.perf_counter() - started
+    return put_shared(data), info
+
+
+def prepare_image_file_task(path: str):
+    """prepare_image_bytes() for an image file, run in a pool process."""
+    from cpu_pool import put_shared
+
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        data, info = prepare_image_bytes(f.read())
+    info["seconds"] = time.perf_counter() - started
+    return put_shared(data), info
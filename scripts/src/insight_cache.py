@@ -0,0 +1,171 @@
+"""
+Result cache for text model calls (insights and patient summary HTML).
+
+Duplicate uploads, regenerate clicks and patient summaries whose reports
+haven't changed send the model exactly the same input again. The output is
+stored under
+
+    key = sha256(model, options, sha256(prompt), sha256(input))
+
+so a change of prompt text, model or options never returns stale output.
+Lookups go through an in-process LRU (INSIGHT_CACHE_LRU_SIZE entries) and
+then the insight_cache table, which the service and all workers share.
+
+The raw model output is cached, not the final document, so changes to the
+HTML wrapper / sanitizer apply to cached results too.
+
+The table is best-effort: if it can't be read or written (no database,
+migration missing) the lookup counts as a miss and the model runs as usual.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from config import (
+    INSIGHT_CACHE_ENABLED,
+    INSIGHT_CACHE_LRU_SIZE,
+    INSIGHT_CACHE_MAX_AGE_DAYS,
+)
+from extraction_cache import make_cache_key, sha256_hex
+from metrics import record_cache_lookup
+
+logger = logging.getLogger("insight_cache")
+
+# Delete expired rows at most this often per process
+PRUNE_INTERVAL_SECONDS = 3600
+
+
+def insight_cache_key(model: str, prompt: str, input_text: str, options=None) -> str:
+    return make_cache_key(
+        model,
+        json.dumps(options or {}, sort_keys=True),
+        sha256_hex(prompt),
+        sha256_hex(input_text),
+    )
+
+
+class InsightCache:
+    """In-process LRU in front of the insight_cache table."""
+
+    def __init__(self, lru_size: int = INSIGHT_CACHE_LRU_SIZE, use_db: bool = True):
+        self.lru_size = lru_size
+        self.use_db = use_db
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "entries": len(self._lru),
+            }
+
+    def _remember(self, key: str, output: str) -> None:
+        """Add to the LRU (called with the lock held)."""
+        self._lru[key] = output
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            output = self._lru.get(key)
+            if output is not None:
+                self._lru.move_to_end(key)
+                self.memory_hits += 1
+        if output is not None:
+            record_cache_lookup("insights", "memory_hit")
+            return output
+
+        output = self._load(key) if self.use_db else None
+        with self._lock:
+            if output is None:
+                self.misses += 1
+            else:
+                self.store_hits += 1
+                self._remember(key, output)
+        record_cache_lookup("insights", "miss" if output is None else "store_hit")
+        return output
+
+    def put(self, key: str, output: str, model: str) -> None:
+        with self._lock:
+            self._remember(key, output)
+        if self.use_db:
+            self._store(key, output, model)
+
+    # ---------------------------------------------------------------
+    # insight_cache table
+    # ---------------------------------------------------------------
+    def _load(self, key: str) -> str | None:
+        try:
+            from db import db_connection
+
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        UPDATE insight_cache SET last_used_at = NOW()
+                        WHERE cache_key = %s
+                        RETURNING output
+                        """,
+                        (key,),
+                    )
+                    row = cur.fetchone()
+                conn.commit()
+        except Exception as e:
+            logger.warning(f"Insight cache lookup failed: {e}")
+            return None
+        return row[0] if row else None
+
+    def _store(self, key: str, output: str, model: str) -> None:
+        prune = time.monotonic() - self._last_prune > PRUNE_INTERVAL_SECONDS
+        try:
+            from db import db_connection
+
+            with db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        INSERT INTO insight_cache (cache_key, output, model_name)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (cache_key) DO UPDATE
+                        SET output = EXCLUDED.output, last_used_at = NOW()
+                        """,
+                        (key, output, model),
+                    )
+                    if prune:
+                        cur.execute(
+                            "DELETE FROM insight_cache "
+                            "WHERE last_used_at < NOW() - make_interval(days => %s)",
+                            (INSIGHT_CACHE_MAX_AGE_DAYS,),
+                        )
+                conn.commit()
+        except Exception as e:
+            logger.warning(f"Insight cache write failed: {e}")
+            return
+        if prune:
+            self._last_prune = time.monotonic()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_insight_cache() -> InsightCache | None:
+    """Process-wide cache instance, or None if caching is disabled."""
+    global _cache
+    if not INSIGHT_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = InsightCache()
+        return _cache
@@ -0,0 +1,572 @@
+#!/usr/bin/env python
+
+"""
+Insights Worker
+
+Consumes the Postgres-backed job queue (see job_queue.py) that
+insights_service.py fills via POST /internal/generate-insights and
+POST /internal/generate-user-insights.
+
+For every claimed document it:
+    1) Extracts Markdown from the report (via qwen2.5vl:7b VLM),
+       unless documents.extracted_markdown is already set. Pages are
+       stored as they complete (document_pages.py), so a retry only
+       extracts the pages an earlier attempt didn't finish.
+    2) Generates HTML insights via the text model (qwen3:4b-instruct)
+    3) Stores the result in `insights` and marks the job completed
+
+For every claimed patient summary job it folds the user's new reports into
+their rolling summary record (patient_summary.py), generates the summary
+and stores it in users.patient_insights.
+
+Usage:
+    python src/insights_worker.py --workers 2
+
+Throughput scales by raising --workers (jobs per process) or by starting
+more worker processes; the queue hands every job to exactly one worker.
+
+Every claimed job is leased (see job_queue.py). A heartbeat thread renews
+the lease while the job runs; if this process dies, another worker
+reclaims the job once the lease expires. A job whose lease was lost is
+not written back.
+"""
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+
+# Add parent directory to path to allow importing config
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from config import (
+    PROJECT_ROOT,
+    BULK_MAX_SHARE,
+    DB_POOL_MAX,
+    INSIGHTS_JOB_LEASE_SECONDS,
+    INSIGHTS_JOB_MAX_ATTEMPTS,
+    INSIGHTS_WORKER_COUNT,
+    INSIGHTS_WORKER_METRICS_PORT,
+    INSIGHTS_WORKER_POLL_SECONDS,
+    LAB_FACTS_ENABLED,
+    LAB_RESULTS_ENABLED,
+    MODEL_NAME,
+    OLLAMA_PRELOAD,
+)
+import llm_client
+from cpu_pool import shutdown_cpu_pool
+from db import close_db_pool, db_connection, get_db_connection, init_db_pool
+from document_pages import DocumentPageStore
+from metrics import job_trace, span, start_metrics_server
+from progress import ProgressPublisher, publish_progress
+from prompts import get_registry, pin_prompts
+from streaming import CallbackSink, LogSink, set_default_sink
+from job_queue import (
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_NORMAL,
+    claim_insights_job,
+    claim_user_summary_job,
+    complete_insights_job,
+    complete_user_summary_job,
+    fail_insights_job,
+    fail_user_summary_job,
+    listen_for_jobs,
+    renew_insights_lease,
+    renew_user_summary_lease,
+    set_document_processing_status,
+    wait_for_jobs,
+)
+
+
+logger = logging.getLogger("insights_worker")
+
+
+# -------------------------------------------------------------------
+# Leases
+# -------------------------------------------------------------------
+def current_worker_id() -> str:
+    """Identifies this worker thread in job leases (host:pid:thread)."""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+class LeaseHeartbeat:
+    """
+    Renews a job lease every lease_seconds / 3 on a background thread
+    while the job runs:
+
+        with LeaseHeartbeat(lambda conn: renew_insights_lease(conn, ...)) as hb:
+            ...
+        if hb.lost.is_set(): ...
+
+    renew(conn) returns False once another worker has taken the job over.
+    """
+
+    def __init__(self, renew, lease_seconds: float = INSIGHTS_JOB_LEASE_SECONDS):
+        self.renew = renew
+        self.interval = lease_seconds / 3
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name=f"{threading.current_thread().name}-heartbeat",
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                with db_connection() as conn:
+                    renewed = self.renew(conn)
+            except Exception as e:
+                # Transient DB trouble: try again next beat, the lease has slack
+                logger.warning(f"[worker] Lease heartbeat failed: {e}")
+                continue
+            if not renewed:
+                logger.warning("[worker] Job lease lost; another worker reclaimed the job")
+                self.lost.set()
+                return
+
+
+# -------------------------------------------------------------------
+# Pipeline — calls your VLM + SLM pipeline for one claimed job
+# -------------------------------------------------------------------
+def resolve_storage_path(storage_path: str) -> str:
+    """
+    Turn documents.storage_path into an existing absolute path.
+    Raises FileNotFoundError if the file is missing.
+    """
+    input_path = storage_path
+    # Ensure absolute path if stored relatively
+    if not os.path.isabs(input_path):
+        # The file is stored in backend/uploads, so we need to point there
+        # If the path from DB is just "uploads/file.jpg", we need to prepend "backend"
+        input_path = os.path.join(PROJECT_ROOT, "backend", input_path)
+
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f"File not found on disk: {input_path}")
+    return input_path
+
+
+def run_insights_pipeline(document_id: str, worker_id: str | None = None) -> None:
+    """
+    Runs one claimed job:
+      1. Looks up `storage_path` and `extracted_markdown` from DB.
+      2. If markdown missing -> runs VLM extraction & saves to DB.
+      3. If markdown exists -> skips VLM.
+      4. Generates HTML insights via generate_insights_html (SLM), with the
+         precomputed lab facts of lab_facts.py ahead of the Markdown.
+      5. Saves the result to the DB and marks the job completed.
+
+    Raises on failure; the caller marks the job as failed. With worker_id
+    the result is only stored while that worker still holds the job lease.
+    DB connections are borrowed per step, never across VLM/SLM calls.
+    Page progress and generated tokens are published live (progress.py),
+    stage timings are recorded as spans of the job trace (metrics.py).
+    """
+    logger.info(f"[worker] Starting insight generation for document_id={document_id!r}")
+    publisher = ProgressPublisher(document_id)
+    sink = CallbackSink(publisher)
+
+    # 1. Get file path and existing markdown
+    with span("db_lookup"), db_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT storage_path, extracted_markdown FROM documents WHERE id = %s",
+            (document_id,),
+        )
+        row = cur.fetchone()
+
+    if not row or not row[0]:
+        raise LookupError(f"Document path not found: {document_id}")
+
+    storage_path, existing_markdown = row
+    input_path = resolve_storage_path(storage_path)
+
+    logger.info("[worker] Using input file path: %s", input_path)
+
+    # 2. Conditional Extraction
+    markdown = existing_markdown
+    extracted = not markdown
+    if extracted:
+        logger.info("[worker] No existing markdown found. Running VLM extraction...")
+        with db_connection() as conn:
+            set_document_processing_status(conn, document_id, "extracting")
+        publisher.set_stage("extracting")
+
+        from extract_report_slm import extract_markdown_from_file
+
+        # Pages are stored as they complete; a retried job resumes from them
+        with span("extraction"):
+            markdown = extract_markdown_from_file(
+                input_path, sink=sink, page_store=DocumentPageStore(document_id)
+            )
+
+        # Save extracted markdown back to DB
+        try:
+            with span("db_save_markdown"), db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE documents SET extracted_markdown = %s, updated_at = NOW() WHERE id = %s",
+                        (markdown, document_id),
+                    )
+                conn.commit()
+            logger.info("[worker] Saved extracted markdown to DB.")
+        except Exception as e:
+            logger.error(f"[worker] Failed to save extracted markdown: {e}")
+            # We continue anyway to generate insights, though it won't be cached
+    else:
+        logger.info("[worker] Found existing markdown in DB. Skipping VLM extraction.")
+
+    # 3. Structured lab results; a failure here doesn't fail the job
+    if LAB_RESULTS_ENABLED:
+        refresh_lab_results(document_id, markdown, extracted, publisher)
+
+    # 4. Generate HTML Insights (SLM)
+    with db_connection() as conn:
+        set_document_processing_status(conn, document_id, "insights_generating")
+    publisher.set_stage("insights_generating")
+
+    from generate_insights_txt import generate_insights_html
+
+    facts = load_lab_facts(document_id) if LAB_FACTS_ENABLED else ""
+    html = generate_insights_html(markdown, sink=sink, facts=facts)
+
+    logger.info(
+        "[worker] Insights generated for document_id=%s (markdown_len=%d, html_len=%d)",
+        document_id,
+        len(markdown),
+        len(html),
+    )
+
+    # 5. Save to DB
+    with span("db_save"), db_connection() as conn:
+        stored = complete_insights_job(conn, document_id, html, worker_id)
+    if not stored:
+        logger.warning(
+            f"[worker] Lease lost for document_id={document_id!r}; result discarded"
+        )
+        return
+    publisher.publish("done")
+    logger.info(f"[worker] Finished insight generation for document_id={document_id!r}")
+
+
+def refresh_lab_results(
+    document_id: str, markdown: str, extracted: bool, publisher=None
+) -> None:
+    """
+    Store the document's lab results (lab_results.py) if its Markdown was
+    just (re-)extracted or it has none yet. Errors are logged, not raised.
+    """
+    from lab_results import has_lab_results, update_document_lab_results
+
+    try:
+        if not extracted:
+            with db_connection() as conn:
+                if has_lab_results(conn, document_id):
+                    return
+        if publisher is not None:
+            publisher.set_stage("structuring")
+        count = update_document_lab_results(document_id, markdown)
+        logger.info(f"[worker] Stored {count} lab result(s) for document_id={document_id!r}")
+    except Exception as e:
+        logger.warning(f"[worker] Lab results for document_id={document_id!r} failed: {e}")
+
+
+def load_lab_facts(document_id: str) -> str:
+    """
+    Precomputed lab facts block for the document (lab_facts.py), "" if it
+    has no numeric results. Errors are logged, not raised.
+    """
+    from lab_facts import document_facts
+
+    try:
+        with span("lab_facts"), db_connection() as conn:
+            return document_facts(conn, document_id)
+    except Exception as e:
+        logger.warning(f"[worker] Lab facts for document_id={document_id!r} failed: {e}")
+        return ""
+
+
+def run_user_summary_pipeline(
+    job_id: str, user_id: str, rebuild: bool = False, worker_id: str | None = None
+) -> None:
+    """
+    Runs one claimed patient summary job:
+      1. Folds the user's new reports into their rolling summary record
+         (or rebuilds it), see patient_summary.py.
+      2. Generates the summary HTML from that record.
+      3. Saves record + HTML and marks the job completed, atomically.
+    """
+    logger.info(f"[worker] Starting patient summary for user_id={user_id!r}")
+
+    from patient_summary import generate_patient_summary, save_summary_state
+
+    html, record, covered_ids, prompt_hash, input_tokens = generate_patient_summary(
+        user_id, rebuild
+    )
+
+    with span("db_save"), db_connection() as conn:
+        save_summary_state(conn, user_id, record, covered_ids, prompt_hash)
+        stored = complete_user_summary_job(
+            conn, job_id, user_id, html, input_tokens, worker_id
+        )
+    if not stored:
+        logger.warning(f"[worker] Lease lost for summary job {job_id}; result discarded")
+        return
+    logger.info(f"[worker] Finished patient summary for user_id={user_id!r}")
+
+
+# -------------------------------------------------------------------
+# Worker loop
+# -------------------------------------------------------------------
+def process_one_job(bulk_slots: threading.Semaphore | None = None) -> bool:
+    """
+    Claim and run a single job, most urgent first:
+      1. interactive / normal document insights
+      2. interactive / normal patient summaries
+      3. bulk jobs (documents, then summaries), but only while one of this
+         process's bulk_slots is free, so bulk work never takes every
+         worker and interactive jobs don't queue behind it.
+    Returns False if there was nothing this worker may run.
+    """
+    worker_id = current_worker_id()
+    with db_connection() as conn:
+        document_id = claim_insights_job(
+            conn,
+            worker_id,
+            INSIGHTS_JOB_LEASE_SECONDS,
+            INSIGHTS_JOB_MAX_ATTEMPTS,
+            max_priority=PRIORITY_NORMAL,
+        )
+    if document_id is not None:
+        run_document_job(document_id, worker_id)
+        return True
+    if process_one_user_summary_job(max_priority=PRIORITY_NORMAL):
+        return True
+
+    if bulk_slots is not None and not bulk_slots.acquire(blocking=False):
+        return False
+    try:
+        # Model calls of bulk jobs also yield to interactive ones (llm_client)
+        with llm_client.priority("bulk"):
+            with db_connection() as conn:
+                document_id = claim_insights_job(
+                    conn,
+                    worker_id,
+                    INSIGHTS_JOB_LEASE_SECONDS,
+                    INSIGHTS_JOB_MAX_ATTEMPTS,
+                    min_priority=PRIORITY_BULK,
+                )
+            if document_id is not None:
+                run_document_job(document_id, worker_id)
+                return True
+            return process_one_user_summary_job(min_priority=PRIORITY_BULK)
+    finally:
+        if bulk_slots is not None:
+            bulk_slots.release()
+
+
+def run_document_job(document_id: str, worker_id: str) -> None:
+    """Run a claimed document insights job and record its outcome."""
+
+    def renew(conn):
+        return renew_insights_lease(conn, document_id, worker_id, INSIGHTS_JOB_LEASE_SECONDS)
+
+    try:
+        # One prompt version per job even if a prompt file is edited mid-job
+        with LeaseHeartbeat(renew), job_trace("document", document_id), pin_prompts():
+            run_insights_pipeline(document_id, worker_id)
+    except Exception as e:
+        logger.exception(
+            "[worker] Unhandled exception while generating insights for document_id=%s: %s",
+            document_id,
+            e,
+        )
+        try:
+            with db_connection() as conn:
+                fail_insights_job(conn, document_id, str(e), worker_id)
+        except Exception:
+            logger.exception(
+                f"[worker] Could not mark document_id={document_id} as failed"
+            )
+        publish_progress(document_id, "error", str(e))
+
+
+def process_one_user_summary_job(
+    min_priority: int = PRIORITY_INTERACTIVE, max_priority: int = PRIORITY_BULK
+) -> bool:
+    """Claim and run a single patient summary job in the priority range, if any."""
+    worker_id = current_worker_id()
+    with db_connection() as conn:
+        claimed = claim_user_summary_job(
+            conn,
+            worker_id,
+            INSIGHTS_JOB_LEASE_SECONDS,
+            INSIGHTS_JOB_MAX_ATTEMPTS,
+            min_priority=min_priority,
+            max_priority=max_priority,
+        )
+    if claimed is None:
+        return False
+
+    job_id, user_id, rebuild = claimed
+
+    def renew(conn):
+        return renew_user_summary_lease(conn, job_id, worker_id, INSIGHTS_JOB_LEASE_SECONDS)
+
+    try:
+        with LeaseHeartbeat(renew), job_trace("user_summary", job_id), pin_prompts():
+            run_user_summary_pipeline(job_id, user_id, rebuild, worker_id)
+    except Exception as e:
+        logger.exception(
+            "[worker] Unhandled exception while generating patient summary for user_id=%s: %s",
+            user_id,
+            e,
+        )
+        try:
+            with db_connection() as conn:
+                fail_user_summary_job(conn, job_id, str(e), worker_id)
+        except Exception:
+            logger.exception(f"[worker] Could not mark summary job {job_id} as failed")
+    return True
+
+
+def worker_loop(
+    worker_id: int,
+    stop_event: threading.Event,
+    bulk_slots: threading.Semaphore | None = None,
+) -> None:
+    """
+    Keep claiming jobs until stop_event is set. While the queue is empty,
+    sleep on a dedicated LISTEN connection (outside the pool, since it
+    stays subscribed) so new jobs are picked up immediately.
+    bulk_slots is shared by all worker threads of the process.
+    """
+    logger.info(f"[worker-{worker_id}] Started")
+
+    listen_conn = None
+    while not stop_event.is_set():
+        try:
+            if listen_conn is None or listen_conn.closed:
+                listen_conn = get_db_connection()
+                listen_conn.autocommit = True
+                listen_for_jobs(listen_conn)
+
+            # Drain the queue before going back to sleep
+            while not stop_event.is_set() and process_one_job(bulk_slots):
+                pass
+
+            wait_for_jobs(listen_conn, INSIGHTS_WORKER_POLL_SECONDS)
+        except Exception as e:
+            logger.exception(f"[worker-{worker_id}] Queue error: {e}")
+            if listen_conn is not None:
+                listen_conn.close()
+            listen_conn = None
+            stop_event.wait(INSIGHTS_WORKER_POLL_SECONDS)
+
+    if listen_conn is not None:
+        listen_conn.close()
+    logger.info(f"[worker-{worker_id}] Stopped")
+
+
+def run_workers(num_workers: int) -> None:
+    """Run `num_workers` worker threads until SIGINT/SIGTERM."""
+    stop_event = threading.Event()
+
+    def _shutdown(signum, frame):
+        logger.info("Shutdown requested; finishing in-flight jobs...")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, _shutdown)
+    signal.signal(signal.SIGTERM, _shutdown)
+
+    # Bulk jobs may occupy at most this many of the worker threads, and never
+    # all of them. A single worker has to run bulk jobs too (or they'd never
+    # run); it still claims interactive jobs first between any two jobs.
+    if num_workers == 1:
+        bulk_limit = 1
+    else:
+        bulk_limit = max(1, min(num_workers - 1, int(num_workers * BULK_MAX_SHARE)))
+    bulk_slots = threading.Semaphore(bulk_limit)
+    logger.info(f"Bulk jobs limited to {bulk_limit} of {num_workers} worker(s)")
+
+    threads = [
+        threading.Thread(
+            target=worker_loop,
+            args=(i, stop_event, bulk_slots),
+            name=f"insights-worker-{i}",
+        )
+        for i in range(num_workers)
+    ]
+    for t in threads:
+        t.start()
+
+    # Join with a timeout so the main thread keeps receiving signals
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(timeout=1.0)
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(levelname)s] %(asctime)s %(name)s - %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(description="Run insight generation workers.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=INSIGHTS_WORKER_COUNT,
+        help="Number of concurrent jobs in this process "
+        "(default: INSIGHTS_WORKER_COUNT from config/env)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=INSIGHTS_WORKER_METRICS_PORT,
+        help="Port for this process's Prometheus /metrics (0 disables; "
+        "default: INSIGHTS_WORKER_METRICS_PORT from config/env)",
+    )
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be >= 1")
+
+    # No per-token console output (or report text in logs) in the worker
+    set_default_sink(LogSink())
+
+    logger.info(f"Starting {args.workers} insights worker(s)")
+    # Read every prompt once now; later changes are picked up by mtime
+    logger.info(f"Loaded {get_registry().load_all()} prompt(s)")
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    if OLLAMA_PRELOAD:
+        # Load both models now (in the background) instead of on the first job
+        from extract_report_slm import VISION_MODEL
+
+        llm_client.preload_models({"vlm": VISION_MODEL, "slm": MODEL_NAME})
+    # Each worker borrows at most one pooled connection at a time, plus one
+    # for its lease heartbeat
+    init_db_pool(maxconn=max(DB_POOL_MAX, 2 * args.workers))
+    try:
+        run_workers(args.workers)
+    finally:
+        shutdown_cpu_pool()
+        close_db_pool()
+
+
+if __name__ == "__main__":
+    main()
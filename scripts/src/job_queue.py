@@ -0,0 +1,548 @@
+"""
+Postgres-backed work queue for insight generation.
+
+Two kinds of jobs share the same states and the same NOTIFY channel:
+    - document insights:  the `insights` row itself is the job
+    - patient summaries:  rows in `user_insight_jobs`
+
+The `insights` table doubles as the job table:
+    pending    -> queued, waiting for a worker
+    processing -> claimed by a worker
+    completed  -> html_insights is filled in
+    failed     -> error_message is filled in; re-enqueueing retries it
+
+Workers claim jobs with `SELECT ... FOR UPDATE SKIP LOCKED`, so any number of
+worker processes can poll the same table without handing out a job twice.
+Enqueueing sends a NOTIFY on JOBS_CHANNEL so idle workers wake up immediately
+instead of waiting for their next poll.
+
+A claim is a lease: the worker is recorded in `locked_by` and must renew
+`lease_expires_at` (heartbeat) while it runs. A 'processing' job whose lease
+ran out - the worker crashed or hung - is handed out again by the next
+claim, and marked failed once it has been attempted max_attempts times.
+Completing or failing a job with a worker_id only succeeds while that
+worker still holds the lease, so a reclaimed job can't be written twice.
+
+Every job has a priority class (PRIORITIES; lower runs first). Claims take
+the most urgent class first, then prefer users with the fewest jobs
+already running, so one user's bulk re-run can't starve everyone else,
+then the oldest job. Re-enqueueing a pending job with a more urgent
+priority upgrades it.
+"""
+
+import select
+
+from progress import PROGRESS_CHANNEL
+
+JOBS_CHANNEL = "insights_jobs"
+
+# Priority classes (smaller = more urgent)
+PRIORITY_INTERACTIVE = 0  # a user is waiting on the screen for this document
+PRIORITY_NORMAL = 1  # patient summaries
+PRIORITY_BULK = 2  # re-runs and backfills
+PRIORITIES = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "normal": PRIORITY_NORMAL,
+    "bulk": PRIORITY_BULK,
+}
+
+
+def enqueue_insights_job(
+    conn, document_id: str, priority: int = PRIORITY_INTERACTIVE
+) -> str | None:
+    """
+    Queue insight generation for a document.
+
+    - No insights row yet       -> inserts a 'pending' row.
+    - Existing 'failed' row     -> resets it to 'pending' (retry).
+    - Existing 'pending' row    -> priority is raised if this one is more urgent.
+    - Processing/completed rows are left untouched.
+
+    Returns the job status after the call, or None if the document
+    does not exist.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO insights (document_id, user_id, status, priority, created_at, updated_at)
+            SELECT d.id, d.user_id, 'pending', %(priority)s, NOW(), NOW()
+            FROM documents d
+            WHERE d.id = %(document_id)s
+            ON CONFLICT (document_id) DO UPDATE
+            SET status = 'pending', error_message = NULL, attempts = 0,
+                priority = EXCLUDED.priority, updated_at = NOW()
+            WHERE insights.status = 'failed'
+            RETURNING status
+            """,
+            {"document_id": document_id, "priority": priority},
+        )
+        row = cur.fetchone()
+        if row:
+            cur.execute(
+                "UPDATE documents SET processing_status = 'pending', last_error = NULL WHERE id = %s",
+                (document_id,),
+            )
+            cur.execute(f"NOTIFY {JOBS_CHANNEL}")
+        else:
+            cur.execute(
+                """
+                UPDATE insights SET priority = %s, updated_at = NOW()
+                WHERE document_id = %s AND status = 'pending' AND priority > %s
+                """,
+                (priority, document_id, priority),
+            )
+            cur.execute(
+                "SELECT status FROM insights WHERE document_id = %s", (document_id,)
+            )
+            row = cur.fetchone()
+    conn.commit()
+    return row[0] if row else None
+
+
+# A 'processing' job is expired once its lease ran out. Jobs claimed before
+# leases existed have no lease_expires_at; they count from updated_at.
+_LEASE_EXPIRED = """
+    status = 'processing'
+    AND COALESCE(lease_expires_at, updated_at + make_interval(secs => %(lease)s)) < NOW()
+"""
+
+
+def claim_insights_job(
+    conn,
+    worker_id: str,
+    lease_seconds: float,
+    max_attempts: int,
+    min_priority: int = PRIORITY_INTERACTIVE,
+    max_priority: int = PRIORITY_BULK,
+) -> str | None:
+    """
+    Atomically move the next 'pending' job - or a 'processing' job whose
+    lease expired - to 'processing', leased to worker_id for lease_seconds.
+    Only jobs with min_priority <= priority <= max_priority are considered;
+    see the module docstring for the order. Expired jobs that already had
+    max_attempts are marked failed instead, with an 'error' progress event
+    so open streams end.
+
+    Returns the claimed document_id, or None if the queue is empty.
+    """
+    params = {
+        "worker": worker_id,
+        "lease": lease_seconds,
+        "max_attempts": max_attempts,
+        "min_priority": min_priority,
+        "max_priority": max_priority,
+        "progress_channel": PROGRESS_CHANNEL,
+    }
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            WITH expired AS (
+                UPDATE insights
+                SET status = 'failed', locked_by = NULL, lease_expires_at = NULL,
+                    error_message = 'Job lease expired after ' || attempts || ' attempt(s)',
+                    updated_at = NOW()
+                WHERE {_LEASE_EXPIRED} AND attempts >= %(max_attempts)s
+                RETURNING document_id, error_message
+            ),
+            failed_documents AS (
+                UPDATE documents d
+                SET processing_status = 'failed', last_error = e.error_message,
+                    updated_at = NOW()
+                FROM expired e
+                WHERE d.id = e.document_id
+            )
+            -- Terminal event for SSE clients following these jobs (progress.py);
+            -- delivered on commit, together with the status change
+            SELECT pg_notify(
+                %(progress_channel)s,
+                json_build_object(
+                    'document_id', document_id::text, 'kind', 'error',
+                    'stage', '', 'data', error_message
+                )::text
+            )
+            FROM expired
+            """,
+            params,
+        )
+        cur.execute(
+            f"""
+            UPDATE insights
+            SET status = 'processing', locked_by = %(worker)s,
+                lease_expires_at = NOW() + make_interval(secs => %(lease)s),
+                attempts = attempts + 1, updated_at = NOW()
+            WHERE id = (
+                SELECT id FROM insights i
+                WHERE (status = 'pending' OR ({_LEASE_EXPIRED}))
+                  AND priority BETWEEN %(min_priority)s AND %(max_priority)s
+                ORDER BY priority,
+                         (SELECT COUNT(*) FROM insights r
+                          WHERE r.user_id = i.user_id AND r.status = 'processing'),
+                         created_at
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING document_id
+            """,
+            params,
+        )
+        row = cur.fetchone()
+    conn.commit()
+    return str(row[0]) if row else None
+
+
+def renew_insights_lease(
+    conn, document_id: str, worker_id: str, lease_seconds: float
+) -> bool:
+    """Extend worker_id's lease on a job. False if the lease was lost."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE insights
+            SET lease_expires_at = NOW() + make_interval(secs => %s)
+            WHERE document_id = %s AND status = 'processing' AND locked_by = %s
+            """,
+            (lease_seconds, document_id, worker_id),
+        )
+        renewed = cur.rowcount == 1
+    conn.commit()
+    return renewed
+
+
+def complete_insights_job(
+    conn, document_id: str, html: str, worker_id: str | None = None
+) -> bool:
+    """
+    Store the generated HTML and mark the job as completed.
+    With worker_id, only if that worker still holds the lease; returns
+    False (and writes nothing) otherwise.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE insights
+            SET html_insights = %(html)s, status = 'completed', error_message = NULL,
+                locked_by = NULL, lease_expires_at = NULL,
+                generated_at = NOW(), updated_at = NOW()
+            WHERE document_id = %(document_id)s
+              AND (%(worker)s::text IS NULL OR (status = 'processing' AND locked_by = %(worker)s))
+            """,
+            {"html": html, "document_id": document_id, "worker": worker_id},
+        )
+        if worker_id is not None and cur.rowcount == 0:
+            conn.rollback()
+            return False
+        cur.execute(
+            "UPDATE documents SET processing_status = 'done', last_error = NULL, updated_at = NOW() WHERE id = %s",
+            (document_id,),
+        )
+    conn.commit()
+    return True
+
+
+def fail_insights_job(
+    conn, document_id: str, error: str, worker_id: str | None = None
+) -> bool:
+    """
+    Mark the job as failed so it can be inspected and re-enqueued.
+    With worker_id, only if that worker still holds the lease.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE insights
+            SET status = 'failed', error_message = %(error)s,
+                locked_by = NULL, lease_expires_at = NULL, updated_at = NOW()
+            WHERE document_id = %(document_id)s
+              AND (%(worker)s::text IS NULL OR (status = 'processing' AND locked_by = %(worker)s))
+            """,
+            {"error": error, "document_id": document_id, "worker": worker_id},
+        )
+        if worker_id is not None and cur.rowcount == 0:
+            conn.rollback()
+            return False
+        cur.execute(
+            "UPDATE documents SET processing_status = 'failed', last_error = %s, updated_at = NOW() WHERE id = %s",
+            (error, document_id),
+        )
+    conn.commit()
+    return True
+
+
+def get_insights_job(conn, document_id: str) -> dict | None:
+    """
+    Return {"status", "html", "error"} for a document's insights job,
+    or None if no job exists. `html` is only set once completed.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT status, CASE WHEN status = 'completed' THEN html_insights END, error_message
+            FROM insights
+            WHERE document_id = %s
+            """,
+            (document_id,),
+        )
+        row = cur.fetchone()
+    if not row:
+        return None
+    return {"status": row[0], "html": row[1], "error": row[2]}
+
+
+def set_document_processing_status(conn, document_id: str, status: str) -> None:
+    """Update documents.processing_status (pending/extracting/insights_generating/...)."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE documents SET processing_status = %s, updated_at = NOW() WHERE id = %s",
+            (status, document_id),
+        )
+    conn.commit()
+
+
+# -------------------------------------------------------------------
+# Patient summary jobs (user_insight_jobs)
+# -------------------------------------------------------------------
+def enqueue_user_summary_job(
+    conn, user_id: str, rebuild: bool = False, priority: int = PRIORITY_NORMAL
+) -> str:
+    """
+    Queue a patient summary for a user and return the job id.
+    If the user already has a pending/processing job, that job is returned
+    (a pending one is upgraded to a full rebuild if `rebuild` is set, and to
+    `priority` if that is more urgent).
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO user_insight_jobs (user_id, status, rebuild, priority, created_at, updated_at)
+            VALUES (%s, 'pending', %s, %s, NOW(), NOW())
+            ON CONFLICT (user_id) WHERE status IN ('pending', 'processing') DO NOTHING
+            RETURNING id
+            """,
+            (user_id, rebuild, priority),
+        )
+        row = cur.fetchone()
+        if row:
+            cur.execute(f"NOTIFY {JOBS_CHANNEL}")
+        else:
+            cur.execute(
+                """
+                SELECT id FROM user_insight_jobs
+                WHERE user_id = %s AND status IN ('pending', 'processing')
+                """,
+                (user_id,),
+            )
+            row = cur.fetchone()
+            cur.execute(
+                """
+                UPDATE user_insight_jobs
+                SET rebuild = rebuild OR %s, priority = LEAST(priority, %s), updated_at = NOW()
+                WHERE id = %s AND status = 'pending' AND (priority > %s OR (%s AND NOT rebuild))
+                """,
+                (rebuild, priority, row[0], priority, rebuild),
+            )
+    conn.commit()
+    return str(row[0])
+
+
+def claim_user_summary_job(
+    conn,
+    worker_id: str,
+    lease_seconds: float,
+    max_attempts: int,
+    min_priority: int = PRIORITY_INTERACTIVE,
+    max_priority: int = PRIORITY_BULK,
+) -> tuple[str, str, bool] | None:
+    """
+    Atomically lease the next pending summary job (or one whose lease
+    expired) to worker_id, like claim_insights_job. A user has at most one
+    active summary job, so there is no per-user ordering here.
+
+    Returns (job_id, user_id, rebuild), or None if there is nothing to do.
+    """
+    params = {
+        "worker": worker_id,
+        "lease": lease_seconds,
+        "max_attempts": max_attempts,
+        "min_priority": min_priority,
+        "max_priority": max_priority,
+    }
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            UPDATE user_insight_jobs
+            SET status = 'failed', locked_by = NULL, lease_expires_at = NULL,
+                error_message = 'Job lease expired after ' || attempts || ' attempt(s)',
+                updated_at = NOW()
+            WHERE {_LEASE_EXPIRED} AND attempts >= %(max_attempts)s
+            """,
+            params,
+        )
+        cur.execute(
+            f"""
+            UPDATE user_insight_jobs
+            SET status = 'processing', locked_by = %(worker)s,
+                lease_expires_at = NOW() + make_interval(secs => %(lease)s),
+                attempts = attempts + 1, updated_at = NOW()
+            WHERE id = (
+                SELECT id FROM user_insight_jobs
+                WHERE (status = 'pending' OR ({_LEASE_EXPIRED}))
+                  AND priority BETWEEN %(min_priority)s AND %(max_priority)s
+                ORDER BY priority, created_at
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING id, user_id, rebuild
+            """,
+            params,
+        )
+        row = cur.fetchone()
+    conn.commit()
+    return (str(row[0]), str(row[1]), row[2]) if row else None
+
+
+def renew_user_summary_lease(
+    conn, job_id: str, worker_id: str, lease_seconds: float
+) -> bool:
+    """Extend worker_id's lease on a summary job. False if the lease was lost."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE user_insight_jobs
+            SET lease_expires_at = NOW() + make_interval(secs => %s)
+            WHERE id = %s AND status = 'processing' AND locked_by = %s
+            """,
+            (lease_seconds, job_id, worker_id),
+        )
+        renewed = cur.rowcount == 1
+    conn.commit()
+    return renewed
+
+
+def complete_user_summary_job(
+    conn,
+    job_id: str,
+    user_id: str,
+    html: str,
+    input_tokens: int | None = None,
+    worker_id: str | None = None,
+) -> bool:
+    """
+    Store the summary on the user and mark the job as completed.
+    With worker_id, only if that worker still holds the lease; otherwise
+    the whole transaction (including the caller's earlier writes) is
+    rolled back and False is returned.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE user_insight_jobs
+            SET status = 'completed', error_message = NULL, input_tokens = %(tokens)s,
+                locked_by = NULL, lease_expires_at = NULL, updated_at = NOW()
+            WHERE id = %(job_id)s
+              AND (%(worker)s::text IS NULL OR (status = 'processing' AND locked_by = %(worker)s))
+            """,
+            {"tokens": input_tokens, "job_id": job_id, "worker": worker_id},
+        )
+        if worker_id is not None and cur.rowcount == 0:
+            conn.rollback()
+            return False
+        cur.execute(
+            "UPDATE users SET patient_insights = %s WHERE id = %s",
+            (html, user_id),
+        )
+    conn.commit()
+    return True
+
+
+def fail_user_summary_job(
+    conn, job_id: str, error: str, worker_id: str | None = None
+) -> bool:
+    """Mark the summary job as failed (with worker_id: only while holding the lease)."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE user_insight_jobs
+            SET status = 'failed', error_message = %(error)s,
+                locked_by = NULL, lease_expires_at = NULL, updated_at = NOW()
+            WHERE id = %(job_id)s
+              AND (%(worker)s::text IS NULL OR (status = 'processing' AND locked_by = %(worker)s))
+            """,
+            {"error": error, "job_id": job_id, "worker": worker_id},
+        )
+        failed = cur.rowcount == 1
+    conn.commit()
+    return failed
+
+
+def get_user_summary_job(conn, job_id: str) -> dict | None:
+    """
+    Return {"job_id", "user_id", "status", "error", "input_tokens", "html"} for a job,
+    or None if it doesn't exist. `html` is only set once completed.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT j.id, j.user_id, j.status, j.error_message, j.input_tokens,
+                   CASE WHEN j.status = 'completed' THEN u.patient_insights END
+            FROM user_insight_jobs j
+            JOIN users u ON u.id = j.user_id
+            WHERE j.id = %s
+            """,
+            (job_id,),
+        )
+        row = cur.fetchone()
+    if not row:
+        return None
+    return {
+        "job_id": str(row[0]),
+        "user_id": str(row[1]),
+        "status": row[2],
+        "error": row[3],
+        "input_tokens": row[4],
+        "html": row[5],
+    }
+
+
+def get_queue_depths(conn) -> dict:
+    """
+    Count pending and processing jobs per queue.
+    Returns {("documents" | "user_summaries", status): count}.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT 'documents', status, COUNT(*) FROM insights
+            WHERE status IN ('pending', 'processing')
+            GROUP BY status
+            UNION ALL
+            SELECT 'user_summaries', status, COUNT(*) FROM user_insight_jobs
+            WHERE status IN ('pending', 'processing')
+            GROUP BY status
+            """
+        )
+        rows = cur.fetchall()
+    conn.commit()
+    depths = {
+        (queue, status): 0
+        for queue in ("documents", "user_summaries")
+        for status in ("pending", "processing")
+    }
+    depths.update({(queue, status): count for queue, status, count in rows})
+    return depths
+
+
+def listen_for_jobs(conn) -> None:
+    """Subscribe an autocommit connection to job notifications."""
+    with conn.cursor() as cur:
+        cur.execute(f"LISTEN {JOBS_CHANNEL}")
+
+
+def wait_for_jobs(conn, timeout: float) -> None:
+    """
+    Block until a job notification arrives or `timeout` seconds pass.
+    The connection must have called listen_for_jobs() first.
+    """
+    if select.select([conn], [], [], timeout) == ([], [], []):
+        return
+    conn.poll()
+    conn.notifies.clear()
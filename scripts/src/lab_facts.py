@@ -0,0 +1,238 @@
+"""
+Precomputed lab facts for the insight and summary prompts.
+
+Spotting out-of-range values and comparing readings across reports is
+arithmetic the text model does slowly and not always correctly. This module
+does it in Python from the `lab_results` rows (lab_results.py) and renders
+a compact block the model copies from instead of recomputing:
+
+    [PRECOMPUTED LAB FACTS]
+    Out of range (latest):
+    - Hemoglobin: 11.2 g/dL (L, ref 12.0 - 16.0) on 2024-09-22
+    Trends:
+    - Hemoglobin: 13.5 -> 12.1 -> 11.2 g/dL (2024-01-10 -> 2024-09-22, 3 readings);
+      change -2.3 (-17%), -3.23/year, falling; out of range 1 of 3
+    Within range (latest): Glucose, TSH
+    [END OF LAB FACTS]
+
+Readings of one analyte are grouped by test_key and unit (values in
+different units are never compared). The same value on the same date (one
+result seen in two uploaded documents) counts once, and only readings on
+at least two different dates make a trend. Flags use each reading's own
+reference range. Only numeric results take part; text results like
+"Negative" stay in the report for the model to read.
+"""
+
+from collections import defaultdict
+from datetime import date
+
+from config import LAB_FACTS_MAX_ITEMS
+
+# Relative change between first and last reading below which a series is "stable"
+STABLE_CHANGE = 0.05
+# Intermediate values listed in a trend line before it is shortened with "..."
+MAX_SERIES_VALUES = 5
+
+
+def _fmt(value: float) -> str:
+    return f"{value:.4g}"
+
+
+def flag(value: float | None, ref_low: float | None, ref_high: float | None) -> str | None:
+    """'H', 'L' or None for a numeric value against its reference range."""
+    if value is None:
+        return None
+    if ref_high is not None and value > ref_high:
+        return "H"
+    if ref_low is not None and value < ref_low:
+        return "L"
+    return None
+
+
+def slope_per_year(points: list[tuple[date, float]]) -> float | None:
+    """Least-squares slope of (date, value) points in units per year."""
+    if len({d for d, _ in points}) < 2:
+        return None
+    origin = points[0][0]
+    xs = [(d - origin).days / 365.25 for d, _ in points]
+    ys = [v for _, v in points]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    return sxy / sxx
+
+
+def summarize_analyte(rows: list[dict]) -> dict:
+    """
+    Facts for one analyte's numeric readings, oldest first. Readings
+    without a date are only used when none has one.
+    """
+    dated = [r for r in rows if r["observed_on"] is not None] or rows
+    first, last = dated[0], dated[-1]
+    flags = [flag(r["value_num"], r["ref_low"], r["ref_high"]) for r in dated]
+    dates = {r["observed_on"] for r in dated if r["observed_on"] is not None}
+
+    facts = {
+        "name": last["test_name"],
+        "unit": last["unit"],
+        "count": len(dated),
+        "dates": len(dates),
+        "values": [r["value_num"] for r in dated],
+        "first_value": first["value_num"],
+        "first_date": first["observed_on"],
+        "last_value": last["value_num"],
+        "last_date": last["observed_on"],
+        "last_flag": flags[-1],
+        "reference_range": last["reference_range"],
+        "out_of_range": sum(1 for f in flags if f),
+        "change": None,
+        "change_pct": None,
+        "slope_per_year": None,
+        "direction": None,
+    }
+    if len(dates) > 1:
+        change = last["value_num"] - first["value_num"]
+        facts["change"] = change
+        if first["value_num"]:
+            facts["change_pct"] = change / abs(first["value_num"])
+        scale = abs(first["value_num"]) or abs(last["value_num"]) or 1.0
+        if abs(change) / scale < STABLE_CHANGE:
+            facts["direction"] = "stable"
+        else:
+            facts["direction"] = "rising" if change > 0 else "falling"
+        facts["slope_per_year"] = slope_per_year(
+            [(r["observed_on"], r["value_num"]) for r in dated]
+        )
+    return facts
+
+
+def compute_facts(rows: list[dict], until: date | None = None) -> list[dict]:
+    """
+    Facts per analyte from load_user_lab_results() rows, ignoring readings
+    observed after `until`. Sorted by name.
+    """
+    groups = defaultdict(list)
+    seen = set()
+    for row in rows:
+        if row["value_num"] is None:
+            continue
+        if until is not None and row["observed_on"] is not None and row["observed_on"] > until:
+            continue
+        key = (row["test_key"], (row["unit"] or "").lower())
+        reading = (key, row["observed_on"], row["value_num"])
+        if reading in seen:
+            continue
+        seen.add(reading)
+        groups[key].append(row)
+
+    facts = []
+    for group in groups.values():
+        # Rows come ordered by date (undated first) from load_user_lab_results
+        group.sort(key=lambda r: (r["observed_on"] is not None, r["observed_on"] or date.min))
+        facts.append(summarize_analyte(group))
+    facts.sort(key=lambda f: f["name"].lower())
+    return facts
+
+
+# -------------------------------------------------------------------
+# Rendering
+# -------------------------------------------------------------------
+def _value_with_unit(value: float, unit: str | None) -> str:
+    return f"{_fmt(value)} {unit}" if unit else _fmt(value)
+
+
+def _series(values: list[float]) -> str:
+    if len(values) > MAX_SERIES_VALUES:
+        values = values[: MAX_SERIES_VALUES - 2] + [None] + values[-1:]
+    return " -> ".join("..." if v is None else _fmt(v) for v in values)
+
+
+def _trend_line(f: dict) -> str:
+    unit = f" {f['unit']}" if f["unit"] else ""
+    dates = ""
+    if f["first_date"] and f["last_date"]:
+        dates = f"{f['first_date'].isoformat()} -> {f['last_date'].isoformat()}, "
+    line = (
+        f"- {f['name']}: {_series(f['values'])}{unit} "
+        f"({dates}{f['count']} readings); change {f['change']:+.4g}"
+    )
+    if f["change_pct"] is not None:
+        line += f" ({f['change_pct']:+.0%})"
+    if f["slope_per_year"] is not None:
+        line += f", {f['slope_per_year']:+.3g}/year"
+    line += f", {f['direction']}"
+    if f["out_of_range"]:
+        line += f"; out of range {f['out_of_range']} of {f['count']}"
+    return line
+
+
+def format_facts(facts: list[dict], max_items: int = LAB_FACTS_MAX_ITEMS) -> str:
+    """
+    The facts block for a prompt, or "" when there are no numeric results.
+    Out-of-range analytes come first; at most max_items lines per section.
+    """
+    if not facts:
+        return ""
+    abnormal = [f for f in facts if f["last_flag"]]
+    trends = [f for f in facts if f["dates"] > 1]
+    normal = [f for f in facts if not f["last_flag"] and f["dates"] <= 1]
+
+    lines = ["[PRECOMPUTED LAB FACTS]"]
+    if abnormal:
+        lines.append("Out of range (latest):")
+        for f in abnormal[:max_items]:
+            ref = f", ref {f['reference_range']}" if f["reference_range"] else ""
+            on = f" on {f['last_date'].isoformat()}" if f["last_date"] else ""
+            lines.append(
+                f"- {f['name']}: {_value_with_unit(f['last_value'], f['unit'])} "
+                f"({f['last_flag']}{ref}){on}"
+            )
+    if trends:
+        lines.append("Trends:")
+        # Changing series first, stable ones last
+        trends.sort(key=lambda f: (f["direction"] == "stable", -abs(f["change_pct"] or 0)))
+        lines.extend(_trend_line(f) for f in trends[:max_items])
+    if normal:
+        names = ", ".join(f["name"] for f in normal[:max_items])
+        if len(normal) > max_items:
+            names += f" (+{len(normal) - max_items} more)"
+        lines.append(f"Within range (latest): {names}")
+    lines.append("[END OF LAB FACTS]")
+    return "\n".join(lines)
+
+
+# -------------------------------------------------------------------
+# DB entry points
+# -------------------------------------------------------------------
+def document_facts(conn, document_id: str) -> str:
+    """
+    Facts block for one document: its analytes, with the user's earlier
+    readings of them up to this document's latest result date.
+    """
+    from lab_results import load_user_lab_results
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT user_id::text, array_agg(DISTINCT test_key), max(observed_on)
+            FROM lab_results
+            WHERE document_id = %s
+            GROUP BY user_id
+            """,
+            (document_id,),
+        )
+        row = cur.fetchone()
+    conn.rollback()
+    if not row:
+        return ""
+    user_id, test_keys, until = row
+    rows = load_user_lab_results(conn, user_id, list(test_keys))
+    return format_facts(compute_facts(rows, until))
+
+
+def user_facts(conn, user_id: str) -> str:
+    """Facts block over all of a user's lab results (patient summary)."""
+    from lab_results import load_user_lab_results
+
+    return format_facts(compute_facts(load_user_lab_results(conn, user_id)))
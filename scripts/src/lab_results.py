@@ -0,0 +1,319 @@
+"""
+Structured lab results: extracted Markdown -> rows in `lab_results`.
+
+The text model is asked for JSON constrained to LAB_RESULTS_SCHEMA (Ollama
+`format=`), one call per chunk of the report so long documents stay well
+inside the context window. Each entry is then normalized in Python:
+
+    test_key          lowercased name without punctuation, for grouping
+                      the same analyte across reports ("HbA1c" -> "hba1c")
+    value_num         numeric value if the result is a number ("<5" -> 5,
+                      "12.0 H" -> 12.0)
+    ref_low/ref_high  bounds parsed from the reference range
+                      ("12.0 - 16.0", "< 200", "> 40")
+    observed_on       result date, else the report date, else the upload date
+
+Trend queries and patient summaries can then work on these compact rows
+instead of re-reading every report's Markdown.
+"""
+
+import json
+import logging
+import re
+from datetime import date, datetime
+
+from psycopg2.extras import execute_values
+
+import llm_client
+from config import LAB_RESULTS_CHUNK_TOKENS, LAB_RESULTS_PROMPT_FILE, MODEL_NAME, SLM_NUM_CTX
+from context_packing import estimate_tokens
+from metrics import record_llm_call, span
+from prompts import load_prompt_text
+from streaming import collect_chat_stream
+
+logger = logging.getLogger("lab_results")
+
+LAB_RESULTS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "report_date": {"type": ["string", "null"]},
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "test_name": {"type": "string"},
+                    "value": {"type": "string"},
+                    "unit": {"type": ["string", "null"]},
+                    "reference_range": {"type": ["string", "null"]},
+                    "date": {"type": ["string", "null"]},
+                },
+                "required": ["test_name", "value", "unit", "reference_range", "date"],
+            },
+        },
+    },
+    "required": ["report_date", "results"],
+}
+
+# A number with an optional comparison, e.g. "13.5", "<5", "≥ 1,200"
+_NUMBER_RE = re.compile(r"^\s*([<>≤≥]=?)?\s*([-+]?\d{1,3}(?:,\d{3})+|[-+]?\d+(?:[.,]\d+)?)\s*$")
+# Reference range forms: "12.0 - 16.0", "12–16", "< 200", "> 40", "up to 5"
+_RANGE_RE = re.compile(r"([-+]?\d+(?:[.,]\d+)?)\s*(?:-|–|—|to)\s*([-+]?\d+(?:[.,]\d+)?)")
+_UPPER_RE = re.compile(r"^\s*(?:<=?|≤|up to|below|less than)\s*([-+]?\d+(?:[.,]\d+)?)", re.I)
+_LOWER_RE = re.compile(r"^\s*(?:>=?|≥|above|more than|greater than)\s*([-+]?\d+(?:[.,]\d+)?)", re.I)
+# Trailing abnormal flag after a value, e.g. "12.0 H", "5.1 (L)", "200*", "7.9 ↑"
+_FLAG_RE = re.compile(
+    r"\s*(?:\(?(?:HH|LL|H|L|High|Low|A|Abnormal|Critical)\)?|\*+|↑|↓)\s*$", re.I
+)
+# "Male:", "Adult (>18 y):" ... qualifying one part of a reference range
+_QUALIFIER_RE = re.compile(r"[A-Za-z][^:;,\d<>≤≥]*:")
+_NON_ALNUM_RE = re.compile(r"[^0-9a-z]+")
+
+_DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%d/%m/%Y",
+    "%d-%m-%Y",
+    "%d.%m.%Y",
+    "%d %b %Y",
+    "%d %B %Y",
+    "%b %d, %Y",
+    "%B %d, %Y",
+)
+
+
+# -------------------------------------------------------------------
+# Normalization
+# -------------------------------------------------------------------
+def _to_float(text: str) -> float:
+    """'1,200' -> 1200.0, '13,5' -> 13.5"""
+    if re.fullmatch(r"[-+]?\d{1,3}(?:,\d{3})+", text):
+        return float(text.replace(",", ""))
+    return float(text.replace(",", "."))
+
+
+def parse_value(value: str) -> float | None:
+    """
+    Numeric value of a result, or None for text results like 'Negative'.
+    A trailing H / L (or similar) flag is ignored.
+    """
+    match = _NUMBER_RE.match(_FLAG_RE.sub("", value or "", count=1))
+    return _to_float(match.group(2)) if match else None
+
+
+def parse_reference_range(reference: str | None) -> tuple[float | None, float | None]:
+    """
+    (low, high) bounds of a reference range; either may be None. Ranges with
+    several qualified parts ("Male: 13-17, Female: 12-15") give (None, None):
+    which part applies is not known here, the raw text is kept for the model.
+    """
+    if not reference:
+        return None, None
+    if len(_QUALIFIER_RE.findall(reference)) > 1 or len(_RANGE_RE.findall(reference)) > 1:
+        return None, None
+    reference = _QUALIFIER_RE.sub("", reference, count=1)
+    match = _RANGE_RE.search(reference)
+    if match:
+        return _to_float(match.group(1)), _to_float(match.group(2))
+    match = _UPPER_RE.match(reference)
+    if match:
+        return None, _to_float(match.group(1))
+    match = _LOWER_RE.match(reference)
+    if match:
+        return _to_float(match.group(1)), None
+    return None, None
+
+
+def parse_date(text: str | None) -> date | None:
+    if not text:
+        return None
+    text = text.strip()
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def test_key(name: str) -> str:
+    """Grouping key for an analyte name."""
+    return _NON_ALNUM_RE.sub(" ", name.lower()).strip()
+
+
+def normalize_results(payload: dict, fallback_date: date | None = None) -> list[dict]:
+    """Turn one model response into lab_results rows (without ids)."""
+    report_date = parse_date(payload.get("report_date")) or fallback_date
+    rows = []
+    for item in payload.get("results") or []:
+        name = (item.get("test_name") or "").strip()
+        value = (item.get("value") or "").strip()
+        if not name or not value:
+            continue
+        reference = (item.get("reference_range") or "").strip() or None
+        ref_low, ref_high = parse_reference_range(reference)
+        rows.append(
+            {
+                "test_name": name,
+                "test_key": test_key(name),
+                "value_text": value,
+                "value_num": parse_value(value),
+                "unit": (item.get("unit") or "").strip() or None,
+                "reference_range": reference,
+                "ref_low": ref_low,
+                "ref_high": ref_high,
+                "observed_on": parse_date(item.get("date")) or report_date,
+            }
+        )
+    return rows
+
+
+# -------------------------------------------------------------------
+# Extraction
+# -------------------------------------------------------------------
+def chunk_markdown(markdown: str, budget_tokens: int = LAB_RESULTS_CHUNK_TOKENS) -> list[str]:
+    """
+    Split a report at blank lines into chunks of at most budget_tokens
+    (estimated). Tables have no blank lines, so they are never cut.
+    """
+    chunks = []
+    current = []
+    used = 0
+    for block in markdown.split("\n\n"):
+        if not block.strip():
+            continue
+        tokens = estimate_tokens(block)
+        if current and used + tokens > budget_tokens:
+            chunks.append("\n\n".join(current))
+            current, used = [], 0
+        current.append(block)
+        used += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def extract_lab_results(markdown: str, fallback_date: date | None = None) -> list[dict]:
+    """Ask the text model for the report's lab results and normalize them."""
+    prompt = load_prompt_text(LAB_RESULTS_PROMPT_FILE)
+    rows = []
+    report_date = fallback_date
+    for i, chunk in enumerate(chunk_markdown(markdown)):
+        messages = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": chunk},
+        ]
+        stats = {}
+        raw = collect_chat_stream(
+            llm_client.chat(
+                "slm",
+                MODEL_NAME,
+                messages,
+                options={"num_ctx": SLM_NUM_CTX, "temperature": 0},
+                format=LAB_RESULTS_SCHEMA,
+            ),
+            stats=stats,
+        )
+        record_llm_call("slm", MODEL_NAME, stats, label="lab_results")
+        try:
+            payload = json.loads(raw)
+        except ValueError:
+            logger.warning(f"Chunk {i + 1}: model returned invalid JSON, skipped")
+            continue
+        # A date printed in the header applies to results in later chunks
+        report_date = parse_date(payload.get("report_date")) or report_date
+        rows.extend(normalize_results(payload, report_date))
+    return rows
+
+
+# -------------------------------------------------------------------
+# Storage
+# -------------------------------------------------------------------
+def save_lab_results(conn, document_id: str, rows: list[dict]) -> None:
+    """Replace a document's lab results (caller commits)."""
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM lab_results WHERE document_id = %s", (document_id,))
+        if not rows:
+            return
+        execute_values(
+            cur,
+            """
+            INSERT INTO lab_results
+                (document_id, user_id, test_name, test_key, value_text, value_num,
+                 unit, reference_range, ref_low, ref_high, observed_on)
+            SELECT d.id, d.user_id, v.test_name, v.test_key, v.value_text, v.value_num,
+                   v.unit, v.reference_range, v.ref_low, v.ref_high, v.observed_on
+            FROM (VALUES %s) AS v(document_id, test_name, test_key, value_text, value_num,
+                                  unit, reference_range, ref_low, ref_high, observed_on)
+            JOIN documents d ON d.id = v.document_id::uuid
+            """,
+            [
+                (
+                    document_id,
+                    r["test_name"],
+                    r["test_key"],
+                    r["value_text"],
+                    r["value_num"],
+                    r["unit"],
+                    r["reference_range"],
+                    r["ref_low"],
+                    r["ref_high"],
+                    r["observed_on"],
+                )
+                for r in rows
+            ],
+            template="(%s, %s, %s, %s, %s::double precision, %s, %s, "
+            "%s::double precision, %s::double precision, %s::date)",
+        )
+
+
+def has_lab_results(conn, document_id: str) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM lab_results WHERE document_id = %s LIMIT 1", (document_id,))
+        found = cur.fetchone() is not None
+    conn.rollback()
+    return found
+
+
+def load_user_lab_results(conn, user_id: str, test_keys=None) -> list[dict]:
+    """
+    A user's numeric and text results ordered by analyte and date,
+    optionally only for some test_keys.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT document_id, test_name, test_key, value_text, value_num, unit,
+                   reference_range, ref_low, ref_high, observed_on
+            FROM lab_results
+            WHERE user_id = %s AND (%s::text[] IS NULL OR test_key = ANY(%s::text[]))
+            ORDER BY test_key, observed_on NULLS FIRST, created_at
+            """,
+            (user_id, test_keys, test_keys),
+        )
+        columns = [c[0] for c in cur.description]
+        rows = [dict(zip(columns, row)) for row in cur.fetchall()]
+    conn.rollback()
+    for row in rows:
+        row["document_id"] = str(row["document_id"])
+    return rows
+
+
+def update_document_lab_results(document_id: str, markdown: str) -> int:
+    """
+    Extract and store a document's lab results (worker / backfill entry
+    point). Results without a date fall back to the upload date.
+    Returns the number of rows stored.
+    """
+    from db import db_connection
+
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT uploaded_at FROM documents WHERE id = %s", (document_id,))
+        row = cur.fetchone()
+    uploaded_on = row[0].date() if row and row[0] else None
+
+    with span("lab_results"):
+        rows = extract_lab_results(markdown, uploaded_on)
+    with db_connection() as conn:
+        save_lab_results(conn, document_id, rows)
+        conn.commit()
+    return len(rows)
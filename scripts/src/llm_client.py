@@ -0,0 +1,256 @@
+"""
+Shared Ollama client layer.
+
+All model calls go through chat(role, model, messages, ...) instead of the
+module-level `ollama.chat`:
+
+    role "vlm" -> VLM_OLLAMA_ENDPOINTS   (qwen2.5vl page extraction)
+    role "slm" -> SLM_OLLAMA_ENDPOINTS   (insights, summaries, digests)
+
+Each role has an EndpointPool of ollama.Client instances, one per base URL,
+each with its own keep-alive HTTP connection pool. A request goes to the
+healthy endpoint with the fewest outstanding requests, and waits while
+every endpoint already runs OLLAMA_ENDPOINT_CONCURRENCY requests. An
+endpoint that refuses connections is skipped for ENDPOINT_RETRY_SECONDS
+and the request moves on to the next one.
+
+Every request passes keep_alive=OLLAMA_KEEP_ALIVE so models stay resident
+between jobs, and preload_models() loads them at service / worker startup
+so the first request after idle doesn't pay for a cold load.
+
+Requests made under `with priority("bulk"):` (or after
+set_default_priority("bulk") in a bulk-only process like the backfill) may
+hold at most BULK_MAX_SHARE of a pool's slots, and always yield to waiting
+interactive requests.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+import ollama
+
+from config import (
+    BULK_MAX_SHARE,
+    OLLAMA_ENDPOINT_CONCURRENCY,
+    OLLAMA_KEEP_ALIVE,
+    OLLAMA_REQUEST_TIMEOUT_SECONDS,
+    SLM_OLLAMA_ENDPOINTS,
+    VLM_OLLAMA_ENDPOINTS,
+)
+
+logger = logging.getLogger("llm_client")
+
+# How long an unreachable endpoint is skipped before it is tried again
+ENDPOINT_RETRY_SECONDS = 30
+
+# "interactive" or "bulk"; see priority()
+_priority = contextvars.ContextVar("llm_priority", default=None)
+_default_priority = "interactive"
+
+
+@contextmanager
+def priority(name: str):
+    """Run the model calls in this block (and its copied contexts) as `name`."""
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def set_default_priority(name: str) -> None:
+    """Priority of calls made outside any priority() block in this process."""
+    global _default_priority
+    _default_priority = name
+
+
+def current_priority() -> str:
+    return _priority.get() or _default_priority
+
+
+class Endpoint:
+    def __init__(self, url: str, max_concurrency: int):
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.down_until = 0.0
+        self.client = ollama.Client(
+            host=url,
+            timeout=OLLAMA_REQUEST_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency,
+            ),
+        )
+
+
+class EndpointPool:
+    """Least-outstanding-requests routing over a list of Ollama endpoints."""
+
+    def __init__(self, urls, max_concurrency: int = OLLAMA_ENDPOINT_CONCURRENCY):
+        if not urls:
+            raise ValueError("EndpointPool needs at least one Ollama endpoint")
+        self.endpoints = [Endpoint(url, max(1, max_concurrency)) for url in urls]
+        total_slots = sum(e.max_concurrency for e in self.endpoints)
+        self.bulk_cap = max(1, int(total_slots * BULK_MAX_SHARE))
+        self.bulk_outstanding = 0
+        self.interactive_waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, exclude=(), bulk: bool = False) -> Endpoint:
+        """
+        Reserve a slot on the least busy endpoint, waiting while all are at
+        their cap. Endpoints in `exclude` or marked down are avoided unless
+        nothing else is left. Bulk requests also wait while bulk_cap slots
+        are taken by bulk work or an interactive request is waiting.
+        """
+        with self._cond:
+            waiting = False
+            try:
+                while True:
+                    endpoint = self._pick(exclude)
+                    if endpoint is not None and (
+                        not bulk
+                        or (
+                            self.bulk_outstanding < self.bulk_cap
+                            and self.interactive_waiting == 0
+                        )
+                    ):
+                        endpoint.outstanding += 1
+                        if bulk:
+                            self.bulk_outstanding += 1
+                        return endpoint
+                    if not bulk and not waiting:
+                        waiting = True
+                        self.interactive_waiting += 1
+                    self._cond.wait()
+            finally:
+                if waiting:
+                    self.interactive_waiting -= 1
+                    self._cond.notify_all()
+
+    def _pick(self, exclude) -> Endpoint | None:
+        """Least busy endpoint with a free slot (called with the lock held)."""
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e not in exclude] or self.endpoints
+        healthy = [e for e in candidates if e.down_until <= now] or candidates
+        free = [e for e in healthy if e.outstanding < e.max_concurrency]
+        if not free:
+            return None
+        return min(free, key=lambda e: e.outstanding / e.max_concurrency)
+
+    def release(self, endpoint: Endpoint, bulk: bool = False) -> None:
+        with self._cond:
+            endpoint.outstanding -= 1
+            if bulk:
+                self.bulk_outstanding -= 1
+            # Waiters differ in what they wait for (bulk vs interactive)
+            self._cond.notify_all()
+
+    def mark_down(self, endpoint: Endpoint, error: Exception) -> None:
+        logger.warning(
+            f"Ollama endpoint {endpoint.url} unreachable ({error}); "
+            f"skipping it for {ENDPOINT_RETRY_SECONDS}s"
+        )
+        with self._cond:
+            endpoint.down_until = time.monotonic() + ENDPOINT_RETRY_SECONDS
+
+    def chat_stream(self, model: str, messages, options=None, format=None):
+        """
+        Streaming chat. The endpoint slot is taken when iteration starts and
+        released when the stream ends or is closed. Connection failures
+        before the first chunk fail over to the next endpoint.
+        """
+        bulk = current_priority() == "bulk"
+        tried = []
+        while True:
+            endpoint = self.acquire(exclude=tried, bulk=bulk)
+            started = False
+            try:
+                stream = endpoint.client.chat(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    options=options,
+                    format=format,
+                    keep_alive=OLLAMA_KEEP_ALIVE,
+                )
+                try:
+                    for chunk in stream:
+                        started = True
+                        yield chunk
+                finally:
+                    # Also runs when the caller closes us at an end marker
+                    stream.close()
+                return
+            except (httpx.ConnectError, httpx.ConnectTimeout, ConnectionError) as e:
+                if started:
+                    raise
+                self.mark_down(endpoint, e)
+                tried.append(endpoint)
+                if len(tried) >= len(self.endpoints):
+                    raise
+            finally:
+                self.release(endpoint, bulk)
+
+    def preload(self, model: str) -> None:
+        """Load `model` on every endpoint and keep it resident."""
+        for endpoint in self.endpoints:
+            started = time.perf_counter()
+            try:
+                # An empty prompt only loads the model
+                endpoint.client.generate(model=model, keep_alive=OLLAMA_KEEP_ALIVE)
+            except Exception as e:
+                logger.warning(f"Could not preload {model} on {endpoint.url}: {e}")
+                continue
+            logger.info(
+                f"Preloaded {model} on {endpoint.url} in {time.perf_counter() - started:.1f}s"
+            )
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_ROLE_ENDPOINTS = {"vlm": VLM_OLLAMA_ENDPOINTS, "slm": SLM_OLLAMA_ENDPOINTS}
+
+
+def get_pool(role: str) -> EndpointPool:
+    """Process-wide pool for "vlm" or "slm", created on first use."""
+    with _pools_lock:
+        pool = _pools.get(role)
+        if pool is None:
+            pool = EndpointPool(_ROLE_ENDPOINTS[role])
+            _pools[role] = pool
+        return pool
+
+
+def chat(role: str, model: str, messages, options=None, format=None):
+    """
+    Streaming chat through the role's endpoint pool. Returns an iterator of
+    chunks, like `ollama.chat(..., stream=True)`; pass it to
+    streaming.collect_chat_stream(), which closes it.
+    format: "json" or a JSON schema dict for constrained output.
+    """
+    return get_pool(role).chat_stream(model, messages, options, format)
+
+
+def preload_models(models: dict, background: bool = True):
+    """
+    Load models so they are resident before the first job.
+    models: {role: model_name}, e.g. {"vlm": VISION_MODEL, "slm": MODEL_NAME}.
+    Runs on a daemon thread unless background is False.
+    """
+
+    def _run():
+        for role, model in models.items():
+            get_pool(role).preload(model)
+
+    if not background:
+        _run()
+        return None
+    thread = threading.Thread(target=_run, name="ollama-preload", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,275 @@
+"""
+Per-stage timing and Prometheus metrics.
+
+span(stage) times a block of work. Every span is observed in the
+`insights_stage_duration_seconds` histogram and, while a job trace is
+active (job_trace()), appended to that job's list of spans, which is
+logged as one structured JSON line when the job finishes:
+
+    [trace] {"job": "document", "id": "...", "outcome": "completed",
+             "total_ms": 8123.4, "spans": [{"stage": "pdf_render", "ms": 41.2,
+             "page": 1}, {"stage": "vlm_decode", "ms": 3012.7, "tokens": 412,
+             "tokens_per_sec": 136.8}, ...]}
+
+The trace lives in a ContextVar; code that hands work to a thread pool
+submits it through contextvars.copy_context().run so page spans land in
+the right job.
+
+record_llm_call() turns the stats collected by streaming.collect_chat_stream
+(time to first token and Ollama's eval_count / eval_duration from the final
+chunk) into <prefix>_ttft / <prefix>_decode spans plus token metrics.
+
+prometheus_client is optional: without it spans are still traced and
+logged, and metrics_response() reports that metrics are unavailable.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Gauge, Histogram
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger("metrics")
+
+# From a fast DB lookup up to a long multi-page extraction
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 35, 50, 75, 100, 150, 200, 300, 500)
+
+if prometheus_client is not None:
+    STAGE_DURATION = Histogram(
+        "insights_stage_duration_seconds",
+        "Duration of one pipeline stage",
+        ["stage"],
+        buckets=STAGE_BUCKETS,
+    )
+    LLM_TOKENS = Counter(
+        "insights_llm_tokens_total",
+        "Tokens processed by the models",
+        ["model", "kind"],  # kind: prompt | completion
+    )
+    LLM_TOKENS_PER_SECOND = Histogram(
+        "insights_llm_tokens_per_second",
+        "Decode speed per model call (Ollama eval_count / eval_duration)",
+        ["model"],
+        buckets=TOKENS_PER_SECOND_BUCKETS,
+    )
+    JOBS = Counter(
+        "insights_jobs_total",
+        "Finished jobs",
+        ["job", "outcome"],
+    )
+    CACHE_LOOKUPS = Counter(
+        "insights_cache_lookups_total",
+        "Result cache lookups",
+        ["cache", "result"],  # result: memory_hit | store_hit | miss
+    )
+    JOBS_IN_FLIGHT = Gauge(
+        "insights_jobs_in_flight",
+        "Jobs currently running in this process",
+        ["job"],
+        multiprocess_mode="livesum",
+    )
+
+_current_trace = contextvars.ContextVar("insights_job_trace", default=None)
+
+
+class JobTrace:
+    """Spans of one job; appended to from several threads."""
+
+    def __init__(self, job: str, job_id: str):
+        self.job = job
+        self.job_id = job_id
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float, fields: dict) -> None:
+        span = {"stage": stage, "ms": round(seconds * 1000, 1)}
+        span.update({k: v for k, v in fields.items() if v is not None})
+        with self._lock:
+            self.spans.append(span)
+
+
+def observe_stage(stage: str, seconds: float, **fields) -> None:
+    """Record an already-measured stage duration."""
+    if prometheus_client is not None:
+        STAGE_DURATION.labels(stage).observe(seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds, fields)
+
+
+def observe_total(stage: str, seconds: float) -> None:
+    """Histogram only, for totals that shouldn't appear as a span."""
+    if prometheus_client is not None:
+        STAGE_DURATION.labels(stage).observe(seconds)
+
+
+@contextmanager
+def span(stage: str, **fields):
+    """
+    Time the enclosed block as `stage`. Extra fields (page number, ...)
+    go into the job trace only, never into metric labels.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started, **fields)
+
+
+@contextmanager
+def job_trace(job: str, job_id: str):
+    """
+    Collect the spans of one job (job: "document" | "user_summary"),
+    count it, and log the trace when it finishes or fails.
+    """
+    trace = JobTrace(job, job_id)
+    token = _current_trace.set(trace)
+    if prometheus_client is not None:
+        JOBS_IN_FLIGHT.labels(job).inc()
+    started = time.perf_counter()
+    outcome = "failed"
+    try:
+        yield trace
+        outcome = "completed"
+    finally:
+        total = time.perf_counter() - started
+        _current_trace.reset(token)
+        if prometheus_client is not None:
+            JOBS_IN_FLIGHT.labels(job).dec()
+            JOBS.labels(job, outcome).inc()
+        observe_total(f"{job}_total", total)
+        logger.info(
+            "[trace] %s",
+            json.dumps(
+                {
+                    "job": job,
+                    "id": job_id,
+                    "outcome": outcome,
+                    "total_ms": round(total * 1000, 1),
+                    "spans": trace.spans,
+                }
+            ),
+        )
+
+
+def record_llm_call(prefix: str, model: str, stats: dict, **fields) -> None:
+    """
+    Record one streamed model call from collect_chat_stream() stats as
+    `<prefix>_ttft` (request -> first token) and `<prefix>_decode`
+    (first token -> last token) spans, plus token counters.
+    """
+    if stats.get("ttft_seconds") is not None:
+        observe_stage(f"{prefix}_ttft", stats["ttft_seconds"], **fields)
+
+    tokens = stats.get("eval_count")
+    eval_seconds = stats.get("eval_seconds")
+    tokens_per_sec = round(tokens / eval_seconds, 1) if tokens and eval_seconds else None
+    observe_stage(
+        f"{prefix}_decode",
+        stats.get("decode_seconds") or 0.0,
+        tokens=tokens,
+        prompt_tokens=stats.get("prompt_eval_count"),
+        tokens_per_sec=tokens_per_sec,
+        **fields,
+    )
+
+    if prometheus_client is None:
+        return
+    if tokens:
+        LLM_TOKENS.labels(model, "completion").inc(tokens)
+    if stats.get("prompt_eval_count"):
+        LLM_TOKENS.labels(model, "prompt").inc(stats["prompt_eval_count"])
+    if tokens_per_sec:
+        LLM_TOKENS_PER_SECOND.labels(model).observe(tokens_per_sec)
+
+
+def record_cache_lookup(cache: str, result: str) -> None:
+    """Count one lookup of a result cache (e.g. cache="insights")."""
+    if prometheus_client is not None:
+        CACHE_LOOKUPS.labels(cache, result).inc()
+
+
+# -------------------------------------------------------------------
+# Exposition
+# -------------------------------------------------------------------
+def metrics_response(extra_collectors=()) -> tuple[bytes, str, int]:
+    """
+    Render all metrics in the Prometheus text format.
+    Returns (body, content_type, status_code).
+
+    With PROMETHEUS_MULTIPROC_DIR set (shared by service and workers on
+    one host) the metrics of every process are aggregated.
+    """
+    if prometheus_client is None:
+        return b"prometheus_client is not installed\n", "text/plain", 503
+
+    from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = CollectorRegistry()
+        registry.register(_DefaultRegistryCollector())
+    for collector in extra_collectors:
+        registry.register(collector)
+    return generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST, 200
+
+
+class QueueDepthCollector:
+    """
+    Gauges read from the job tables at scrape time, so they are correct
+    across all worker processes:
+        insights_queue_jobs{queue, status}   pending / processing jobs
+    `load` returns {(queue, status): count}.
+    """
+
+    def __init__(self, load):
+        self.load = load
+
+    def collect(self):
+        from prometheus_client.core import GaugeMetricFamily
+
+        gauge = GaugeMetricFamily(
+            "insights_queue_jobs",
+            "Jobs waiting (pending) or running (processing), from the job tables",
+            labels=["queue", "status"],
+        )
+        try:
+            depths = self.load()
+        except Exception as e:
+            logger.warning(f"Could not read queue depth: {e}")
+            depths = {}
+        for (queue, status), count in sorted(depths.items()):
+            gauge.add_metric([queue, status], count)
+        yield gauge
+
+
+class _DefaultRegistryCollector:
+    """Expose the default registry inside a per-request registry."""
+
+    def collect(self):
+        return prometheus_client.REGISTRY.collect()
+
+
+def start_metrics_server(port: int) -> bool:
+    """Serve /metrics on its own port (used by the worker). Returns success."""
+    if prometheus_client is None:
+        logger.warning("prometheus_client is not installed; worker metrics disabled")
+        return False
+    try:
+        prometheus_client.start_http_server(port)
+    except OSError as e:
+        logger.warning(f"Could not serve worker metrics on port {port}: {e}")
+        return False
+    logger.info(f"Worker metrics on http://0.0.0.0:{port}/metrics")
+    return True
@@ -0,0 +1,378 @@
+"""
+Incremental patient summaries.
+
+Instead of concatenating every report of a user into one prompt, each user
+has a rolling Markdown record in `user_summary_state` together with the ids
+of the documents it already covers (the watermark):
+
+    new reports   = user's extracted documents - covered_document_ids
+    record        = fold(previous record, new reports)      # state prompt
+    summary HTML  = generate_insights_html(record)           # summary prompt
+
+Only the delta plus the previous record go to the model. The record is
+rebuilt from scratch when there is no record yet, the state prompt or model
+changed, a covered document was removed, the record itself has grown past
+half of the input budget, or the caller asks for it.
+
+Every call is kept within PATIENT_SUMMARY_MAX_INPUT_TOKENS (see
+context_packing.py): the newest / most relevant reports go in verbatim,
+older ones as cached per-document digests. Only if even the digests don't
+fit are the reports folded chunk by chunk (map-reduce on rebuild).
+"""
+
+import logging
+
+from config import (
+    LAB_FACTS_ENABLED,
+    MODEL_NAME,
+    PATIENT_SUMMARY_MAX_INPUT_TOKENS,
+    PATIENT_SUMMARY_PROMPT_FILE,
+    PATIENT_SUMMARY_STATE_PROMPT_FILE,
+    REPORT_DIGEST_PROMPT_FILE,
+)
+from context_packing import estimate_tokens, pack_reports
+from db import db_connection
+from prompts import get_prompt, load_prompt_text
+
+logger = logging.getLogger("patient_summary")
+
+
+def format_reports(docs) -> str:
+    """
+    Render (document_id, markdown, uploaded_at) rows as dated report blocks,
+    in the same layout the patient summary prompt has always received.
+    """
+    parts = []
+    for i, (_doc_id, markdown, uploaded_at) in enumerate(docs):
+        date_str = uploaded_at.strftime("%Y-%m-%d") if uploaded_at else "Unknown Date"
+        parts.append(f"\n[REPORT {i + 1} - {date_str}]\n{markdown}\n")
+    parts.append("\n[END OF REPORTS]\n")
+    return "".join(parts)
+
+
+def chunk_reports(docs, budget_tokens: int):
+    """
+    Split docs (in order) into chunks whose formatted size fits the budget.
+    A single report larger than the budget gets a chunk of its own.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+    for doc in docs:
+        doc_tokens = estimate_tokens(format_reports([doc]))
+        if current and current_tokens + doc_tokens > budget_tokens:
+            chunks.append(current)
+            current = []
+            current_tokens = 0
+        current.append(doc)
+        current_tokens += doc_tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def fold_into_record(
+    previous_record: str, new_material: str, state_prompt: str, usage: dict
+) -> str:
+    """One state-prompt call: merge new reports/records into the previous record."""
+    from generate_insights_txt import generate_insights
+
+    user_content = (
+        f"[PREVIOUS RECORD]\n{previous_record or '(empty)'}\n\n"
+        f"[NEW REPORTS]\n{new_material}"
+    )
+    usage["input_tokens"] += estimate_tokens(state_prompt) + estimate_tokens(user_content)
+    return generate_insights(state_prompt, user_content).strip()
+
+
+def fold_packed(record: str, docs, state_prompt: str, compress, usage: dict) -> str | None:
+    """
+    Try to fold all docs into the record in a single call by packing them
+    (verbatim or as digests) into the remaining budget.
+    Returns None if some report would have to be dropped.
+    """
+    # The report headers format_reports() adds around the packed texts
+    headers = format_reports([(doc_id, "", uploaded_at) for doc_id, _md, uploaded_at in docs])
+    budget = (
+        PATIENT_SUMMARY_MAX_INPUT_TOKENS
+        - estimate_tokens(state_prompt)
+        - estimate_tokens(record)
+        - estimate_tokens(headers)
+    )
+    packed, stats = pack_reports(docs, budget, compress)
+    logger.info(
+        "[summary] Packed %d report(s): %d full, %d digest, %d over budget (%d tokens)",
+        len(docs),
+        stats["full"],
+        stats["compressed"],
+        stats["dropped"],
+        stats["tokens"],
+    )
+    if stats["dropped"]:
+        return None
+    return fold_into_record(record, format_reports(packed), state_prompt, usage)
+
+
+def merge_partial_records(left, right, state_prompt: str, compress, usage: dict):
+    """
+    Reduce step of build_record: merge two (record, docs) partial records.
+    Two records that don't fit into one call together are rebuilt from
+    their reports instead (older ones as digests); if not even the digests
+    fit, the right side's digests are folded into the left record chunk by
+    chunk.
+    """
+    (left_record, left_docs), (right_record, right_docs) = left, right
+    docs = left_docs + right_docs
+    budget = PATIENT_SUMMARY_MAX_INPUT_TOKENS - estimate_tokens(state_prompt)
+    if estimate_tokens(left_record) + estimate_tokens(right_record) <= budget:
+        return fold_into_record(left_record, right_record, state_prompt, usage), docs
+
+    logger.info(
+        f"[summary] Partial records of {len(left_docs)} + {len(right_docs)} report(s) "
+        "don't fit one call; rebuilding them from digests"
+    )
+    record = fold_packed("", docs, state_prompt, compress, usage)
+    if record is not None:
+        return record, docs
+    digests = [(doc[0], compress(doc) or doc[1], doc[2]) for doc in right_docs]
+    return update_record(left_record, digests, state_prompt, None, usage), docs
+
+
+def build_record(docs, state_prompt: str, compress, usage: dict) -> str:
+    """
+    Full rebuild. Packs all reports into one call when possible; otherwise
+    maps each chunk of reports to a partial record, then reduces partial
+    records pairwise until one remains (see merge_partial_records).
+    """
+    record = fold_packed("", docs, state_prompt, compress, usage)
+    if record is not None:
+        return record
+
+    budget = PATIENT_SUMMARY_MAX_INPUT_TOKENS - estimate_tokens(state_prompt)
+    # (record, the reports it covers)
+    records = [
+        (fold_into_record("", format_reports(chunk), state_prompt, usage), chunk)
+        for chunk in chunk_reports(docs, budget)
+    ]
+    logger.info(f"[summary] Rebuild: {len(docs)} report(s) -> {len(records)} partial record(s)")
+
+    while len(records) > 1:
+        merged = []
+        for i in range(0, len(records), 2):
+            if i + 1 < len(records):
+                merged.append(
+                    merge_partial_records(
+                        records[i], records[i + 1], state_prompt, compress, usage
+                    )
+                )
+            else:
+                merged.append(records[i])
+        records = merged
+    return records[0][0] if records else ""
+
+
+def update_record(record: str, new_docs, state_prompt: str, compress, usage: dict) -> str:
+    """Incremental update: fold new reports into the record, in one call if they fit."""
+    packed_record = fold_packed(record, new_docs, state_prompt, compress, usage)
+    if packed_record is not None:
+        return packed_record
+
+    remaining = list(new_docs)
+    while remaining:
+        # The record grows with every chunk, so size each chunk anew
+        budget = (
+            PATIENT_SUMMARY_MAX_INPUT_TOKENS
+            - estimate_tokens(state_prompt)
+            - estimate_tokens(record)
+        )
+        if budget <= 0:
+            logger.warning(
+                "[summary] Record alone exceeds PATIENT_SUMMARY_MAX_INPUT_TOKENS; "
+                "the state prompt may be truncated"
+            )
+        chunk = chunk_reports(remaining, max(budget, 1))[0]
+        record = fold_into_record(record, format_reports(chunk), state_prompt, usage)
+        remaining = remaining[len(chunk):]
+    return record
+
+
+# -------------------------------------------------------------------
+# DB helpers
+# -------------------------------------------------------------------
+def load_summary_inputs(user_id: str):
+    """
+    Returns (docs, state, existing_html):
+      docs           -> [(document_id, markdown, uploaded_at), ...] oldest first
+      state          -> {"summary_markdown", "covered_document_ids", "prompt_hash",
+                         "model_name"} or None
+      existing_html  -> users.patient_insights
+    """
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id::text, extracted_markdown, uploaded_at
+            FROM documents
+            WHERE user_id = %s AND extracted_markdown IS NOT NULL AND extracted_markdown != ''
+            ORDER BY uploaded_at ASC
+            """,
+            (user_id,),
+        )
+        docs = cur.fetchall()
+
+        cur.execute(
+            """
+            SELECT summary_markdown, covered_document_ids::text[], prompt_hash, model_name
+            FROM user_summary_state
+            WHERE user_id = %s
+            """,
+            (user_id,),
+        )
+        row = cur.fetchone()
+        state = None
+        if row:
+            state = {
+                "summary_markdown": row[0],
+                "covered_document_ids": list(row[1] or []),
+                "prompt_hash": row[2],
+                "model_name": row[3],
+            }
+
+        cur.execute("SELECT patient_insights FROM users WHERE id = %s", (user_id,))
+        user_row = cur.fetchone()
+    return docs, state, (user_row[0] if user_row else None)
+
+
+def make_digest_compressor(usage: dict):
+    """
+    Returns compress(doc) -> digest for pack_reports. Digests are cached in
+    documents.digest_markdown and regenerated when the digest prompt changes.
+    """
+    from generate_insights_txt import generate_insights
+
+    prompt = get_prompt(REPORT_DIGEST_PROMPT_FILE)
+    digest_prompt, digest_hash = prompt.text, prompt.version
+
+    def compress(doc) -> str:
+        doc_id = doc[0]
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT digest_markdown, digest_prompt_hash FROM documents WHERE id = %s",
+                (doc_id,),
+            )
+            row = cur.fetchone()
+        if row and row[0] and row[1] == digest_hash:
+            return row[0]
+
+        report = format_reports([doc])
+        usage["input_tokens"] += estimate_tokens(digest_prompt) + estimate_tokens(report)
+        digest = generate_insights(digest_prompt, report).strip()
+
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE documents SET digest_markdown = %s, digest_prompt_hash = %s
+                    WHERE id = %s
+                    """,
+                    (digest, digest_hash, doc_id),
+                )
+            conn.commit()
+        return digest
+
+    return compress
+
+
+def save_summary_state(conn, user_id: str, record: str, covered_ids, prompt_hash: str) -> None:
+    """Upsert the rolling record and its watermark (caller commits)."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO user_summary_state
+                (user_id, summary_markdown, covered_document_ids, prompt_hash, model_name, updated_at)
+            VALUES (%s, %s, %s::uuid[], %s, %s, NOW())
+            ON CONFLICT (user_id) DO UPDATE SET
+                summary_markdown = EXCLUDED.summary_markdown,
+                covered_document_ids = EXCLUDED.covered_document_ids,
+                prompt_hash = EXCLUDED.prompt_hash,
+                model_name = EXCLUDED.model_name,
+                updated_at = NOW()
+            """,
+            (user_id, record, list(covered_ids), prompt_hash, MODEL_NAME),
+        )
+
+
+def load_user_facts(user_id: str) -> str:
+    """Precomputed lab facts over all of the user's reports (lab_facts.py)."""
+    from lab_facts import user_facts
+
+    try:
+        with db_connection() as conn:
+            return user_facts(conn, user_id)
+    except Exception as e:
+        logger.warning(f"[summary] Lab facts for user_id={user_id!r} failed: {e}")
+        return ""
+
+
+# -------------------------------------------------------------------
+# Entry point used by the worker
+# -------------------------------------------------------------------
+def generate_patient_summary(user_id: str, rebuild: bool = False):
+    """
+    Bring the user's rolling record up to date and render the summary HTML.
+
+    Returns (html, record, covered_document_ids, prompt_hash, input_tokens).
+    Apart from cached report digests nothing is written to the DB; the
+    caller stores the record together with the HTML via save_summary_state()
+    in the same transaction that completes the job. input_tokens is the
+    estimated number of prompt tokens sent to the model for this summary.
+    """
+    from generate_insights_txt import generate_insights_html
+
+    docs, state, existing_html = load_summary_inputs(user_id)
+    if not docs:
+        raise LookupError("No documents with extracted markdown found for this user.")
+
+    prompt = get_prompt(PATIENT_SUMMARY_STATE_PROMPT_FILE)
+    state_prompt, prompt_hash = prompt.text, prompt.version
+    doc_ids = [doc[0] for doc in docs]
+    usage = {"input_tokens": 0}
+    compress = make_digest_compressor(usage)
+
+    reason = None
+    if rebuild:
+        reason = "requested"
+    elif state is None:
+        reason = "no previous record"
+    elif state["prompt_hash"] != prompt_hash or state["model_name"] != MODEL_NAME:
+        reason = "prompt/model changed"
+    elif not set(state["covered_document_ids"]) <= set(doc_ids):
+        reason = "covered document removed"
+    elif estimate_tokens(state["summary_markdown"]) > PATIENT_SUMMARY_MAX_INPUT_TOKENS // 2:
+        reason = "record too large for context"
+
+    if reason is not None:
+        logger.info(f"[summary] Full rebuild for user_id={user_id!r} ({reason})")
+        record = build_record(docs, state_prompt, compress, usage)
+    else:
+        covered = set(state["covered_document_ids"])
+        new_docs = [doc for doc in docs if doc[0] not in covered]
+        if not new_docs and existing_html:
+            logger.info(f"[summary] No new reports for user_id={user_id!r}; summary is current")
+            return existing_html, state["summary_markdown"], doc_ids, prompt_hash, 0
+        logger.info(
+            f"[summary] Incremental update for user_id={user_id!r}: {len(new_docs)} new report(s)"
+        )
+        record = update_record(state["summary_markdown"], new_docs, state_prompt, compress, usage)
+
+    summary_prompt = load_prompt_text(PATIENT_SUMMARY_PROMPT_FILE)
+    summary_input = f"[PATIENT RECORD - {len(docs)} report(s)]\n{record}\n[END OF RECORD]\n"
+    facts = load_user_facts(user_id) if LAB_FACTS_ENABLED else ""
+    if facts:
+        summary_input = f"{facts}\n\n{summary_input}"
+    usage["input_tokens"] += estimate_tokens(summary_prompt) + estimate_tokens(summary_input)
+    html = generate_insights_html(summary_input, prompt=summary_prompt)
+
+    logger.info(
+        f"[summary] user_id={user_id!r}: ~{usage['input_tokens']} input tokens sent"
+    )
+    return html, record, doc_ids, prompt_hash, usage["input_tokens"]
@@ -0,0 +1,215 @@
+"""
+Live progress of insight jobs, from the worker process to SSE clients.
+
+Worker side:  ProgressPublisher is a CallbackSink callback. It batches
+              tokens and sends them with pg_notify() on PROGRESS_CHANNEL.
+Service side: ProgressHub keeps one LISTEN connection and fans events out
+              to per-client asyncio queues (see the /stream endpoint in
+              insights_service.py).
+
+Event payload (JSON):
+    {"document_id": "...", "kind": "...", "stage": "...", "data": "..."}
+
+kind:
+    status  -> data is the new documents.processing_status
+    event   -> progress message, e.g. "Processing report.pdf - page 2/5"
+    token   -> a batch of generated text for the current stage
+    done    -> job completed (fetch the HTML from the DB)
+    error   -> job failed, data is the error message
+
+Progress is best effort: failing to publish never fails a job, and a
+client that connects late simply starts from the current DB status.
+"""
+
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+
+from db import db_connection, get_db_connection
+
+logger = logging.getLogger("progress")
+
+PROGRESS_CHANNEL = "insights_progress"
+
+# NOTIFY payloads must stay below 8000 bytes; 1000 chars leaves room for
+# multi-byte characters and the JSON envelope.
+MAX_BATCH_CHARS = 1000
+FLUSH_INTERVAL_SECONDS = 0.25
+# Event kinds a slow SSE client may miss, cheapest first (see ProgressHub._offer)
+DROPPABLE_KINDS = ("token", "event")
+
+
+def publish_progress(document_id: str, kind: str, data: str = "", stage: str = "") -> None:
+    """Send one progress event. Errors are logged, never raised."""
+    payload = json.dumps(
+        {"document_id": document_id, "kind": kind, "stage": stage, "data": data},
+        ensure_ascii=False,
+    )
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_notify(%s, %s)", (PROGRESS_CHANNEL, payload))
+            conn.commit()
+    except Exception as e:
+        logger.warning(f"Could not publish progress for document_id={document_id}: {e}")
+
+
+class ProgressPublisher:
+    """
+    Callback for streaming.CallbackSink: callback(kind, data).
+
+    Tokens are buffered and sent at most every FLUSH_INTERVAL_SECONDS (or
+    when the batch reaches MAX_BATCH_CHARS), so a job costs a few NOTIFYs
+    per second rather than one per token.
+    """
+
+    def __init__(self, document_id: str):
+        self.document_id = document_id
+        self.stage = ""
+        self._buffer = []
+        self._buffered_chars = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, kind: str, data: str) -> None:
+        if kind == "token":
+            with self._lock:
+                self._buffer.append(data)
+                self._buffered_chars += len(data)
+                due = (
+                    self._buffered_chars >= MAX_BATCH_CHARS
+                    or time.monotonic() - self._last_flush >= FLUSH_INTERVAL_SECONDS
+                )
+            if due:
+                self.flush()
+        else:
+            self.publish(kind, data)
+
+    def set_stage(self, stage: str) -> None:
+        """Flush the previous stage's tokens and announce the new stage."""
+        self.flush()
+        self.stage = stage
+        self.publish("status", stage)
+
+    def publish(self, kind: str, data: str = "") -> None:
+        self.flush()
+        publish_progress(self.document_id, kind, data, self.stage)
+
+    def flush(self) -> None:
+        with self._lock:
+            text = "".join(self._buffer)
+            self._buffer = []
+            self._buffered_chars = 0
+            self._last_flush = time.monotonic()
+        # A batch can exceed the limit when a single token is huge
+        for i in range(0, len(text), MAX_BATCH_CHARS):
+            publish_progress(
+                self.document_id, "token", text[i : i + MAX_BATCH_CHARS], self.stage
+            )
+
+
+class ProgressHub:
+    """
+    One LISTEN connection per service process, fanned out to subscribers.
+    Subscribers get an asyncio.Queue of event dicts for one document.
+    """
+
+    def __init__(self, queue_size: int = 1000):
+        self.queue_size = queue_size
+        self._subscribers = {}  # document_id -> set of (loop, queue)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._listen_loop, name="progress-hub", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def subscribe(self, document_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        entry = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            self._subscribers.setdefault(document_id, set()).add(entry)
+        return queue
+
+    def unsubscribe(self, document_id: str, queue: asyncio.Queue) -> None:
+        with self._lock:
+            entries = self._subscribers.get(document_id, set())
+            entries = {e for e in entries if e[1] is not queue}
+            if entries:
+                self._subscribers[document_id] = entries
+            else:
+                self._subscribers.pop(document_id, None)
+
+    def _dispatch(self, payload: str) -> None:
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        with self._lock:
+            entries = list(self._subscribers.get(event.get("document_id"), ()))
+        for loop, queue in entries:
+            loop.call_soon_threadsafe(self._offer, queue, event)
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, event: dict) -> None:
+        """
+        Queue an event for a client (runs on the client's event loop).
+        A slow client whose queue is full loses token and progress events,
+        never the latest status, done or error: a new token is dropped,
+        any other event evicts the oldest queued event of the cheapest kind.
+        """
+        try:
+            queue.put_nowait(event)
+            return
+        except asyncio.QueueFull:
+            pass
+        if event.get("kind") == "token":
+            return
+        # A newer status or terminal event supersedes the oldest status
+        evictable = DROPPABLE_KINDS + ("status",)
+        queued = [queue.get_nowait() for _ in range(queue.qsize())]
+        for kind in evictable:
+            victim = next((e for e in queued if e.get("kind") == kind), None)
+            if victim is not None:
+                queued.remove(victim)
+                queued.append(event)
+                break
+        else:
+            logger.warning(f"Progress queue full; dropped a {event.get('kind')} event")
+        for e in queued:
+            queue.put_nowait(e)
+
+    def _listen_loop(self) -> None:
+        conn = None
+        while not self._stop.is_set():
+            try:
+                if conn is None or conn.closed:
+                    conn = get_db_connection()
+                    conn.autocommit = True
+                    with conn.cursor() as cur:
+                        cur.execute(f"LISTEN {PROGRESS_CHANNEL}")
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self._dispatch(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.warning(f"Progress listener error, reconnecting: {e}")
+                if conn is not None:
+                    conn.close()
+                conn = None
+                self._stop.wait(1.0)
+        if conn is not None:
+            conn.close()
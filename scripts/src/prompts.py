@@ -0,0 +1,161 @@
+"""
+Prompt registry.
+
+All prompt files under PROMPT_DIR (scripts/prompt/) are read once, at
+worker startup or on first use, and kept in memory together with a
+version: the SHA-256 of their content, the same hash the summary state
+and digest caches already store. get_prompt(path) then returns the cached
+text without touching the filesystem, except for an mtime check at most
+every PROMPT_RELOAD_SECONDS; a prompt that changed on disk is re-read and
+gets a new version (0 turns reloading off).
+
+A job sees one consistent set of prompts: inside `with pin_prompts():`
+the first get_prompt() of each file pins that version, and later calls in
+the same job (and in threads started from its copied context) return it
+even if the file is edited meanwhile.
+
+A missing or unreadable prompt raises PromptNotFoundError, a
+FileNotFoundError, which fails the job instead of the process.
+"""
+
+import contextvars
+import hashlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from config import PROMPT_DIR, PROMPT_RELOAD_SECONDS
+
+logger = logging.getLogger("prompts")
+
+PROMPT_EXTENSIONS = (".txt", ".md")
+
+# {path: Prompt} of the running job, see pin_prompts()
+_pinned = contextvars.ContextVar("pinned_prompts", default=None)
+
+
+class PromptNotFoundError(FileNotFoundError):
+    pass
+
+
+class Prompt:
+    __slots__ = ("path", "text", "version", "mtime")
+
+    def __init__(self, path: str, text: str, mtime: float):
+        self.path = path
+        self.text = text
+        self.version = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self.mtime = mtime
+
+    @property
+    def name(self) -> str:
+        """Path relative to PROMPT_DIR, e.g. 'txt/insight_prompt.txt'."""
+        return os.path.relpath(self.path, PROMPT_DIR)
+
+
+def _read(path: str) -> Prompt:
+    try:
+        mtime = os.stat(path).st_mtime
+        with open(path, "r", encoding="utf-8") as f:
+            return Prompt(path, f.read(), mtime)
+    except OSError as e:
+        raise PromptNotFoundError(f"Prompt file not readable: {path} ({e})") from e
+
+
+class PromptRegistry:
+    def __init__(self, root: str = PROMPT_DIR, reload_seconds: float = PROMPT_RELOAD_SECONDS):
+        self.root = root
+        self.reload_seconds = reload_seconds
+        self._prompts = {}
+        self._checked = {}  # path -> time.monotonic() of the last mtime check
+        self._lock = threading.Lock()
+
+    def load_all(self) -> int:
+        """Read every prompt file under root; returns how many were loaded."""
+        count = 0
+        for dirpath, _dirs, files in os.walk(self.root):
+            for name in sorted(files):
+                if name.endswith(PROMPT_EXTENSIONS):
+                    self.get(os.path.join(dirpath, name))
+                    count += 1
+        return count
+
+    def get(self, path: str) -> Prompt:
+        """Current version of a prompt; absolute paths or paths relative to root."""
+        path = os.path.abspath(os.path.join(self.root, path))
+        now = time.monotonic()
+        with self._lock:
+            prompt = self._prompts.get(path)
+            if prompt is not None and (
+                self.reload_seconds <= 0 or now - self._checked[path] < self.reload_seconds
+            ):
+                return prompt
+            self._checked[path] = now
+
+        if prompt is not None:
+            try:
+                if os.stat(path).st_mtime == prompt.mtime:
+                    return prompt
+            except OSError:
+                # Deleted or being replaced: keep serving the loaded version
+                logger.warning(
+                    f"Prompt {prompt.name} disappeared; keeping version {prompt.version[:12]}"
+                )
+                return prompt
+
+        loaded = _read(path)
+        with self._lock:
+            self._prompts[path] = loaded
+        if prompt is None:
+            logger.debug(f"Loaded prompt {loaded.name} (version {loaded.version[:12]})")
+        elif loaded.version != prompt.version:
+            logger.info(
+                f"Reloaded prompt {loaded.name}: version "
+                f"{prompt.version[:12]} -> {loaded.version[:12]}"
+            )
+        return loaded
+
+    def versions(self) -> dict:
+        """{name: version} of all loaded prompts."""
+        with self._lock:
+            return {p.name: p.version for p in self._prompts.values()}
+
+
+_registry = PromptRegistry()
+
+
+def get_registry() -> PromptRegistry:
+    return _registry
+
+
+def get_prompt(path: str) -> Prompt:
+    """The prompt at `path`, pinned to the running job's version if any."""
+    pinned = _pinned.get()
+    if pinned is None:
+        return _registry.get(path)
+    key = os.path.abspath(os.path.join(_registry.root, path))
+    prompt = pinned.get(key)
+    if prompt is None:
+        # setdefault: page threads of one job may race on the first use
+        prompt = pinned.setdefault(key, _registry.get(key))
+    return prompt
+
+
+def load_prompt_text(path: str) -> str:
+    return get_prompt(path).text
+
+
+@contextmanager
+def pin_prompts():
+    """
+    Within the block every prompt keeps the version it had on first use.
+    Yields the {path: Prompt} dict of pinned prompts.
+    """
+    pinned = {}
+    token = _pinned.set(pinned)
+    try:
+        yield pinned
+    finally:
+        _pinned.reset(token)
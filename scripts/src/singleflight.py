@@ -0,0 +1,81 @@
+"""
+In-process request coalescing ("singleflight").
+
+    flight = SingleFlight(ttl=2.0)
+    status = flight.do(document_id, lambda: enqueue(document_id))
+
+Concurrent calls with the same key run fn once; the others wait for it and
+get the same result (or exception). With ttl > 0 a successful result is
+also reused for calls arriving within ttl seconds after it finished, which
+absorbs double clicks and retry bursts that don't quite overlap.
+
+Only for idempotent work whose result may be shared between callers, like
+enqueueing a job. Cross-process deduplication is the job queue's business.
+"""
+
+import threading
+import time
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished_at = None
+
+
+class SingleFlight:
+    def __init__(self, ttl: float = 0.0):
+        self.ttl = ttl
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and call.done.is_set():
+                fresh = call.error is None and time.monotonic() - call.finished_at < self.ttl
+                if not fresh:
+                    del self._calls[key]
+                    call = None
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+            else:
+                leader = False
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            call.finished_at = time.monotonic()
+            with self._lock:
+                if call.error is not None or self.ttl <= 0:
+                    self._calls.pop(key, None)
+                else:
+                    self._prune()
+            call.done.set()
+        return call.result
+
+    def _prune(self) -> None:
+        """Drop results older than ttl (called with the lock held)."""
+        now = time.monotonic()
+        stale = [
+            k
+            for k, c in self._calls.items()
+            if c.done.is_set() and now - c.finished_at >= self.ttl
+        ]
+        for k in stale:
+            del self._calls[k]
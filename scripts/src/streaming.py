@@ -0,0 +1,194 @@
+"""
+Helpers for consuming streamed Ollama chat responses.
+
+StreamCollector buffers tokens in a list (one join at the end instead of
+`full += token`) and looks for an end marker only in a rolling window of
+the last len(marker) - 1 characters plus the new token, so the cost per
+token is bounded no matter how long the output gets.
+
+collect_chat_stream() drives an `ollama.chat(..., stream=True)` iterator
+through a collector and closes it as soon as the marker appears, which
+drops the HTTP response and makes the server stop generating.
+
+Sinks decide where tokens and progress messages go: ConsoleSink for the
+CLI main()s, LogSink for the service/worker (no per-token I/O, no report
+text in logs) and CallbackSink to publish partial output while a job runs.
+"""
+
+import logging
+import time
+
+
+class StreamCollector:
+    """Accumulates streamed tokens and detects an optional end marker."""
+
+    def __init__(self, end_marker: str | None = None):
+        self.end_marker = end_marker
+        self.marker_seen = False
+        self._parts = []
+        self._length = 0
+        self._tail = ""
+        self._cut = None  # absolute offset of the marker, once seen
+
+    def feed(self, token: str) -> bool:
+        """Add a token. Returns True once the end marker has been seen."""
+        if self.marker_seen or not token:
+            return self.marker_seen
+
+        if self.end_marker:
+            window = self._tail + token
+            idx = window.find(self.end_marker)
+            if idx != -1:
+                self._cut = self._length - len(self._tail) + idx
+                self.marker_seen = True
+            else:
+                keep = len(self.end_marker) - 1
+                self._tail = window[-keep:] if keep else ""
+
+        self._parts.append(token)
+        self._length += len(token)
+        return self.marker_seen
+
+    def text(self) -> str:
+        """Everything received so far, without the end marker and what follows."""
+        full = "".join(self._parts)
+        # Collapse the buffer so repeated calls stay cheap
+        self._parts = [full]
+        if self._cut is not None:
+            return full[: self._cut]
+        return full
+
+
+def collect_chat_stream(
+    stream, end_marker: str | None = None, on_token=None, stats: dict | None = None
+) -> str:
+    """
+    Consume a streaming chat response and return the generated content.
+
+    - on_token(token) is called for every non-empty content token.
+    - If end_marker is given, the stream is closed as soon as it appears
+      and the returned text stops right before it.
+    - If a stats dict is given it is filled with timings (seconds) and,
+      when the stream ran to its final chunk, Ollama's token counts:
+        ttft_seconds, decode_seconds, stopped_early,
+        eval_count, eval_seconds, prompt_eval_count
+      When the stream is closed at the end marker Ollama never sends its
+      final chunk; eval_count then counts the streamed chunks and
+      eval_seconds is the locally measured decode time.
+    """
+    collector = StreamCollector(end_marker)
+    started = time.perf_counter()
+    first_token_at = None
+    chunks = 0
+    final = None
+    try:
+        for chunk in stream:
+            if chunk.get("done"):
+                final = chunk
+            token = chunk.get("message", {}).get("content", "")
+            if not token:
+                continue
+            chunks += 1
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            if on_token is not None:
+                on_token(token)
+            if collector.feed(token):
+                break
+    finally:
+        # Closing the generator closes the underlying HTTP response, so the
+        # server stops generating instead of running to its token limit.
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+
+    if stats is not None:
+        ended = time.perf_counter()
+        decode_seconds = ended - first_token_at if first_token_at is not None else 0.0
+        stats["ttft_seconds"] = (
+            first_token_at - started if first_token_at is not None else None
+        )
+        stats["decode_seconds"] = decode_seconds
+        stats["stopped_early"] = collector.marker_seen
+        if final is not None and final.get("eval_count"):
+            stats["eval_count"] = final.get("eval_count")
+            stats["eval_seconds"] = (final.get("eval_duration") or 0) / 1e9
+            stats["prompt_eval_count"] = final.get("prompt_eval_count")
+        else:
+            stats["eval_count"] = chunks
+            stats["eval_seconds"] = decode_seconds
+            stats["prompt_eval_count"] = None
+    return collector.text()
+
+
+# -------------------------------------------------------------------
+# Sinks: where streamed output and progress messages go
+# -------------------------------------------------------------------
+class ConsoleSink:
+    """Print everything, token by token (CLI scripts)."""
+
+    def event(self, message: str) -> None:
+        print(message)
+
+    def document(self, title: str, text: str) -> None:
+        print(f"{title}\n{text}")
+
+    def token(self, token: str) -> None:
+        print(token, end="", flush=True)
+
+
+class LogSink:
+    """
+    Service / worker default: no per-token I/O. Progress messages are
+    logged at DEBUG; prompts and reports (which may contain PHI) only
+    have their size logged, and only when DEBUG is enabled.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger("llm_stream")
+
+    def event(self, message: str) -> None:
+        self.logger.debug(message.strip())
+
+    def document(self, title: str, text: str) -> None:
+        self.logger.debug("%s (%d chars)", title.strip(), len(text))
+
+    def token(self, token: str) -> None:
+        pass
+
+
+class CallbackSink:
+    """
+    Publish progress to callback(kind, data) with kind "event" or "token",
+    e.g. to stream partial output to a client. Prompts and reports are not
+    published. Everything is also passed to `inner` (default: LogSink).
+    """
+
+    def __init__(self, callback, inner=None):
+        self.callback = callback
+        self.inner = inner if inner is not None else LogSink()
+
+    def event(self, message: str) -> None:
+        self.inner.event(message)
+        # Drop the console decoration ("=== ... ===", "--- ... ---")
+        self.callback("event", message.strip().strip("=-").strip())
+
+    def document(self, title: str, text: str) -> None:
+        self.inner.document(title, text)
+
+    def token(self, token: str) -> None:
+        self.inner.token(token)
+        self.callback("token", token)
+
+
+_default_sink = ConsoleSink()
+
+
+def set_default_sink(sink) -> None:
+    """Set the sink used when a caller doesn't pass one (e.g. LogSink in the worker)."""
+    global _default_sink
+    _default_sink = sink
+
+
+def get_default_sink():
+    return _default_sink
@@ -3,27 +3,182 @@
 import os
 import sys
 import re
+from bisect import bisect_right
+
 import fitz  # PyMuPDF
 
 # Add parent directory to path to allow importing config
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from config import INPUT_PDF, OUTPUT_MD
+from config import (
+    INPUT_PDF,
+    OUTPUT_MD,
+    TEXT_LAYER_MIN_CHARS,
+    TEXT_LAYER_MAX_IMAGE_COVERAGE,
+)
+
+# A line holding nothing but a number / range / flag, e.g. "13.2", "4.0 - 11.0", "<5"
+NUMERIC_ONLY_LINE = re.compile(r"^[\d.,:/%<>=+\-–\s]+$")
+# 2+ spaces inside one span separate columns (space-padded layouts)
+COLUMN_GAP = re.compile(r"\s{2,}")
+
+# Layout thresholds, in multiples of the font size unless noted.
+# Spans on one row further apart than this start a new cell
+CELL_GAP_EM = 1.0
+# Rows with more empty space than this between them start a new block
+BLOCK_GAP_EM = 0.8
+# A single-line row this much larger than the page's body text is a heading
+HEADING_SIZE_RATIO = 1.15
+# Cells starting within this many points of each other share a table column
+COLUMN_TOLERANCE = 10.0
+
+# get_text("dict") without images; only the text layer is used here
+TEXT_FLAGS = fitz.TEXTFLAGS_TEXT
+
+
+class Row:
+    """One visual line of a page: its cells as (x0, text), left to right."""
 
+    __slots__ = ("y0", "y1", "size", "cells")
 
-def extract_lines_from_pdf(pdf_path: str):
-    """Return list of pages, each as list of lines (strings)."""
+    def __init__(self, y0: float, y1: float, size: float, cells: list):
+        self.y0 = y0
+        self.y1 = y1
+        self.size = size
+        self.cells = cells
+
+    @property
+    def text(self) -> str:
+        return "  ".join(text for _, text in self.cells)
+
+
+def _make_row(spans) -> Row:
+    """
+    Build a Row from spans sharing a baseline. Spans further apart than
+    CELL_GAP_EM become separate cells, as do runs of 2+ spaces in a span.
+    """
+    spans.sort(key=lambda s: s[1])
+    size = max(s[5] for s in spans)
+    cells = []
+    prev_x1 = None
+    for _, x0, x1, _, _, span_size, text in spans:
+        if prev_x1 is not None and x0 - prev_x1 <= span_size * CELL_GAP_EM:
+            cell_x0, cell_text = cells[-1]
+            if x0 - prev_x1 > span_size * 0.15 and not cell_text.endswith(" "):
+                cell_text += " "
+            cells[-1] = (cell_x0, cell_text + text)
+        else:
+            cells.append((x0, text))
+        prev_x1 = x1
+
+    row_cells = []
+    for x0, text in cells:
+        text = text.strip()
+        parts = COLUMN_GAP.split(text)
+        if len(parts) == 1:
+            row_cells.append((x0, text))
+            continue
+        # Place sub-cells by character offset; good enough to align columns
+        char_width = size * 0.5
+        offset = 0
+        for part in parts:
+            offset = text.index(part, offset)
+            row_cells.append((x0 + offset * char_width, part))
+            offset += len(part)
+    return Row(min(s[3] for s in spans), max(s[4] for s in spans), size, row_cells)
+
+
+def extract_page_rows(page) -> list:
+    """
+    Return a page's text layer as visual rows, top to bottom, from the span
+    coordinates of get_text("dict"). Spans are grouped into rows by their
+    vertical center, so table cells written as separate text objects still
+    end up on one row, in column order.
+    """
+    spans = []
+    for block in page.get_text("dict", flags=TEXT_FLAGS)["blocks"]:
+        for line in block["lines"]:
+            # Skip rotated text (margins, watermarks)
+            if abs(line["dir"][1]) > 0.1:
+                continue
+            for span in line["spans"]:
+                text = span["text"]
+                if not text.strip():
+                    continue
+                x0, y0, x1, y1 = span["bbox"]
+                spans.append(((y0 + y1) / 2, x0, x1, y0, y1, span["size"], text))
+
+    spans.sort()
+    rows = []
+    current = []
+    row_center = row_size = 0.0
+    for span in spans:
+        if current and span[0] - row_center > row_size * 0.5:
+            rows.append(_make_row(current))
+            current = []
+        if not current:
+            row_center, row_size = span[0], span[5]
+        current.append(span)
+    if current:
+        rows.append(_make_row(current))
+    return rows
+
+
+def iter_pdf_pages(pdf_path: str):
+    """
+    Yield (page_number, rows) for each page. Only the current page's layout
+    is held in memory, so long PDFs convert in bounded memory.
+    """
     if not os.path.exists(pdf_path):
         print(f"[ERROR] PDF file not found: {pdf_path}", file=sys.stderr)
         sys.exit(1)
 
-    doc = fitz.open(pdf_path)
-    pages = []
-    for page in doc:
-        # Use simple text extraction, then split into lines
-        text = page.get_text("text")
-        lines = text.splitlines()
-        pages.append(lines)
-    return pages
+    with fitz.open(pdf_path) as doc:
+        for i, page in enumerate(doc, start=1):
+            yield i, extract_page_rows(page)
+
+
+def classify_page(page, rows=None):
+    """
+    Decide whether a PDF page's text layer is good enough to convert
+    without the vision model.
+
+    Returns (use_text_layer, reason). A page qualifies when:
+    - it has embedded fonts (a scanned page usually has none),
+    - its text layer has at least TEXT_LAYER_MIN_CHARS characters,
+      with no more than a few undecodable glyphs,
+    - images cover at most TEXT_LAYER_MAX_IMAGE_COVERAGE of the page
+      (rules out scans with an OCR text layer on top), and
+    - table values did not lose their layout: when most rows are bare
+      numbers but no table block can be detected, cells were emitted one
+      per line and the VLM reconstructs the table better.
+    """
+    if not page.get_fonts():
+        return False, "no fonts"
+
+    if rows is None:
+        rows = extract_page_rows(page)
+    texts = [row.text for row in rows]
+    text = "".join(texts)
+    chars = len("".join(text.split()))
+    if chars < TEXT_LAYER_MIN_CHARS:
+        return False, f"sparse text layer ({chars} chars)"
+    if text.count("\ufffd") > chars * 0.02:
+        return False, "undecodable glyphs"
+
+    page_area = abs(page.rect)
+    image_area = 0.0
+    for info in page.get_image_info():
+        image_area += abs(fitz.Rect(info["bbox"]) & page.rect)
+    if page_area and image_area / page_area > TEXT_LAYER_MAX_IMAGE_COVERAGE:
+        return False, f"image covers {image_area / page_area:.0%} of page"
+
+    numeric = sum(1 for t in texts if NUMERIC_ONLY_LINE.match(t))
+    if numeric > len(texts) * 0.3 and not any(
+        looks_like_table_block(block) for block in group_blocks(rows)
+    ):
+        return False, "table layout lost in text layer"
+
+    return True, f"text layer ({chars} chars)"
 
 
 def is_heading(line: str) -> bool:
@@ -40,93 +195,115 @@ def is_heading(line: str) -> bool:
     if stripped.endswith(":"):
         return True
 
-    # Mostly uppercase and letters / spaces
-    letters = re.sub(r"[^A-Za-z]", "", stripped)
-    if not letters:
+    # Mostly uppercase letters
+    upper = sum(map(str.isupper, stripped))
+    lower = sum(map(str.islower, stripped))
+    if not upper + lower:
         return False
+    return upper / (upper + lower) > 0.7
 
-    upper_ratio = sum(1 for c in letters if c.isupper()) / len(letters)
-    return upper_ratio > 0.7
 
+def is_heading_row(row: Row, body_size: float) -> bool:
+    """A single-cell row that reads like a heading or is set in a larger font."""
+    if len(row.cells) != 1:
+        return False
+    text = row.cells[0][1]
+    if is_heading(text):
+        return True
+    return len(text) <= 60 and row.size >= body_size * HEADING_SIZE_RATIO
+
+
+def body_font_size(rows) -> float:
+    """Font size covering the most characters on the page."""
+    weights = {}
+    for row in rows:
+        size = round(row.size, 1)
+        weights[size] = weights.get(size, 0) + sum(len(t) for _, t in row.cells)
+    return max(weights, key=weights.get) if weights else 0.0
 
-def looks_like_table_block(lines):
+
+def looks_like_table_block(rows):
     """
     Heuristic: a block looks like a table if
-    - It has at least 3 non-empty lines
-    - Many lines have multiple chunks separated by 2+ spaces
+    - It has at least 3 rows
+    - Most rows have 2+ cells
     """
-    non_empty = [ln for ln in lines if ln.strip()]
-    if len(non_empty) < 3:
+    if len(rows) < 3:
         return False
+    multi_col_count = sum(1 for row in rows if len(row.cells) >= 2)
+    return multi_col_count >= max(2, len(rows) // 2)
 
-    multi_col_count = 0
-    for ln in non_empty:
-        # Split on 2+ spaces
-        parts = re.split(r"\s{2,}", ln.strip())
-        if len(parts) >= 2:
-            multi_col_count += 1
 
-    # If most lines have 2+ columns, treat as table
-    return multi_col_count >= max(2, len(non_empty) // 2)
+def column_anchors(rows) -> list:
+    """
+    Left edges of the table's columns: cell x positions clustered within
+    COLUMN_TOLERANCE, in one pass over the sorted positions.
+    """
+    anchors = []
+    for x0 in sorted(x0 for row in rows for x0, _ in row.cells):
+        if not anchors or x0 - anchors[-1] > COLUMN_TOLERANCE:
+            anchors.append(x0)
+    return anchors
 
 
-def block_to_markdown_table(lines):
+def block_to_markdown_table(rows):
     """
-    Convert a block of lines into a markdown table using 2+ spaces as column separators.
-    First line is assumed to be header.
+    Convert a block of rows into a markdown table, placing each cell in the
+    column its x position falls into. First row is assumed to be header.
     """
-    # Split each non-empty line into columns
-    rows = []
-    for ln in lines:
-        if not ln.strip():
-            continue
-        cols = re.split(r"\s{2,}", ln.strip())
-        rows.append(cols)
-
     if not rows:
         return ""
 
-    # Normalize column counts by padding with empty strings
-    max_cols = max(len(r) for r in rows)
-    norm_rows = [r + [""] * (max_cols - len(r)) for r in rows]
-
-    header = norm_rows[0]
-    data_rows = norm_rows[1:]
+    anchors = column_anchors(rows)
+    table = []
+    for row in rows:
+        cols = [""] * len(anchors)
+        for x0, text in row.cells:
+            i = max(0, bisect_right(anchors, x0 + COLUMN_TOLERANCE / 2) - 1)
+            text = text.replace("|", "\\|")
+            cols[i] = f"{cols[i]} {text}" if cols[i] else text
+        table.append(cols)
 
     md_lines = []
     # Header
-    md_lines.append("| " + " | ".join(header) + " |")
+    md_lines.append("| " + " | ".join(table[0]) + " |")
     # Separator
-    md_lines.append("|" + "|".join(["---"] * max_cols) + "|")
+    md_lines.append("|" + "|".join(["---"] * len(anchors)) + "|")
     # Rows
-    for r in data_rows:
+    for r in table[1:]:
         md_lines.append("| " + " | ".join(r) + " |")
 
     return "\n".join(md_lines)
 
 
-def group_blocks(lines):
+def group_blocks(rows):
     """
-    Group consecutive lines into blocks separated by empty lines.
-    Each block is a list of lines.
+    Group consecutive rows into blocks, split where there is vertical
+    space between rows (a blank line) or the font size changes.
+    Each block is a list of rows.
     """
     blocks = []
     current = []
-    for ln in lines:
-        if ln.strip():
-            current.append(ln)
-        else:
-            if current:
+    prev = None
+    for row in rows:
+        if prev is not None:
+            size = min(prev.size, row.size)
+            if (
+                row.y0 - prev.y1 > size * BLOCK_GAP_EM
+                or max(prev.size, row.size) > size * HEADING_SIZE_RATIO
+            ):
                 blocks.append(current)
                 current = []
+        current.append(row)
+        prev = row
     if current:
         blocks.append(current)
     return blocks
 
 
-def page_to_markdown(lines, page_number: int):
+def page_to_markdown(rows, page_number: int):
     """
-    Convert a single page's lines into markdown:
+    Convert a single page's rows into markdown:
     - 'Page N' header
     - Blocks as headings, tables, or paragraphs based on heuristics
     """
@@ -134,12 +311,22 @@ def page_to_markdown(lines, page_number: int):
     md.append(f"## Page {page_number}")
     md.append("")
 
-    blocks = group_blocks(lines)
+    body_size = body_font_size(rows)
+
+    for block in group_blocks(rows):
+        # A heading directly above a table, without space in between
+        if (
+            len(block) > 3
+            and is_heading_row(block[0], body_size)
+            and looks_like_table_block(block[1:])
+        ):
+            md.append(f"### {block[0].text.rstrip(':').title()}")
+            md.append("")
+            block = block[1:]
 
-    for block in blocks:
         # Single-line block that looks like a heading
-        if len(block) == 1 and is_heading(block[0]):
-            heading_text = block[0].strip().rstrip(":")
+        if len(block) == 1 and is_heading_row(block[0], body_size):
+            heading_text = block[0].text.rstrip(":")
             # Capitalize nicely
             heading_text = heading_text.title()
             md.append(f"### {heading_text}")
@@ -153,21 +340,22 @@ def page_to_markdown(lines, page_number: int):
             continue
 
         # Otherwise, treat as paragraphs
-        # Collapse lines into one paragraph, but keep block boundaries
-        para = " ".join(ln.strip() for ln in block)
+        # Collapse rows into one paragraph, but keep block boundaries
+        para = " ".join(row.text for row in block)
         md.append(para)
         md.append("")
 
     return "\n".join(md)
 
 
+def iter_markdown_pages(pdf_path: str):
+    """Yield the Markdown of each page in order, one page at a time."""
+    for i, rows in iter_pdf_pages(pdf_path):
+        yield page_to_markdown(rows, i)
+
+
 def pdf_to_markdown(pdf_path: str) -> str:
-    pages = extract_lines_from_pdf(pdf_path)
-    md_pages = []
-    for i, lines in enumerate(pages, start=1):
-        md = page_to_markdown(lines, i)
-        md_pages.append(md)
-    return "\n\n".join(md_pages)
+    return "\n\n".join(iter_markdown_pages(pdf_path))
 
 
 def main():
@@ -177,14 +365,15 @@ def main():
         sys.exit(1)
 
     print("\n=== 📄 Converting PDF to Markdown (no LLM) ===\n")
-    markdown = pdf_to_markdown(pdf_path)
-
-    # Stream to console
-    print(markdown)
 
-    # Save to file
+    # Stream each page to the console and the file as it is converted
     with open(OUTPUT_MD, "w", encoding="utf-8") as f:
-        f.write(markdown)
+        for i, page_md in enumerate(iter_markdown_pages(pdf_path)):
+            if i:
+                print()
+                f.write("\n\n")
+            print(page_md)
+            f.write(page_md)
 
     print("\n=== ✅ Markdown saved ===")
     print(os.path.abspath(OUTPUT_MD))